@@ -0,0 +1,248 @@
+"""per date and per neighborhood summaries of the posts for the dashboard's charts
+
+the per date summaries are indexed by neighborhood and sorted by neighborhood then
+date, so a chart trace is one slice through neighborhood_slice
+
+the cube holds post counts and price totals per date, neighborhood, size and
+PRICE_BUCKET, so the charts can be answered by summing slices of it instead of scanning
+every post, and its size stops growing with the posts once their dates fill it. its
+cells are histogram sketches of price, which give medians and percentiles of any
+selection within PRICE_BUCKET of exact, and the price totals give exact averages
+"""
+import numpy as np
+import pandas as pd
+
+
+def neighborhood_slice(summary, neighborhood):
+    """rows of a per date summary for a single neighborhood"""
+    if neighborhood not in summary.index:
+        return summary.iloc[:0]
+
+    return summary.loc[[neighborhood]]
+
+
+# width of a price bucket in the cube, the same as the dashboard's price slider step
+PRICE_BUCKET = 50
+
+# columns a cube's cells are keyed by
+CUBE_KEYS = ['post_date', 'neighborhood', 'size', 'price_bucket', 'on_edge']
+
+
+def build_cube(apartment_data):
+    """post counts and price totals per post_date, neighborhood, size and PRICE_BUCKET,
+    built once per dataset from the compacted posts
+
+    each bucket is split into the posts exactly on its lower edge and those inside it.
+    the slider's ends are multiples of PRICE_BUCKET, so its inclusive ranges are whole
+    cells and count the same posts as the raw prices
+    """
+    prices = apartment_data['post_price'].values.astype(np.int64)
+    posts = pd.DataFrame({
+        'post_day': apartment_data['post_day'].values,
+        'neighborhood': apartment_data['neighborhood'].values,
+        'size': apartment_data['size'].values,
+        'price_bucket': prices // PRICE_BUCKET * PRICE_BUCKET,
+        'on_edge': prices % PRICE_BUCKET == 0,
+        'post_price': prices,
+    })
+
+    grouped = posts.groupby(['post_day'] + CUBE_KEYS[1:], sort=True, observed=True)['post_price']
+    cube = pd.DataFrame({'posts': grouped.size(), 'price_sum': grouped.sum()}).reset_index()
+    cube.insert(0, 'post_date', pd.to_datetime(cube.pop('post_day'), unit='D'))
+
+    return finish_cube(cube)
+
+
+def cube_from_counts(counts):
+    """cube from posts and price totals per cell counted elsewhere, like the database's
+    daily rollups, laid out like build_cube's. cells with no posts are left out
+    """
+    counts = counts.loc[counts['posts'] > 0]
+    cube = pd.DataFrame({
+        'post_date': pd.to_datetime(counts['post_date']),
+        'neighborhood': counts['neighborhood'].astype(object),
+        'size': counts['size'].astype(object),
+        'price_bucket': counts['price_bucket'],
+        'on_edge': counts['on_edge'].astype(bool),
+        'posts': counts['posts'],
+        'price_sum': counts['price_sum'],
+    })
+    cube = cube.sort_values(CUBE_KEYS, kind='mergesort')
+
+    return finish_cube(cube.reset_index(drop=True))
+
+
+def finish_cube(cube):
+    """categorical neighborhood and size, and the same dtypes however the cube was counted"""
+    cube['neighborhood'] = cube['neighborhood'].astype('category')
+    cube['size'] = cube['size'].astype('category')
+    for column in ['price_bucket', 'posts', 'price_sum']:
+        cube[column] = cube[column].astype(np.int64)
+    cube['on_edge'] = cube['on_edge'].astype(bool)
+
+    return cube
+
+
+def take_rows(frame, rows):
+    """the frame's rows at positions or where a mask is true, taken a column at a time
+
+    unlike loc and iloc this never consolidates frame's columns into new blocks, which
+    would copy every column of a frame mapped from a saved snapshot
+    """
+    return pd.DataFrame({column: frame[column].values[rows] for column in frame.columns},
+                        index=frame.index[rows], columns=frame.columns)
+
+
+def select_cube(cube, neighborhoods=None, price_range=None, sizes=None):
+    """cells of the cube within the selections, None selects everything
+
+    price_range's ends are multiples of PRICE_BUCKET, like the slider's. the bucket at
+    its upper end counts only the posts exactly on its edge
+    """
+    keep = np.ones(len(cube), dtype=bool)
+
+    if neighborhoods is not None:
+        keep &= cube['neighborhood'].isin(neighborhoods).values
+    if price_range is not None:
+        buckets = cube['price_bucket'].values
+        keep &= (buckets >= price_range[0]) & (
+            (buckets < price_range[1]) | ((buckets == price_range[1]) & cube['on_edge'].values))
+    if sizes is not None:
+        keep &= cube['size'].isin(sizes).values
+
+    return take_rows(cube, keep)
+
+
+def merge_cubes(cube, other):
+    """cube counting the posts of both, as when new posts are counted into a dataset's cube"""
+    cells = pd.concat([cube, other], ignore_index=True, sort=False)
+    for column in ['neighborhood', 'size']:
+        cells[column] = cells[column].astype(object)
+
+    merged = cells.groupby(CUBE_KEYS, sort=True)[['posts', 'price_sum']].sum()
+
+    return finish_cube(merged.reset_index())
+
+
+def replace_dates(cube, cells, since):
+    """cube with its cells from since's date on replaced by cells, as when those dates
+    are counted again
+    """
+    kept = take_rows(cube, cube['post_date'].values < np.datetime64(pd.Timestamp(since).normalize()))
+
+    return merge_cubes(kept, cells)
+
+
+def price_sketches(cells, keys):
+    """posts per PRICE_BUCKET for each group of cells, and how many of them are exactly
+    on its lower edge, a histogram sketch of their prices
+
+    sketches of any dates, neighborhoods or sizes merge by adding their counts, so a
+    group's sketch is the sum of its cells' whatever range they cover
+    """
+    sketches = pd.DataFrame({column: cells[column].values for column in keys + ['price_bucket']})
+    sketches['posts'] = cells['posts'].values
+    sketches['edge_posts'] = np.where(cells['on_edge'].values, cells['posts'].values, 0)
+
+    return sketches.groupby(keys + ['price_bucket'], observed=True)[['posts', 'edge_posts']].sum().reset_index()
+
+
+def sketch_quantiles(sketches, keys, quantile):
+    """approximate quantile of the prices in each group of price_sketches
+
+    the posts on a bucket's edge are at its price, and the rest are taken as spread
+    evenly inside it, then the quantile is interpolated between the posts either side
+    of it like Series.quantile. each of those posts is placed in its own bucket, so the
+    result is less than PRICE_BUCKET from the exact quantile, and exact when both are on
+    edges, as most rents are round amounts. a group with no posts has no quantile, NaN
+    """
+    if len(sketches) == 0:
+        return pd.Series([], dtype=float, name='post_price', index=pd.MultiIndex.from_frame(sketches[keys]))
+
+    groups = sketches.groupby(keys, observed=True).ngroup().values
+    buckets = sketches['price_bucket'].values
+
+    # buckets in group order then price order, with the running count of posts through them
+    order = np.lexsort([buckets, groups])
+    groups = groups[order]
+    buckets = buckets[order]
+    counts = sketches['posts'].values[order]
+    edges = sketches['edge_posts'].values[order]
+    through = np.cumsum(counts)
+
+    starts = np.concatenate([[0], np.flatnonzero(np.diff(groups)) + 1])
+    before = np.concatenate([[0], through[starts[1:] - 1]])
+    total = np.append(through[starts[1:] - 1], through[-1:]) - before
+
+    def price_of(rank):
+        # the price of the post at rank within its group, counting from 0
+        i = np.searchsorted(through, before + rank, side='right')
+        within = before + rank - (through[i] - counts[i])
+        inside = PRICE_BUCKET * (within - edges[i] + 1) / (counts[i] - edges[i] + 1)
+
+        return buckets[i] + np.where(within < edges[i], 0, inside)
+
+    position = quantile * (total - 1)
+    lower = np.floor(position)
+    upper = np.minimum(lower + 1, total - 1)
+    prices = price_of(lower) + (position - lower) * (price_of(upper) - price_of(lower))
+    # an empty group's ranks fall in the group before it
+    prices = np.where(total > 0, prices, np.nan)
+
+    quantiles = pd.Series(prices, index=pd.MultiIndex.from_frame(sketches[keys].iloc[order[starts]]),
+                          name='post_price')
+    if len(keys) == 1:
+        quantiles.index = quantiles.index.get_level_values(0)
+
+    return quantiles
+
+
+def cube_posts_per_date(cells):
+    """counts of posts per date per neighborhood, a posts column indexed by neighborhood"""
+    counts = cells.groupby(['neighborhood', 'post_date'], observed=True)['posts'].sum().sort_index()
+
+    return counts.reset_index(level='post_date')
+
+
+def cube_price_quantile_per_date(cells, quantile):
+    """a quantile of price per date per neighborhood from price sketches, a price column
+    indexed by neighborhood
+    """
+    keys = ['neighborhood', 'post_date']
+    prices = sketch_quantiles(price_sketches(cells, keys), keys, quantile).sort_index()
+
+    return prices.rename('price').reset_index(level='post_date')
+
+
+def cube_price_histogram(cells, price_range=None):
+    """posts per PRICE_BUCKET per neighborhood, indexed by neighborhood like the per date summaries
+
+    at most one row per bucket of the price range, however many posts or dates the
+    cells cover. the posts exactly at the top of price_range are counted in the bucket
+    below it, so the last bucket is closed and no bucket reaches past the range
+    """
+    buckets = cells['price_bucket']
+    if price_range is not None and price_range[0] < price_range[1]:
+        buckets = buckets.where(buckets < price_range[1], price_range[1] - PRICE_BUCKET)
+
+    counts = cells['posts'].groupby([cells['neighborhood'], buckets.rename('price_bucket')], observed=True).sum()
+    counts = counts.sort_index()
+
+    return counts.reset_index(level='price_bucket')
+
+
+def cube_all_time_prices(cells):
+    """all-time median and average price of each neighborhood, as two frames of
+    post_price and neighborhood sorted by neighborhood
+
+    the averages are exact, the medians come from price sketches
+    """
+    # sorted afterwards, groupby leaves observed categories in the order they appear
+    totals = cells.groupby('neighborhood', observed=True)[['posts', 'price_sum']].sum().sort_index()
+    means = totals['price_sum'] / totals['posts']
+    medians = sketch_quantiles(price_sketches(cells, ['neighborhood']), ['neighborhood'], 0.5).reindex(totals.index)
+
+    df_median = pd.DataFrame({'post_price': medians.round(0).values, 'neighborhood': totals.index.astype(object)})
+    df_mean = pd.DataFrame({'post_price': means.round(0).values, 'neighborhood': totals.index.astype(object)})
+
+    return df_median, df_mean
@@ -1,165 +1,267 @@
-from requests import get
-from bs4 import BeautifulSoup
 import pandas as pd
-from time import sleep
-from random import randint
-import os
+import argparse
+import time
 import sqlalchemy
-from sqlalchemy import create_engine
-import psycopg2
-from psycopg2 import IntegrityError, errors
 from datetime import datetime
 import datetime as dt
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlparse, urlunparse, parse_qsl, urlencode
+from fetch import FetchEngine, REQUESTS_PER_SECOND
+from replay import make_mode_session
+import rollups
+import storage
+from storage import copy_frame
+from parsers import get_parser
 
 
 pd.options.mode.chained_assignment = None  # default='warn'
 
+# craigslist serves results in pages of 120, offset by the s= parameter
+RESULTS_PER_PAGE = 120
 
-def get_apartment_data(searches):
-    """main function for searching apartment postings"""
+# how deep to follow result pages per location, craigslist stops at 3000 results
+MAX_PAGES = 25
 
-    all_apartments = pd.DataFrame()
+# columns of a scraped post, in the order parse_results_page emits them
+POST_COLUMNS = ('region', 'post_datetime', 'neighborhood', 'post_title_text', 'post_price', 'post_link')
 
-    # loop through each of the locations
-    for location, link in searches.items():
+# candidate posts looked up per query when checking for already stored posts
+DEDUP_CHUNK_SIZE = 1000
 
-        # momentary sleep
-        sleep(randint(1, 5))
+# fastest html parser installed, see parsers.py
+DEFAULT_PARSER = get_parser()
 
-        response = get(link)
+# how many days of stored post links to check new pages against
+KNOWN_LINK_DAYS = 14
 
-        html_soup = BeautifulSoup(response.text, 'html.parser')
 
-        posts = html_soup.find_all('li', class_= 'result-row')
-        print('location: ' + location + "\nposts found: " + str(len(posts)) + "\n")
+def page_url(link, offset):
+    """url of the results page starting at the given post offset"""
+    if offset == 0:
+        return link
 
-        # loop through each of the posts
-        for i in range(0, (len(posts) - 1)):
-            post = posts[i]
+    parts = urlparse(link)
+    query = [(k, v) for k, v in parse_qsl(parts.query) if k != 's'] + [('s', str(offset))]
 
-            # skip if the neighborhood is not available
-            if post.find('span', class_ = 'result-hood') is not None:
+    return urlunparse(parts._replace(query=urlencode(query)))
 
-                # get the time of the post
-                post_time = post.find('time', class_= 'result-date')
-                post_datetime = post_time['datetime']
 
-                # get the title and associated link
-                post_title = post.find('a', class_='result-title hdrlnk')
-                post_link = post_title['href']
-                post_title_text = post_title.text
+def load_known_links(con, table, days=KNOWN_LINK_DAYS):
+    """set of post links already stored in the table within the last few days"""
+    since = datetime.today() - dt.timedelta(days=days)
+    sql = sqlalchemy.text(
+        "SELECT post_link FROM " + table + " WHERE post_datetime >= :since"
+    )
+    x = pd.read_sql(sql, con=con, params={'since': since})
 
-                # get the neighborhood
-                post_hood = post.find('span', class_= 'result-hood').text
+    return set(x['post_link'])
 
-                # get the post price
-                try:
-                    post_price = int(post.a.text.strip().replace("$", ""))
-                except ValueError:
-                    continue
 
-                # create dataframe of the post
-                data = pd.DataFrame(
-                    data={
-                        "region": [location],
-                        "post_datetime": [post_datetime],
-                        "neighborhood": [post_hood],
-                        "post_title_text": [post_title_text],
-                        "post_price": [post_price],
-                        "post_link": [post_link],
-                    }
-                )
+class PostColumns(object):
+    """accumulates scraped posts as column lists, built into one typed dataframe at the end"""
+    __slots__ = POST_COLUMNS
 
-                # append all-in dataframe
-                all_apartments = all_apartments.append(data, sort=False)
+    def __init__(self):
+        for column in POST_COLUMNS:
+            setattr(self, column, [])
 
-    # format
-    all_apartments['neighborhood'] = all_apartments['neighborhood'].str.translate(
-        (str.maketrans({'(': '', ')': ''})))
+    def __len__(self):
+        return len(self.post_link)
 
-    all_apartments['neighborhood'] = all_apartments['neighborhood'].str.lstrip()
+    def extend(self, records):
+        """add (region, post_datetime, neighborhood, post_title_text, post_price, post_link) tuples"""
+        for record in records:
+            for column, value in zip(POST_COLUMNS, record):
+                getattr(self, column).append(value)
+
+    def to_frame(self):
+        """single dataframe of all the posts"""
+        # strip the parentheses craigslist puts around neighborhoods, once per distinct value
+        hood_translation = str.maketrans({'(': '', ')': ''})
+        hoods = {h: h.translate(hood_translation).lstrip() for h in set(self.neighborhood)}
+
+        return pd.DataFrame({
+            'region': pd.Categorical(self.region),
+            'post_datetime': pd.to_datetime(pd.Series(self.post_datetime, dtype=object)),
+            'neighborhood': pd.Categorical([hoods[h] for h in self.neighborhood]),
+            'post_title_text': pd.Series(self.post_title_text, dtype=object),
+            'post_price': pd.Series(self.post_price, dtype='int64'),
+            'post_link': pd.Series(self.post_link, dtype=object),
+        }, columns=list(POST_COLUMNS))
+
+
+def parse_results_page(html, location, parser=None):
+    """parse a single results page, returns the number of posts found and a list of post records"""
+    if parser is None:
+        parser = DEFAULT_PARSER
+
+    return parser.parse(html, location)
+
+
+def get_apartment_data(searches, engine=None, known_links=None, max_pages=1):
+    """main function for searching apartment postings
+
+    follows the result pages of each location up to max_pages deep, stopping early
+    on a short page or on a page where every post link is already in known_links
+    """
+    if engine is None:
+        with FetchEngine() as engine:
+            return get_apartment_data(searches, engine, known_links, max_pages)
+
+    all_posts = PostColumns()
+
+    # page through all the locations together, one round of requests per page depth
+    # politeness is handled by the engine's rate limiter
+    offsets = {location: 0 for location in searches}
+    for page in range(max_pages):
+        responses = engine.fetch_all({
+            location: page_url(searches[location], offset) for location, offset in offsets.items()
+        })
+
+        for location, response in responses.items():
+            posts_found, records = parse_results_page(response.text, location)
+            print('location: ' + location + "\npage: " + str(page + 1)
+                  + "\nposts found: " + str(posts_found)
+                  + "\nlatency: " + str(round(response.latency, 2)) + "s\n")
+
+            all_posts.extend(records)
+
+            # stop at the last page, or once a page holds nothing new
+            if posts_found < RESULTS_PER_PAGE:
+                del offsets[location]
+            elif known_links is not None and all(record[-1] in known_links for record in records):
+                del offsets[location]
+            else:
+                offsets[location] += RESULTS_PER_PAGE
+
+        if len(offsets) == 0:
+            break
+
+    all_apartments = all_posts.to_frame()
 
     # create unique key
-    all_apartments['post_datetime'] = pd.to_datetime(all_apartments['post_datetime'])
-    #  all_apartments['temp'] = all_apartments['post_datetime'].dt.strftime("%Y_%m_%d")
-    all_apartments['temp'] = datetime.today().strftime("%Y_%m_%d")
-    all_apartments['id'] = all_apartments['post_link'].str.cat(all_apartments['temp'], sep="_")
-    all_apartments = all_apartments.drop(columns=['temp'])
+    all_apartments['id'] = all_apartments['post_link'] + datetime.today().strftime("_%Y_%m_%d")
 
     return all_apartments
 
 
-def update_data_records(all_rooms, all_apartments):
-    """save to databases"""
-    # apartment shares
+def create_post_indexes(con, table):
+    """index the post links looked up for every new batch and the dates of recent posts"""
+    for column in ['post_link', 'post_datetime']:
+        con.execute(sqlalchemy.text(
+            'CREATE INDEX IF NOT EXISTS ' + table + '_' + column + '_idx ON ' + table + ' (' + column + ')'
+        ))
 
-    # update on amazon rds database
-    database_path = os.environ['DATABASE_PATH']
 
-    engine = create_engine(database_path)
-    con = engine.connect()
+def find_stored_posts(con, table, data, chunk_size=DEDUP_CHUNK_SIZE):
+    """post links already in the table, looking up only this batch's candidates
 
-    try:
+    ids are the post link and the day it was scraped, so a stored id always has a stored link
+    """
+    sql = sqlalchemy.text(
+        "SELECT post_link FROM " + table + " WHERE post_link IN :links"
+    ).bindparams(sqlalchemy.bindparam('links', expanding=True))
 
-        print('reading rds room share database... ')
-        sql = ("""
-        SELECT id, post_link FROM rooms
-        """)
-        x = pd.read_sql(sql, con=con)
+    links = data['post_link'].drop_duplicates().tolist()
 
-        # drop any duplicate ids
-        data = all_rooms.loc[~all_rooms['id'].isin(x['id'])]
-        data = data.drop_duplicates(subset='id')
-        # drop duplicate links
-        data = data.loc[~data['post_link'].isin(x['post_link'])]
+    stored = [pd.DataFrame(columns=['post_link'])]
+    for i in range(0, len(links), chunk_size):
+        stored.append(pd.read_sql(sql, con=con, params={'links': links[i:i + chunk_size]}))
 
-        if len(data) > 0:
-            print(str(len(data)) + " new records will be added. ")
-            data.to_sql('rooms', con=con, if_exists='append', index=False)
+    return pd.concat(stored, sort=False)
 
-            print('\nCraigslist room share database successfully updated with '
-                  + str(len(data)) + " new posts.")
-        else:
-            print('no new records to add.')
 
-    #  except IntegrityError:
-    except:
-        print('error on apartment share sql append.')
-        print('apartment share databases not updated.')
+def store_new_posts(con, table, data):
+    """append the posts not already in the table, returns those appended"""
+    create_post_indexes(con, table)
+    x = find_stored_posts(con, table, data)
 
-    # todo: repeat for full apartments
+    # drop duplicate links, stored or within the batch
+    new_data = data.loc[~data['post_link'].isin(x['post_link'])]
+    new_data = new_data.drop_duplicates(subset='post_link')
 
-    try:
+    copy_frame(con, table, new_data)
+
+    # keep the dashboard's daily rollups in step, in the same transaction
+    if table == rollups.POSTS_TABLE and len(new_data) > 0:
+        rollups.add_posts(con, new_data)
 
-        print('reading rds apartment database... ')
-        sql = ("""
-        SELECT id, post_link FROM apartments
-        """)
-        x = pd.read_sql(sql, con=con)
+    return new_data
 
-        # drop any duplicate ids
-        data = all_apartments.loc[~all_apartments['id'].isin(x['id'])]
-        data = data.drop_duplicates(subset='id')
-        # drop duplicate links
-        data = data.loc[~data['post_link'].isin(x['post_link'])]
 
-        if len(data) > 0:
-            print(str(len(data)) + " new records will be added. ")
-            data.to_sql('apartments', con=con, if_exists='append', index=False)
+def oldest_post(new_data):
+    """post_datetime of the oldest of the new posts, None when there are none"""
+    if len(new_data) == 0:
+        return None
 
-            print('\nCraigslist apartment database successfully updated with '
-                  + str(len(data)) + " new posts.")
-        else:
-            print('no new records to add.')
+    return new_data['post_datetime'].min()
+
+
+def update_data_records(all_rooms, all_apartments):
+    """save to databases in a single transaction, returns {table: (inserted, skipped)}"""
+
+    counts = {}
+    oldest = None
+
+    try:
+
+        # update on amazon rds database
+        with storage.begin() as con:
+            for table, data, label in [
+                ('rooms', all_rooms, 'room share'),
+                ('apartments', all_apartments, 'apartment'),
+            ]:
+                print('checking rds ' + label + ' database for ' + str(len(data)) + ' scraped posts... ')
+                new_data = store_new_posts(con, table, data)
+                inserted, skipped = len(new_data), len(data) - len(new_data)
+                counts[table] = (inserted, skipped)
+                if table == rollups.POSTS_TABLE:
+                    oldest = oldest_post(new_data)
+
+                if inserted > 0:
+                    print('\nCraigslist ' + label + ' database successfully updated with '
+                          + str(inserted) + " new posts, " + str(skipped) + " already stored.")
+                else:
+                    print('no new records to add, ' + str(skipped) + ' already stored.')
+
+            # tell the dashboard there is something new to load, and how far back it goes
+            new_posts = sum(inserted for inserted, skipped in counts.values())
+            if new_posts > 0:
+                storage.signal_data_updated(con, new_posts, oldest)
 
     #  except IntegrityError:
-    except:
-        print('error on apartment share sql append.')
-        print('apartment share databases not updated.')
+    except Exception as e:
+        print('error on sql append: ' + str(e))
+        print('room share and apartment databases not updated.')
+        counts = {}
+
+    return counts
+
+
+def backfill_data_records(path, table):
+    """load a csv export of posts into a table, skipping posts already stored"""
+    data = pd.read_csv(path, parse_dates=['post_datetime'])
 
+    start = time.perf_counter()
+    with storage.begin() as con:
+        new_data = store_new_posts(con, table, data)
+        inserted, skipped = len(new_data), len(data) - len(new_data)
+        if inserted > 0:
+            oldest = oldest_post(new_data) if table == rollups.POSTS_TABLE else None
+            storage.signal_data_updated(con, inserted, oldest)
+    elapsed = time.perf_counter() - start
 
-def run_apartment_search():
-    """"""
+    print('backfilled ' + table + ' from ' + path + ': ' + str(inserted) + ' new posts, '
+          + str(skipped) + ' already stored, in ' + str(round(elapsed, 2)) + 's')
+
+    return inserted, skipped
+
+
+def run_apartment_search(max_pages=MAX_PAGES, record=None, replay=None):
+    """searches craigslist and saves new posts, returns {table: (inserted, skipped)}
+
+    record saves every response to a store at that path, replay scrapes from one offline
+    """
     searches = {
         "manhattan": "https://newyork.craigslist.org/search/mnh/roo?min_price=800",
         "brooklyn": "https://newyork.craigslist.org/search/brk/roo?min_price=800",
@@ -167,8 +269,6 @@ def run_apartment_search():
         "queens": "https://newyork.craigslist.org/search/que/roo?min_price=800",
         "bronx": "https://newyork.craigslist.org/search/brx/roo?min_price=800"
     }
-    print('\nsearching for room shares...')
-    all_rooms = get_apartment_data(searches)
 
     # repeat for full apartments
     apartment_searches = {
@@ -178,18 +278,61 @@ def run_apartment_search():
         "queens": "https://newyork.craigslist.org/search/que/apa?min_price=800",
         "bronx": "https://newyork.craigslist.org/search/brx/apa?min_price=800"
     }
-    print('\nsearching for apartments...')
-    all_apartments = get_apartment_data(apartment_searches)
+
+    # posts already stored, so paging can stop once it reaches them
+    print('\nreading recently stored posts...')
+    with storage.connect() as con:
+        known_rooms = load_known_links(con, 'rooms')
+        known_apartments = load_known_links(con, 'apartments')
+
+    # run both searches side by side on one engine, so the rate limit covers all requests
+    print('\nsearching for room shares and apartments...')
+    session = make_mode_session(record=record, replay=replay)
+    rate = None if replay is not None else REQUESTS_PER_SECOND
+    with FetchEngine(rate=rate, session=session) as engine, ThreadPoolExecutor(max_workers=2) as executor:
+        rooms_search = executor.submit(
+            get_apartment_data, searches, engine, known_rooms, max_pages)
+        apartments_search = executor.submit(
+            get_apartment_data, apartment_searches, engine, known_apartments, max_pages)
+
+        all_rooms = rooms_search.result()
+        all_apartments = apartments_search.result()
+
+        engine.report()
 
     # update databases
-    update_data_records(all_rooms, all_apartments)
+    counts = update_data_records(all_rooms, all_apartments)
 
     from time import strftime
     from datetime import datetime
     update = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
 
     print('\ncraigslist apartment searches complete at ' + update)
+    storage.report()
+
+    return counts
 
 
 if __name__ == '__main__':
-    run_apartment_search()
+    parser = argparse.ArgumentParser(description='search craigslist for new apartment posts')
+    parser.add_argument('--max-pages', type=int, default=MAX_PAGES,
+                        help='result pages to follow per location, raise to backfill after downtime')
+    parser.add_argument('--record', metavar='STORE',
+                        help='save every craigslist response to this directory')
+    parser.add_argument('--replay', metavar='STORE',
+                        help='serve craigslist responses from this directory instead of the network')
+    parser.add_argument('--backfill', metavar='CSV',
+                        help='load a csv export of posts into --table instead of searching')
+    parser.add_argument('--table', choices=['rooms', 'apartments'], default='rooms',
+                        help='table to backfill')
+    parser.add_argument('--rebuild-rollups', action='store_true',
+                        help="recount the dashboard's daily rollups from every stored room post")
+    args = parser.parse_args()
+
+    if args.rebuild_rollups:
+        with storage.begin() as con:
+            print('rebuilt ' + rollups.ROLLUP_TABLE + ' with ' + str(rollups.rebuild(con)) + ' cells.')
+    elif args.backfill is not None:
+        backfill_data_records(args.backfill, args.table)
+    else:
+        run_apartment_search(max_pages=args.max_pages, record=args.record, replay=args.replay)
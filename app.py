@@ -9,219 +9,155 @@ import dash_table
 import datetime as dt
 import plotly.graph_objs as go
 from datetime import datetime
-import psycopg2
-import os
 import time
 from datetime import datetime
 from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
-from apartment_search import run_apartment_search
+from aggregations import (
+    PRICE_BUCKET, cube_all_time_prices, cube_posts_per_date, cube_price_histogram,
+    cube_price_quantile_per_date, neighborhood_slice
+)
+from dataset import current_snapshot, refresh_snapshot
+import dataset
+from filters import page_of_posts, selected_cells, sorted_posts
+import filters
+from cache import make_cache, memoize, report
+import persist
+import rollups
+import storage
+
+# when this process started, for the time to the first response
+STARTED = time.perf_counter()
 
 pd.options.mode.chained_assignment = None  # default='warn'
 
 external_stylesheets = ["https://stackpath.bootstrapcdn.com/bootstrap/4.1.3/css/bootstrap-grid.min.css"]
 
 
-# number of seconds between re-calculating the data
-# update every hour
-UPDATE_INTERVAL = 3600
+# number of seconds between checks for new posts from the scraper worker
+POLL_INTERVAL = 60
 
+# posts per page of the recent posts table
+TABLE_PAGE_SIZE = 25
 
-def get_apartment_data():
-    """gets apartment data from rds database"""
-    global apartment_data
-
-    # amazon rds database connection
-    connection = psycopg2.connect(
-        host=os.environ['HOST'],
-        port='5432',
-        user='duncan',
-        password=os.environ['PASSWORD'],
-        database='postgres'
-    )
+# rent shown per date, from the cube's $50 price sketches, less than $50 from exact
+PRICE_STATISTICS = [
+    ('Median', 'median'),
+    ('25th percentile', 'p25'),
+    ('75th percentile', 'p75'),
+    ('90th percentile', 'p90'),
+]
+PRICE_QUANTILES = {'median': 0.5, 'p25': 0.25, 'p75': 0.75, 'p90': 0.9}
 
-    sql = """
-    SELECT * FROM rooms;
-    """
-    apartment_data = pd.read_sql(sql, con=connection)
+# what the charts below the table count, unique listings count a room reposted under
+# new links once, at its first post, see reposts.py
+COUNT_BY = [
+    ('All posts', 'posts'),
+    ('Unique listings', 'listings'),
+]
 
-    apartment_data['post_date'] = pd.to_datetime(apartment_data['post_datetime']).dt.date
-
-    apartment_data['post_title_text'] = apartment_data['post_title_text'].str.lower()
-
-    # determine size of the apartment
-    apartment_data['size'] = apartment_data.apply(
-        lambda x: determine_apt_size(
-            x['post_title_text']
-        ),
-        axis=1)
-
-
-def get_new_data_every(period=UPDATE_INTERVAL):
-    """Update the data every 'period' seconds"""
-    while True:
-        # run the craigslist scrape process
-        run_apartment_search()
-
-        # update data in the app
-        get_apartment_data()
-
-        time.sleep(period)
 
+# results of the callbacks below, reused until new data is published
+callback_cache = make_cache()
 
-def apply_price_range_apartment_data(apartment_data, low_, high_):
-    """returns apartment data between two price ranges"""
-    apartment_data_filtered = apartment_data.loc[
-        (apartment_data['post_price'] >= low_) & (apartment_data['post_price'] <= high_)
-    ]
-
-    return apartment_data_filtered
 
+def get_apartment_data():
+    """gets apartment data from rds database, reading only posts not already loaded
 
-def get_posts_per_date(apartment_data):
-    """find the counts of posts per date per neighborhood"""
-    all_dates = pd.DataFrame()
+    the result is published as a new snapshot, callbacks keep serving the old one until then.
+    the publisher among the workers then saves it, and maps the saved copy in its place
+    """
+    previous = current_snapshot()
+    # with QUERY_BACKEND=database the charts' cube comes from the database's daily rollups
+    snapshot = refresh_snapshot(rollups.cube_source())
 
-    # loop through by date
-    for d in apartment_data['post_date'].unique():
-        df = apartment_data.loc[apartment_data['post_date'] == d]
+    loaded = 0 if previous is None else len(previous.data)
+    print(str(len(snapshot.data) - loaded) + ' new posts loaded, ' + str(len(snapshot.data))
+          + ' in total, dataset version ' + str(snapshot.version) + '.')
+    dataset.report(snapshot)
 
-        # counts by neighborhood
-        dfx = pd.DataFrame(df['neighborhood'].value_counts()).rename(
-            columns={'neighborhood': 'posts'}
-        )
-        dfx['neighborhood'] = dfx.index
-        dfx = dfx.reset_index(drop=True)
-        dfx['post_date'] = d
-        all_dates = all_dates.append(dfx, sort=False)
-
-    return all_dates
-
-
-def get_median_price_per_date(apartment_data):
-    """finds the median price of a posting per date per apartment"""
-    all_prices = pd.DataFrame()
-    # loop through by date
-    for d in apartment_data['post_date'].unique():
-        df = apartment_data.loc[apartment_data['post_date'] == d]
-
-        # counts by neighborhood
-        dfx = pd.DataFrame(pd.pivot_table(
-            df,
-            values='post_price',
-            index='neighborhood',
-            aggfunc=np.median
-        )
-        ).rename(columns={'post_price': 'median_price'})
+    # keep a local copy for the other workers and the next start
+    if snapshot is not previous and persist.try_publisher_lock():
+        try:
+            persist.save(snapshot)
+            load_saved_data()
+        except OSError as e:
+            print('could not save the snapshot: ' + str(e))
 
-        dfx['neighborhood'] = dfx.index
-        dfx = dfx.reset_index(drop=True)
-        dfx['post_date'] = d
 
-        all_prices = all_prices.append(dfx, sort=False)
+def load_saved_data():
+    """publishes the locally saved snapshot, mapped from its files, returns False when there isn't one"""
+    saved = persist.load()
+    if saved is None:
+        return False
 
-    return all_prices
+    snapshot = dataset.publish(*saved)
+    print(str(len(snapshot.data)) + ' posts mapped from saved snapshot ' + snapshot.tag
+          + ', dataset version ' + str(snapshot.version) + '.')
 
+    return True
 
-def get_all_time_prices(apartment_data):
-    """finds the all-time median and average price of each of the neighborhoods"""
 
-    # median df
-    dfx = pd.pivot_table(
-        apartment_data,
-        index='neighborhood',
-        values='post_price',
-        aggfunc=np.median
-    )
-    dfx['neighborhood'] = dfx.index
-    dfx['post_price'] = round(dfx['post_price'], 0)
-    df_median = dfx.reset_index(drop=True)
-
-    # avg df
-    dfx = pd.pivot_table(
-        apartment_data,
-        index='neighborhood',
-        values='post_price',
-        aggfunc=np.mean
-    )
-    dfx['neighborhood'] = dfx.index
-    dfx['post_price'] = round(dfx['post_price'], 0)
-    df_mean = dfx.reset_index(drop=True)
+def watch_for_new_data(period=POLL_INTERVAL, catch_up=False):
+    """reload the data whenever there is something new, checking now and then every
+    'period' seconds
 
-    return df_median, df_mean
+    the publisher among the workers reloads from the database when the scraper worker
+    signals new posts, the others map each snapshot it saves. the first check runs
+    here rather than at start up, so a start from the saved snapshot never waits on the
+    database. catch_up reloads on the first check even when nothing was signalled
+    """
+    seen = current_snapshot().updated_through
 
+    while True:
+        try:
+            reloaded = False
+            if persist.try_publisher_lock():
+                latest = storage.latest_data_update()
+                if catch_up or latest != seen:
+                    # update data in the app
+                    get_apartment_data()
+                    seen, catch_up, reloaded = latest, False, True
 
-# estimate apartment size/bedrooms
-def determine_apt_size(post_title):
-    """"""
-    studio = ['studio']
-    one_bed = ['1br', 'one bedroom', '1 bedroom', '1 br', '1 bdr', '1bdr', '1bd', '1 bed', '1 bd']
-    two_bed = ['2br', 'two bedroom', '2 bedroom', '2 br', '2 bdr', '2bdr', '2bd', '2 bed', '2 bd']
-    three_bed = ['3br', 'three bedroom', '3 bedroom', '3 br', '3 bdr', '3bdr', '3bd', '3 bed', '3 bd']
-    four_bed = ['4br', 'four bedroom', '4 bedroom', '4 br', '4 bdr', '4bdr', '4bd', '4 bed', '4 bd']
-    five_bed = ['5br', 'five bedroom', '5 bedroom', '5 br', '5 bdr', '5bdr', '5bd', '5 bed', '5 bd']
-
-    post_title = post_title.lower()
-
-    if any(word in post_title for word in studio):
-        apt_size = 'studio'
-    elif any(word in post_title for word in five_bed):
-        apt_size = 'five bedroom'
-    elif any(word in post_title for word in four_bed):
-        apt_size = 'four bedroom'
-    elif any(word in post_title for word in three_bed):
-        apt_size = 'three bedroom'
-    elif any(word in post_title for word in two_bed):
-        apt_size = 'two bedroom'
-    elif any(word in post_title for word in one_bed):
-        apt_size = 'one bedroom'
-    else:
-        apt_size = 'other'
-
-    return apt_size
-
-
-# find the most common neighborhoods
-def get_most_common_neighborhoods(apartment_data):
-    """"""
+            elif persist.current_version() not in (None, persist.version_name(current_snapshot().tag)):
+                reloaded = load_saved_data()
 
-    most_common = pd.DataFrame(
-        apartment_data['neighborhood'].value_counts()
-    ).rename(
-        columns={
-            'neighborhood': 'count'
-        }
-    )
-    most_common['neighborhood'] = most_common.index
-    most_common = most_common.reset_index(drop=True)
+            if reloaded:
+                report(callback_cache)
+                filters.report()
 
-    # get neighborhoods with at least 30 results
-    most_common_neighborhoods = most_common.loc[most_common['count'] >= 30]
+        except Exception as e:
+            print('error checking for new data: ' + str(e))
 
-    return most_common_neighborhoods
+        time.sleep(period)
 
 
 app = dash.Dash('apartments', external_stylesheets=external_stylesheets)
 app.title = 'NYC Room Search'
 
-# get initial data
-get_apartment_data()
+# get initial data, from the saved snapshot when there is one so the app can serve
+# straight away without the database, it is brought up to date in the background below
+started_from_saved = load_saved_data()
+if not started_from_saved:
+    get_apartment_data()
+print('data ready ' + str(round(time.perf_counter() - STARTED, 2)) + 's after start.')
 
 server = app.server
+first_response = []
 
 
-most_common_apartments = get_most_common_neighborhoods(apartment_data)
-
+@server.after_request
+def report_first_response(response):
+    """print the time from start to the first response, once"""
+    if not first_response:
+        first_response.append(time.perf_counter() - STARTED)
+        print('first response ' + str(round(first_response[0], 2)) + 's after start.')
 
-# get count of all neighborhoods as a list
-hoods = pd.DataFrame(apartment_data['neighborhood'].value_counts())
-hoods['neighborhood'] = hoods.index
-sorted_hoods = hoods['neighborhood'].tolist()
-
-sizes = apartment_data['size'].unique().tolist()
+    return response
 
 
 # create the layout of the app
 def make_layout():
+    snapshot = current_snapshot()
 
     return html.Div([
 
@@ -249,7 +185,7 @@ def make_layout():
             id='hood_selection',
             options=[
                 {'label': c, 'value': c}
-                for c in sorted_hoods
+                for c in snapshot.sorted_hoods
 
             ],
             value=[
@@ -268,7 +204,7 @@ def make_layout():
             id='size_selection',
             options=[
                 {'label': c, 'value': c}
-                for c in sizes
+                for c in snapshot.sizes
 
             ],
             value=[
@@ -328,16 +264,26 @@ def make_layout():
                 columns=[
                     {'name': 'Neighborhood', 'id': 'neighborhood'},
                     {'name': 'Price', 'id': 'post_price'},
+                    # percent of similar posts from the month before asking less, see deals.py
+                    {'name': 'Price Percentile', 'id': 'deal_percentile'},
                     {'name': 'Title', 'id': 'post_title_text'},
                     {'name': 'Date', 'id': 'post_date'},
                     {'name': 'Size', 'id': 'size'},
                     {'name': 'Link', 'id': 'post_link'},
                 ],
+                # pages are cut and sorted on the server, only the page shown is sent
+                page_action='custom',
+                page_current=0,
+                page_size=TABLE_PAGE_SIZE,
+                sort_action='custom',
+                sort_mode='single',
+                sort_by=[],
                 style_table={
                         'maxHeight': '500px',
                         'overflowY': 'scroll',
         },
             ),
+            html.Div(id='recent_posts_count'),
         ]),
 
         dcc.Markdown('''
@@ -345,12 +291,30 @@ def make_layout():
         '''),
 
         html.Div([
+                dcc.RadioItems(
+                    id='count_by',
+                    options=[
+                        {'label': label, 'value': value}
+                        for label, value in COUNT_BY
+                    ],
+                    value='posts',
+                    labelStyle={'display': 'inline-block', 'margin-right': '12px'},
+                ),
                 dcc.Graph(id='all_prices_histogram'),
             ]),
         html.Div([
                 dcc.Graph(id='post_by_date_series'),
             ]),
         html.Div([
+                dcc.RadioItems(
+                    id='price_statistic',
+                    options=[
+                        {'label': label, 'value': value}
+                        for label, value in PRICE_STATISTICS
+                    ],
+                    value='median',
+                    labelStyle={'display': 'inline-block', 'margin-right': '12px'},
+                ),
                 dcc.Graph(id='price_by_date_series'),
             ]),
 
@@ -393,6 +357,14 @@ def make_layout():
 app.layout = make_layout
 
 
+def dataset_tag():
+    """the data the callbacks are serving, the same in each worker that loaded the same posts"""
+    return current_snapshot().tag
+
+
+cached = memoize(callback_cache, dataset_tag)
+
+
 @app.callback(
     dash.dependencies.Output('output-container-range-slider', 'children'),
     [dash.dependencies.Input('price_range_slider', 'value')])
@@ -407,26 +379,22 @@ def update_range_output(value):
     Output('post_by_date_series', 'figure'),
     [Input('hood_selection', 'value'),
      Input('price_range_slider', 'value'),
-     Input('size_selection', 'value')]
+     Input('size_selection', 'value'),
+     Input('count_by', 'value')]
 )
-def update_posts_by_date_series(neighborhoods, price_range, sizes):
+@cached
+def update_posts_by_date_series(neighborhoods, price_range, sizes, count_by='posts'):
     """"""
+    snapshot = current_snapshot()
 
-    # get apartment data within price range
-    apartment_data_filtered = apply_price_range_apartment_data(
-        apartment_data, price_range[0], price_range[1]
-    )
-
-    # filter to room size selections
-    apartment_data_filtered = apartment_data_filtered.loc[
-        apartment_data_filtered['size'].isin(sizes)
-    ]
+    # cube cells within the selections, shared with the other callbacks for the same inputs
+    cells = selected_cells(snapshot, neighborhoods, price_range, sizes, listings=count_by == 'listings')
 
-    all_dates = get_posts_per_date(apartment_data_filtered)
+    all_dates = cube_posts_per_date(cells)
 
     all_traces = []
     for neighborhood in neighborhoods:
-        neighborhood_df = all_dates.loc[all_dates['neighborhood'] == neighborhood]
+        neighborhood_df = neighborhood_slice(all_dates, neighborhood)
 
         neighborhood_df['post_date'] = pd.to_datetime(neighborhood_df['post_date'])
         neighborhood_df = neighborhood_df.sort_values(by='post_date')
@@ -444,7 +412,7 @@ def update_posts_by_date_series(neighborhoods, price_range, sizes):
         all_traces.append(trace)
 
     layout = go.Layout(
-        title = "Count of Posts per Date",
+        title = "Count of " + ("New Listings" if count_by == 'listings' else "Posts") + " per Date",
         xaxis = {"title": "Date",
                  "type": "date",
                  #  "range": ['2020-04-01', '2020-04-30'],
@@ -464,26 +432,23 @@ def update_posts_by_date_series(neighborhoods, price_range, sizes):
     Output('price_by_date_series', 'figure'),
     [Input('hood_selection', 'value',),
      Input('price_range_slider', 'value'),
-     Input('size_selection', 'value')]
+     Input('size_selection', 'value'),
+     Input('price_statistic', 'value'),
+     Input('count_by', 'value')]
 )
-def update_price_by_date_series(neighborhoods, price_range, sizes):
+@cached
+def update_price_by_date_series(neighborhoods, price_range, sizes, statistic='median', count_by='posts'):
     """"""
+    snapshot = current_snapshot()
 
-    # get apartment data within price range
-    apartment_data_filtered = apply_price_range_apartment_data(
-        apartment_data, price_range[0], price_range[1]
-    )
-
-    # filter to room size selections
-    apartment_data_filtered = apartment_data_filtered.loc[
-        apartment_data_filtered['size'].isin(sizes)
-    ]
+    # cube cells within the selections, shared with the other callbacks for the same inputs
+    cells = selected_cells(snapshot, neighborhoods, price_range, sizes, listings=count_by == 'listings')
 
-    all_prices = get_median_price_per_date(apartment_data_filtered)
+    all_prices = cube_price_quantile_per_date(cells, PRICE_QUANTILES[statistic])
 
     all_traces = []
     for neighborhood in neighborhoods:
-        neighborhood_df = all_prices.loc[all_prices['neighborhood'] == neighborhood]
+        neighborhood_df = neighborhood_slice(all_prices, neighborhood)
 
         neighborhood_df['post_date'] = pd.to_datetime(neighborhood_df['post_date'])
         neighborhood_df = neighborhood_df.sort_values(by='post_date')
@@ -493,21 +458,22 @@ def update_price_by_date_series(neighborhoods, price_range, sizes):
         # scatter trace per neighborhood
         trace = go.Scatter(
             x=neighborhood_df['post_date'],
-            y=neighborhood_df['median_price'],
+            y=neighborhood_df['price'],
             name=neighborhood,
             opacity = 0.8,
         )
 
         all_traces.append(trace)
 
+    label = {value: label for label, value in PRICE_STATISTICS}[statistic]
     layout = go.Layout(
-        title = "Median Monthly Rent per Date",
+        title = label + " Monthly Rent per Date",
         xaxis = {"title": "Date",
                  "type": "date",
                  #  "range": ['2020-04-01', '2020-04-30'],
                  },
         yaxis = {
-            "title": "Median Rent",
+            "title": label + " Rent",
             "range": [0, 3000]
         },
 
@@ -523,10 +489,12 @@ def update_price_by_date_series(neighborhoods, price_range, sizes):
     Output('all_time_median_chart', 'figure'),
     [Input('hood_selection', 'value')]
 )
+@cached
 def update_price_by_date_series(neighborhoods):
     """"""
+    snapshot = current_snapshot()
 
-    median_prices, df_mean = get_all_time_prices(apartment_data)
+    median_prices, df_mean = cube_all_time_prices(selected_cells(snapshot, neighborhoods))
 
     neighborhood_df = median_prices.loc[median_prices['neighborhood'].isin(neighborhoods)].sort_values(
         by='post_price', ascending=True
@@ -563,13 +531,14 @@ def update_price_by_date_series(neighborhoods):
     Output('all_time_median_chart_all_neighborhoods', 'figure'),
     [Input('size_selection', 'value')]
 )
+@cached
 def update_median_all_neighborhoods(sizes):
     """"""
+    snapshot = current_snapshot()
 
-    df = apartment_data.loc[apartment_data['size'].isin(sizes)]
-    df = df.loc[df['neighborhood'].isin(most_common_apartments['neighborhood'])]
+    cells = selected_cells(snapshot, snapshot.most_common_neighborhoods['neighborhood'].tolist(), sizes=sizes)
 
-    df_median, df_mean = get_all_time_prices(df)
+    df_median, df_mean = cube_all_time_prices(cells)
 
     neighborhood_df = df_median.sort_values(
         by='post_price', ascending=True
@@ -606,13 +575,14 @@ def update_median_all_neighborhoods(sizes):
     Output('all_time_mean_chart_all_neighborhoods', 'figure'),
     [Input('size_selection', 'value')]
 )
+@cached
 def update_mean_all_neighborhoods(sizes):
     """"""
+    snapshot = current_snapshot()
 
-    df = apartment_data.loc[apartment_data['size'].isin(sizes)]
-    df = df.loc[df['neighborhood'].isin(most_common_apartments['neighborhood'])]
+    cells = selected_cells(snapshot, snapshot.most_common_neighborhoods['neighborhood'].tolist(), sizes=sizes)
 
-    df_median, df_mean = get_all_time_prices(df)
+    df_median, df_mean = cube_all_time_prices(cells)
 
     neighborhood_df = df_mean.sort_values(
         by='post_price', ascending=True
@@ -648,10 +618,12 @@ def update_mean_all_neighborhoods(sizes):
     Output('all_time_average_chart', 'figure'),
     [Input('hood_selection', 'value')]
 )
+@cached
 def update_price_by_date_series(neighborhoods):
     """"""
+    snapshot = current_snapshot()
 
-    df_median, mean_prices = get_all_time_prices(apartment_data)
+    df_median, mean_prices = cube_all_time_prices(selected_cells(snapshot, neighborhoods))
 
     neighborhood_df = mean_prices.loc[mean_prices['neighborhood'].isin(neighborhoods)].sort_values(
         by='post_price', ascending=True
@@ -689,27 +661,29 @@ def update_price_by_date_series(neighborhoods):
     Output('all_prices_histogram', 'figure'),
     [Input('hood_selection', 'value'),
      Input('price_range_slider', 'value'),
-     Input('size_selection', 'value')]
+     Input('size_selection', 'value'),
+     Input('count_by', 'value')]
 )
-def update_all_prices_histogram(neighborhoods, price_range, sizes):
+@cached
+def update_all_prices_histogram(neighborhoods, price_range, sizes, count_by='posts'):
     """"""
-    # get apartment data within price range
-    apartment_data_filtered = apply_price_range_apartment_data(
-        apartment_data, price_range[0], price_range[1]
-    )
+    snapshot = current_snapshot()
+
+    # cube cells within the selections, shared with the other callbacks for the same inputs
+    cells = selected_cells(snapshot, neighborhoods, price_range, sizes, listings=count_by == 'listings')
 
-    # filter to room size selections
-    apartment_data_filtered = apartment_data_filtered.loc[
-        apartment_data_filtered['size'].isin(sizes)
-    ]
+    # binned here rather than in the browser, one bar per price bucket within the range
+    bins = cube_price_histogram(cells, price_range)
+    # a range of one price is a single bar at that price
+    offset = PRICE_BUCKET / 2 if price_range[0] < price_range[1] else 0
 
     all_traces = []
     for neighborhood in neighborhoods:
-        neighborhood_df = apartment_data_filtered.loc[
-            apartment_data_filtered['neighborhood'] == neighborhood]
+        neighborhood_df = neighborhood_slice(bins, neighborhood)
 
-        trace = go.Histogram(
-            x=neighborhood_df['post_price'],
+        trace = go.Bar(
+            x=neighborhood_df['price_bucket'] + offset,
+            y=neighborhood_df['posts'],
             name=neighborhood,
         )
         all_traces.append(trace)
@@ -726,39 +700,50 @@ def update_all_prices_histogram(neighborhoods, price_range, sizes):
     return figure
 
 
+# columns sent for each post in the table
+TABLE_COLUMNS = ['neighborhood', 'post_price', 'deal_percentile', 'post_title_text', 'post_date', 'size', 'post_link']
+
+
 @app.callback(
-    Output('recent_posts_table', 'data'),
+    Output('recent_posts_table', 'page_current'),
     [Input('hood_selection', 'value'),
      Input('price_range_slider', 'value'),
      Input('size_selection', 'value')]
 )
-def update_recent_posts_table(neighborhoods, price_range, sizes):
-    """returns a table of the most recent apartment posts"""
-    # get apartment data within price range
-    apartment_data_filtered = apply_price_range_apartment_data(
-        apartment_data, price_range[0], price_range[1]
-    )
+def reset_recent_posts_page(neighborhoods, price_range, sizes):
+    """back to the first page whenever the selections change"""
+    return 0
+
 
-    apartment_data_filtered = apartment_data_filtered.loc[
-        apartment_data_filtered['neighborhood'].isin(neighborhoods)
-    ]
+@app.callback(
+    [Output('recent_posts_table', 'data'),
+     Output('recent_posts_count', 'children')],
+    [Input('hood_selection', 'value'),
+     Input('price_range_slider', 'value'),
+     Input('size_selection', 'value'),
+     Input('recent_posts_table', 'page_current'),
+     Input('recent_posts_table', 'page_size'),
+     Input('recent_posts_table', 'sort_by')]
+)
+@cached
+def update_recent_posts_table(neighborhoods, price_range, sizes, page_current, page_size, sort_by):
+    """returns one page of the most recent apartment posts, or of the posts sorted by another column"""
+    snapshot = current_snapshot()
 
-    # filter to room size selections
-    apartment_data_filtered = apartment_data_filtered.loc[
-        apartment_data_filtered['size'].isin(sizes)
-    ]
+    # every selected post in table order, shared with the requests for other pages
+    positions = sorted_posts(snapshot, neighborhoods, price_range, sizes, sort_by)
 
-    # sort by most recent posts
-    apartment_data_filtered = apartment_data_filtered.sort_values(by=['post_datetime'], ascending=False)
+    data = page_of_posts(snapshot, positions, page_current, page_size, TABLE_COLUMNS).to_dict(orient='records')
 
-    data = apartment_data_filtered.to_dict(orient='records')
+    pages = max(1, -(-len(positions) // page_size))
+    count = str(len(positions)) + ' posts, page ' + str(page_current + 1) + ' of ' + str(pages)
 
-    return data
+    return data, count
 
 
-# Run the function in another thread
+# watch for new data in another thread, the scraping itself runs in worker.py
 executor = ThreadPoolExecutor(max_workers=1)
-executor.submit(get_new_data_every)
+executor.submit(watch_for_new_data, POLL_INTERVAL, started_from_saved)
 
 
 if __name__ == '__main__':
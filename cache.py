@@ -0,0 +1,206 @@
+"""memoized dashboard callback results
+
+results are keyed by the callback, its inputs with selections put in a fixed order,
+and the version of the dataset they were computed from. a newly published dataset
+makes every older result unreachable, and they are dropped the first time it is seen.
+
+each process keeps its own cache in memory unless CALLBACK_CACHE_DIR is set, then
+results are pickled to files in that directory so gunicorn workers on one host
+share their hits.
+"""
+import functools
+import hashlib
+import os
+import pickle
+import threading
+from collections import OrderedDict
+
+
+# most results kept at once, about a dozen per distinct set of selections
+MAX_ENTRIES = 256
+
+
+def normalize(value):
+    """hashable form of a callback input, selections in sorted order"""
+    if isinstance(value, dict):
+        return tuple(sorted((key, normalize(item)) for key, item in value.items()))
+
+    if isinstance(value, (list, tuple)):
+        items = [normalize(item) for item in value]
+        try:
+            return tuple(sorted(items))
+        except TypeError:
+            return tuple(items)
+
+    return value
+
+
+class ResultCache(object):
+    """bounded in-memory cache, least recently used results are evicted first"""
+
+    def __init__(self, max_entries=MAX_ENTRIES):
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self.version = None
+
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _check_version(self, version):
+        if version != self.version:
+            self.clear()
+            self.version = version
+
+    def get(self, key, version):
+        """(True, result) when cached for this version, else (False, None)"""
+        with self._lock:
+            self._check_version(version)
+
+            if key not in self._entries:
+                self.misses += 1
+                return False, None
+
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return True, self._entries[key]
+
+    def put(self, key, version, result):
+        with self._lock:
+            self._check_version(version)
+
+            self._entries[key] = result
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        self._entries.clear()
+
+    def stats(self):
+        """{'hits', 'misses', 'entries'} since the process started"""
+        return {'hits': self.hits, 'misses': self.misses, 'entries': len(self)}
+
+
+class DiskResultCache(ResultCache):
+    """cache of pickled results in a directory, shared by every process using it
+
+    a hit touches its file, and the files least recently touched are removed once
+    there are more than max_entries. results of older versions are removed as soon as
+    any process sees a newer one
+    """
+
+    def __init__(self, path, max_entries=MAX_ENTRIES):
+        super(DiskResultCache, self).__init__(max_entries)
+        self.path = path
+        os.makedirs(path, exist_ok=True)
+
+    def __len__(self):
+        return len(self._files())
+
+    def _files(self):
+        return [name for name in os.listdir(self.path) if name.endswith('.pickle')]
+
+    def _file(self, key, version):
+        digest = hashlib.sha1(repr(key).encode('utf-8')).hexdigest()
+        return os.path.join(self.path, str(version) + '-' + digest + '.pickle')
+
+    def _check_version(self, version):
+        if version == self.version:
+            return
+
+        self.version = version
+        for name in self._files():
+            if name.split('-', 1)[0] != str(version):
+                self._remove(name)
+
+    def _remove(self, name):
+        # another worker may have removed it already
+        try:
+            os.remove(os.path.join(self.path, name))
+        except OSError:
+            pass
+
+    def get(self, key, version):
+        with self._lock:
+            self._check_version(version)
+            path = self._file(key, version)
+
+            try:
+                with open(path, 'rb') as f:
+                    result = pickle.load(f)
+            except (OSError, EOFError, pickle.UnpicklingError):
+                self.misses += 1
+                return False, None
+
+            os.utime(path, None)
+            self.hits += 1
+            return True, result
+
+    def put(self, key, version, result):
+        with self._lock:
+            self._check_version(version)
+            path = self._file(key, version)
+
+            # written aside then renamed, so other workers never read half a file
+            partial = path + '.' + str(os.getpid()) + '.partial'
+            with open(partial, 'wb') as f:
+                pickle.dump(result, f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(partial, path)
+
+            names = self._files()
+            if len(names) > self.max_entries:
+                touched = sorted(names, key=lambda name: self._touched(name))
+                for name in touched[:len(names) - self.max_entries]:
+                    self._remove(name)
+
+    def _touched(self, name):
+        try:
+            return os.path.getmtime(os.path.join(self.path, name))
+        except OSError:
+            return 0.0
+
+    def clear(self):
+        for name in self._files():
+            self._remove(name)
+
+
+def make_cache():
+    """on disk when CALLBACK_CACHE_DIR is set, otherwise in memory"""
+    if 'CALLBACK_CACHE_DIR' in os.environ:
+        return DiskResultCache(os.environ['CALLBACK_CACHE_DIR'])
+
+    return ResultCache()
+
+
+def memoize(cache, get_version):
+    """decorator caching a callback's results in cache, keyed by its inputs and get_version()"""
+    def decorator(callback):
+        @functools.wraps(callback)
+        def wrapper(*args):
+            # the line number tells apart callbacks that share a name
+            key = (callback.__name__, callback.__code__.co_firstlineno) + tuple(normalize(arg) for arg in args)
+            version = get_version()
+
+            found, result = cache.get(key, version)
+            if not found:
+                result = callback(*args)
+                cache.put(key, version, result)
+
+            return result
+
+        return wrapper
+
+    return decorator
+
+
+def report(cache):
+    """print the cache's hit rate"""
+    stats = cache.stats()
+    lookups = stats['hits'] + stats['misses']
+    rate = 0 if lookups == 0 else round(100.0 * stats['hits'] / lookups)
+    print('callback cache: ' + str(stats['hits']) + ' hits, ' + str(stats['misses']) + ' misses ('
+          + str(rate) + '%), ' + str(stats['entries']) + ' results kept.')
@@ -0,0 +1,1581 @@
+"""tests and benchmarks for the scraper and dashboard data
+
+run with: python -m pytest data_tests.py
+"""
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pandas as pd
+import pytest
+import sqlalchemy
+from bs4 import BeautifulSoup
+from sqlalchemy import create_engine
+
+from apartment_search import (
+    PostColumns, backfill_data_records, get_apartment_data, page_url, parse_results_page, store_new_posts,
+    update_data_records, RESULTS_PER_PAGE
+)
+from fetch import FetchEngine, TokenBucket
+import aggregations
+import dataset
+import deals
+import filters
+import persist
+import reposts
+import rollups
+from dataset import classify_apt_sizes, derive_columns, determine_apt_size, load_apartment_data
+from parsers import available_parsers, get_parser
+import storage
+import worker
+from cache import DiskResultCache, ResultCache, memoize
+from replay import DEFAULT_STORE, MissingRecording, RecordingSession, ReplaySession, ResponseStore
+
+
+SEARCHES = {
+    "manhattan": "https://newyork.craigslist.org/search/mnh/roo?min_price=800",
+    "brooklyn": "https://newyork.craigslist.org/search/brk/roo?min_price=800",
+    "new_jersey": "https://newyork.craigslist.org/search/jsy/roo?min_price=800",
+    "queens": "https://newyork.craigslist.org/search/que/roo?min_price=800",
+    "bronx": "https://newyork.craigslist.org/search/brx/roo?min_price=800"
+}
+
+
+# synthetic craigslist search results
+
+def synthetic_post(i, region='mnh'):
+    """html for a single craigslist result row"""
+    link = 'https://newyork.craigslist.org/' + region + '/roo/d/room-' + str(i) + '/' + str(7000000000 + i) + '.html'
+    price = 800 + (i * 37) % 3200
+
+    return (
+        '<li class="result-row" data-pid="' + str(7000000000 + i) + '">'
+        '<a href="' + link + '" class="result-image gallery"><span class="result-price">$' + str(price) + '</span></a>'
+        '<div class="result-info">'
+        '<span class="icon icon-star" role="button"></span>'
+        '<time class="result-date" datetime="2020-05-' + str(1 + i % 28).zfill(2) + ' '
+        + str(i % 24).zfill(2) + ':' + str(i % 60).zfill(2) + '" title="">May 9</time>'
+        '<h2 class="result-heading">'
+        '<a href="' + link + '" class="result-title hdrlnk">Furnished room ' + str(i) + ' in sunny ' + str(1 + i % 5) + 'br</a>'
+        '</h2>'
+        '<span class="result-meta">'
+        '<span class="result-price">$' + str(price) + '</span>'
+        '<span class="result-hood"> (Neighborhood ' + str(i % 40) + ')</span>'
+        '</span>'
+        '</div>'
+        '</li>'
+    )
+
+
+def synthetic_page(start, count, region='mnh'):
+    """html for a results page holding posts start to start + count"""
+    rows = ''.join(synthetic_post(i, region) for i in range(start, start + count))
+
+    return '<html><body><div class="content"><ul class="rows">' + rows + '</ul></div></body></html>'
+
+
+def synthetic_pages(n_posts):
+    """full results pages covering n_posts"""
+    return [
+        synthetic_page(start, min(RESULTS_PER_PAGE, n_posts - start))
+        for start in range(0, n_posts, RESULTS_PER_PAGE)
+    ]
+
+
+def synthetic_store(path, n_posts):
+    """response store holding n_posts spread over the result pages of every search"""
+    store = ResponseStore(str(path))
+    per_search = n_posts // len(SEARCHES)
+    for n, (location, link) in enumerate(SEARCHES.items()):
+        region = link.split('/')[4]
+        first = n * per_search
+        for offset in range(0, per_search, RESULTS_PER_PAGE):
+            html = synthetic_page(first + offset, min(RESULTS_PER_PAGE, per_search - offset), region)
+            store.save(page_url(link, offset), 200, html)
+
+    return store
+
+
+def awkward_page():
+    """results page with the rows the scraper has to skip or clean up"""
+    no_hood = synthetic_post(1).replace('<span class="result-hood"> (Neighborhood 1)</span>', '')
+    no_price = synthetic_post(2).replace('$874</span></a>', '</span></a>')
+    comma_price = synthetic_post(3).replace('$911</span></a>', '$1,911</span></a>')
+    entities = synthetic_post(4).replace('Furnished room 4', 'Room &amp; board &#8211; 4')
+
+    return '<html><body><ul class="rows">' + synthetic_post(0) + no_hood + no_price \
+        + comma_price + entities + '</ul></body></html>'
+
+
+# html parsers
+
+@pytest.mark.parametrize('name', available_parsers())
+def test_parsers_match_soup(name):
+    expected = get_parser('soup').parse(awkward_page(), 'manhattan')
+    posts_found, records = get_parser(name).parse(awkward_page(), 'manhattan')
+
+    assert posts_found == 5
+    assert [record[-1][-15:] for record in records] == ['7000000000.html', '7000000004.html']
+    assert (posts_found, records) == expected
+
+    pages = synthetic_pages(500)
+    assert [get_parser(name).parse(html, 'manhattan') for html in pages] == \
+        [get_parser('soup').parse(html, 'manhattan') for html in pages]
+
+
+@pytest.mark.benchmark(group='parse 1200 posts')
+@pytest.mark.parametrize('name', available_parsers())
+def test_benchmark_parsers(benchmark, name):
+    parser = get_parser(name)
+    pages = synthetic_pages(1200)
+
+    def parse_pages():
+        return [parser.parse(html, 'manhattan') for html in pages]
+
+    results = benchmark.pedantic(parse_pages, rounds=3)
+    assert sum(posts_found for posts_found, records in results) == 1200
+
+
+# scraper
+
+def build_posts_by_append(pages, location='manhattan'):
+    """the scraper's old approach, one dataframe per post appended onto the total"""
+    all_apartments = pd.DataFrame()
+    for html in pages:
+        posts = BeautifulSoup(html, 'html.parser').find_all('li', class_='result-row')
+        for post in posts:
+            if post.find('span', class_='result-hood') is not None:
+                post_title = post.find('a', class_='result-title hdrlnk')
+                try:
+                    post_price = int(post.a.text.strip().replace("$", ""))
+                except ValueError:
+                    continue
+                data = pd.DataFrame(data={
+                    "region": [location],
+                    "post_datetime": [post.find('time', class_='result-date')['datetime']],
+                    "neighborhood": [post.find('span', class_='result-hood').text],
+                    "post_title_text": [post_title.text],
+                    "post_price": [post_price],
+                    "post_link": [post_title['href']],
+                })
+                all_apartments = pd.concat([all_apartments, data], sort=False)
+
+    return all_apartments
+
+
+def build_posts(pages, location='manhattan'):
+    """parse pages into the columnar accumulator and build the frame"""
+    all_posts = PostColumns()
+    for html in pages:
+        posts_found, records = parse_results_page(html, location)
+        all_posts.extend(records)
+
+    return all_posts.to_frame()
+
+
+def test_parse_results_page():
+    posts_found, records = parse_results_page(synthetic_page(0, 3), 'manhattan')
+
+    assert posts_found == 3
+    assert records[1] == (
+        'manhattan',
+        '2020-05-02 01:01',
+        ' (Neighborhood 1)',
+        'Furnished room 1 in sunny 2br',
+        837,
+        'https://newyork.craigslist.org/mnh/roo/d/room-1/7000000001.html',
+    )
+
+
+def test_post_columns_frame():
+    data = build_posts(synthetic_pages(250))
+
+    assert len(data) == 250
+    assert list(data.columns) == ['region', 'post_datetime', 'neighborhood', 'post_title_text', 'post_price', 'post_link']
+    assert str(data['region'].dtype) == 'category'
+    assert str(data['neighborhood'].dtype) == 'category'
+    assert data['neighborhood'].iloc[41] == 'Neighborhood 1'
+    assert data['post_price'].dtype == 'int64'
+
+
+def test_post_columns_matches_append():
+    pages = synthetic_pages(300)
+    expected = build_posts_by_append(pages).reset_index(drop=True)
+    expected['neighborhood'] = expected['neighborhood'].str.translate(
+        str.maketrans({'(': '', ')': ''})).str.lstrip()
+    expected['post_datetime'] = pd.to_datetime(expected['post_datetime'])
+
+    data = build_posts(pages)
+    data['region'] = data['region'].astype(object)
+    data['neighborhood'] = data['neighborhood'].astype(object)
+
+    pd.testing.assert_frame_equal(data, expected)
+
+
+@pytest.mark.slow
+@pytest.mark.benchmark(group='build posts 10k')
+def test_benchmark_build_posts_by_append(benchmark):
+    pages = synthetic_pages(10000)
+    data = benchmark.pedantic(build_posts_by_append, args=(pages,), rounds=1)
+    assert len(data) == 10000
+
+
+@pytest.mark.benchmark(group='build posts 10k')
+def test_benchmark_build_posts(benchmark):
+    pages = synthetic_pages(10000)
+    data = benchmark.pedantic(build_posts, args=(pages,), rounds=1)
+    assert len(data) == 10000
+
+
+# database
+
+def stored_posts():
+    """the bundled room posts, as they come back from the database"""
+    data = pd.read_csv('apartment_data.csv')
+    data['post_datetime'] = pd.to_datetime(data['post_datetime'])
+
+    return data
+
+
+def test_store_new_posts(tmp_path):
+    engine = create_engine('sqlite:///' + str(tmp_path / 'posts.db'))
+    data = stored_posts()
+    data.iloc[:1000].to_sql('rooms', con=engine, index=False)
+
+    # 900 stored posts, 100 reposted links under a new id, 500 new, one new post twice
+    batch = pd.concat([data.iloc[100:1000], data.iloc[1500:2000], data.iloc[1999:2000]])
+    batch.iloc[:100, batch.columns.get_loc('id')] = batch['id'].iloc[:100] + '_repost'
+
+    with engine.begin() as con:
+        new_data = store_new_posts(con, 'rooms', batch)
+
+    assert len(new_data) == 500
+    assert new_data['id'].tolist() == data['id'].iloc[1500:2000].tolist()
+    assert pd.read_sql('SELECT COUNT(*) AS n FROM rooms', engine)['n'][0] == 1500
+
+    # the links checked for each batch and the dates of recent posts are indexed
+    indexed = [index['column_names'] for index in sqlalchemy.inspect(engine).get_indexes('rooms')]
+    assert ['post_link'] in indexed and ['post_datetime'] in indexed
+
+
+class FakeCursor(object):
+    """records what a psycopg2 cursor is asked to copy"""
+    def __init__(self):
+        self.copies = []
+        self.closed = False
+
+    def copy_expert(self, sql, file):
+        self.copies.append((sql, file.read()))
+
+    def close(self):
+        self.closed = True
+
+
+class FakeDialect(object):
+    name = 'postgresql'
+    driver = 'psycopg2'
+
+
+class FakePostgresConnection(object):
+    """stands in for a sqlalchemy connection to postgres, and for the psycopg2 one beneath it"""
+    def __init__(self):
+        self.dialect = FakeDialect()
+        self.connection = self
+        self.opened = FakeCursor()
+
+    def cursor(self):
+        return self.opened
+
+
+def test_copy_frame_streams_csv_to_postgres():
+    con = FakePostgresConnection()
+    data = pd.DataFrame({
+        'post_datetime': pd.to_datetime(['2020-05-09 08:36:00', None]),
+        'neighborhood': ['Harlem / Morningside', None],
+        'post_title_text': ['room, "sunny"', 'room'],
+        'post_price': [1300, 950],
+    }, columns=['post_datetime', 'neighborhood', 'post_title_text', 'post_price'])
+
+    assert storage.copy_frame(con, 'rooms', data) == 2
+
+    (sql, payload), = con.opened.copies
+    assert sql == ('COPY rooms ("post_datetime", "neighborhood", "post_title_text", "post_price") '
+                   'FROM STDIN WITH (FORMAT csv)')
+    # nulls are unquoted empty fields, which COPY reads as NULL
+    assert payload.splitlines() == [
+        '2020-05-09 08:36:00,Harlem / Morningside,"room, ""sunny""",1300',
+        ',,room,950',
+    ]
+    assert con.opened.closed
+
+
+def test_database_url_escapes_the_password(monkeypatch):
+    monkeypatch.delenv('DATABASE_PATH', raising=False)
+    monkeypatch.setenv('PASSWORD', 'p@ss/w#rd:')
+    monkeypatch.setenv('HOST', 'db.example.com')
+
+    url = sqlalchemy.engine.url.make_url(storage.database_url())
+    assert (url.host, url.port, url.username, url.password) == ('db.example.com', 5432, 'duncan', 'p@ss/w#rd:')
+
+
+def test_storage_shares_one_engine(tmp_path, monkeypatch):
+    monkeypatch.setenv('DATABASE_PATH', 'sqlite:///' + str(tmp_path / 'posts.db'))
+    engine = storage.get_engine()
+    stored_posts().iloc[:50].to_sql('rooms', con=engine, index=False)
+
+    queries = storage.metrics().get('queries', (0, 0.0))[0]
+    assert len(storage.read_sql('SELECT * FROM rooms')) == 50
+    with storage.begin() as con:
+        con.execute(sqlalchemy.text('DELETE FROM rooms'))
+
+    assert storage.get_engine() is engine
+    assert storage.metrics()['queries'][0] >= queries + 2
+    assert len(storage.read_sql('SELECT * FROM rooms')) == 0
+
+    monkeypatch.setenv('DATABASE_PATH', 'sqlite:///' + str(tmp_path / 'other.db'))
+    assert storage.get_engine() is not engine
+    storage.dispose()
+
+
+def test_update_data_records_is_one_transaction(tmp_path, monkeypatch):
+    engine = create_engine('sqlite:///' + str(tmp_path / 'posts.db'))
+    data = stored_posts()
+    data.iloc[:10].to_sql('rooms', con=engine, index=False)
+    monkeypatch.setenv('DATABASE_PATH', str(engine.url))
+
+    # no apartments table, so the rooms written first must be rolled back
+    assert update_data_records(data.iloc[:100], data.iloc[:100]) == {}
+    assert pd.read_sql('SELECT COUNT(*) AS n FROM rooms', engine)['n'][0] == 10
+    assert storage.latest_data_update() is None
+
+    data.iloc[:0].to_sql('apartments', con=engine, index=False)
+    assert update_data_records(data.iloc[:100], data.iloc[:100]) == {'rooms': (90, 10), 'apartments': (100, 0)}
+
+    # the dashboard is told about new posts, and only new posts
+    signalled = storage.latest_data_update()
+    assert signalled is not None
+    update_data_records(data.iloc[:100], data.iloc[:100])
+    assert storage.latest_data_update() == signalled
+    storage.dispose()
+
+
+def test_data_updates_record_the_oldest_room_post(tmp_path, monkeypatch):
+    monkeypatch.setenv('DATABASE_PATH', 'sqlite:///' + str(tmp_path / 'posts.db'))
+    data = stored_posts()
+    data.iloc[:0].to_sql('rooms', con=storage.get_engine(), index=False)
+    data.iloc[:0].to_sql('apartments', con=storage.get_engine(), index=False)
+
+    # a batch of apartments alone has no oldest room post
+    assert update_data_records(data.iloc[:0], data.iloc[:50]) == {'rooms': (0, 0), 'apartments': (50, 0)}
+    assert storage.data_updates_since()[1] is None
+
+    assert update_data_records(data.iloc[100:200], data.iloc[50:80]) == {'rooms': (100, 0), 'apartments': (30, 0)}
+    latest, oldest = storage.data_updates_since()
+    assert oldest == data['post_datetime'].iloc[100:200].min()
+    assert storage.data_updates_since(latest) == (latest, None)
+    storage.dispose()
+
+
+def test_backfill_data_records(tmp_path, monkeypatch):
+    engine = create_engine('sqlite:///' + str(tmp_path / 'posts.db'))
+    stored_posts().iloc[:0].to_sql('rooms', con=engine, index=False)
+    monkeypatch.setenv('DATABASE_PATH', str(engine.url))
+
+    inserted, skipped = backfill_data_records('apartment_data.csv', 'rooms')
+    assert inserted + skipped == len(stored_posts())
+    assert backfill_data_records('apartment_data.csv', 'rooms') == (0, inserted + skipped)
+
+
+def sorted_cells(cube):
+    """a cube's cells in key order, which groupby leaves alone for categoricals"""
+    return cube.sort_values(aggregations.CUBE_KEYS).reset_index(drop=True)
+
+
+def test_rollups_are_counted_in_as_posts_are_stored(tmp_path, monkeypatch):
+    monkeypatch.setenv('DATABASE_PATH', 'sqlite:///' + str(tmp_path / 'posts.db'))
+    data = stored_posts().sort_values('post_datetime')
+    data.iloc[:0].to_sql('rooms', con=storage.get_engine(), index=False)
+
+    # the first batch builds the rollups, later ones add to their cells
+    for batch in [data.iloc[:3000], data.iloc[2500:4000], data.iloc[4000:]]:
+        with storage.begin() as con:
+            store_new_posts(con, 'rooms', batch)
+
+    expected = aggregations.build_cube(dataset.compact(derive_columns(stored_posts()))[0])
+    pd.testing.assert_frame_equal(sorted_cells(rollups.load_cube()), sorted_cells(expected))
+
+    with storage.begin() as con:
+        assert rollups.rebuild(con) == len(expected)
+    pd.testing.assert_frame_equal(sorted_cells(rollups.load_cube()), sorted_cells(expected))
+    storage.dispose()
+
+
+def test_rollups_of_scraped_posts_hold_only_cells_posted_to(tmp_path, monkeypatch):
+    monkeypatch.setenv('DATABASE_PATH', 'sqlite:///' + str(tmp_path / 'posts.db'))
+    stored_posts().iloc[:0].to_sql('rooms', con=storage.get_engine(), index=False)
+
+    # two scrapes, their frames built by PostColumns with a categorical neighborhood
+    for start in [0, 200]:
+        with FetchEngine(rate=None, session=FakeSession(synthetic_page(start, 320))) as engine:
+            scraped = get_apartment_data({'manhattan': SEARCHES['manhattan']}, engine)
+        assert scraped['neighborhood'].dtype == 'category'
+        with storage.begin() as con:
+            store_new_posts(con, 'rooms', scraped)
+
+    cells = pd.read_sql('SELECT * FROM ' + rollups.ROLLUP_TABLE, storage.get_engine())
+    assert (cells['posts'] > 0).all()
+
+    expected = aggregations.build_cube(dataset.compact(derive_columns(storage.read_sql('SELECT * FROM rooms')))[0])
+    assert cells['posts'].sum() == len(storage.read_sql('SELECT * FROM rooms')) == 520
+    pd.testing.assert_frame_equal(sorted_cells(rollups.load_cube()), sorted_cells(expected))
+    storage.dispose()
+
+
+def test_refresh_with_cube_from_rollups(tmp_path, monkeypatch):
+    monkeypatch.setenv('DATABASE_PATH', 'sqlite:///' + str(tmp_path / 'posts.db'))
+    monkeypatch.setattr(dataset, '_snapshot', None)
+    data = stored_posts().sort_values('post_datetime')
+    data.iloc[:0].to_sql('rooms', con=storage.get_engine(), index=False)
+    with storage.begin() as con:
+        store_new_posts(con, 'rooms', data.iloc[:-500])
+
+    # only the recent posts are loaded, the charts still count every post
+    first = dataset.refresh_snapshot(rollups.load_cube)
+    newest = data['post_datetime'].iloc[-501]
+    assert len(first.data) == (data.iloc[:-500]['post_datetime'] >= newest - dataset.RECENT_POST_DAYS).sum()
+    assert first.cube['posts'].sum() == len(data) - 500
+    assert dataset.refresh_snapshot(rollups.load_cube) is first
+
+    with storage.begin() as con:
+        store_new_posts(con, 'rooms', data.iloc[-500:])
+
+    # only the dates of the new posts are read again
+    read = []
+    def load_cube(since=None):
+        cube = rollups.load_cube(since)
+        read.append((since, len(cube)))
+        return cube
+    second = dataset.refresh_snapshot(load_cube)
+    assert len(second.data) == len(first.data) + 500
+    assert read[0][0] == data['post_datetime'].iloc[-500:].min()
+    assert read[0][1] < len(first.cube) / 2
+
+    in_memory = dataset.build_snapshot(*dataset.compact(derive_columns(stored_posts())), version=1)
+    pd.testing.assert_frame_equal(sorted_cells(second.cube), sorted_cells(in_memory.cube))
+    assert second.sorted_hoods[:10] == in_memory.sorted_hoods[:10]
+    assert sorted(second.most_common_neighborhoods['neighborhood']) == \
+        sorted(in_memory.most_common_neighborhoods['neighborhood'])
+    storage.dispose()
+
+
+# scraper worker
+
+def test_schedule_does_not_drift():
+    # a run that finishes late doesn't push the later ones back
+    assert worker.next_run(100, 60, 100.5) == 160
+    assert worker.next_run(100, 60, 175) == 220
+
+    # runs missed while one overran are skipped
+    assert worker.next_run(100, 60, 290) == 340
+
+
+def test_run_every_keeps_to_schedule():
+    now = [0.0]
+    started = []
+
+    def job():
+        started.append(now[0])
+        now[0] += 7.5
+
+    def sleep(seconds):
+        now[0] += seconds
+
+    worker.run_every(60, job, runs=4, clock=lambda: now[0], sleep=sleep)
+    assert started == [0.0, 60.0, 120.0, 180.0]
+
+
+def test_single_instance(monkeypatch, tmp_path):
+    monkeypatch.setenv('DATABASE_PATH', 'sqlite:///' + str(tmp_path / 'posts.db'))
+    monkeypatch.setattr(worker.tempfile, 'gettempdir', lambda: str(tmp_path))
+
+    with worker.single_instance('test'):
+        with pytest.raises(worker.AlreadyRunning):
+            with worker.single_instance('test'):
+                pass
+
+    with worker.single_instance('test'):
+        pass
+    storage.dispose()
+
+
+class FakeResult(object):
+    def __init__(self, value):
+        self.value = value
+
+    def scalar(self):
+        return self.value
+
+
+class FakeLockSession(object):
+    """a postgres session as far as advisory locks go, until the server drops it"""
+    def __init__(self, server):
+        self.server = server
+        self.dropped = False
+
+    def execute(self, sql, params):
+        if self.dropped:
+            raise sqlalchemy.exc.OperationalError(str(sql), params, Exception('server closed the connection'))
+        sql = str(sql)
+        if 'pg_locks' in sql:
+            return FakeResult(int(self.server.holder is self))
+        if 'pg_try_advisory_lock' in sql:
+            if self.server.holder is None:
+                self.server.holder = self
+            return FakeResult(self.server.holder is self)
+        if 'pg_advisory_unlock' in sql and self.server.holder is self:
+            self.server.holder = None
+        return FakeResult(None)
+
+    def close(self):
+        pass
+
+
+class FakeLockServer(object):
+    """stands in for the engine, handing out sessions of one postgres server"""
+    dialect = FakeDialect()
+
+    def __init__(self):
+        self.holder = None
+        self.sessions = []
+
+    def connect(self):
+        self.sessions.append(FakeLockSession(self))
+        return self.sessions[-1]
+
+    def drop(self, session):
+        session.dropped = True
+        if self.holder is session:
+            self.holder = None
+
+
+def test_advisory_lock_is_checked_before_each_run(monkeypatch):
+    server = FakeLockServer()
+    monkeypatch.setattr(storage, 'get_engine', lambda: server)
+
+    with worker.single_instance('test') as check_lock:
+        with pytest.raises(worker.AlreadyRunning):
+            with worker.single_instance('test'):
+                pass
+
+        check_lock()
+        assert len(server.sessions) == 2
+
+        # the idle connection is dropped, and with it the lock, which is free to take again
+        server.drop(server.sessions[0])
+        check_lock()
+        assert server.holder is server.sessions[-1]
+
+        # dropped again, and another worker takes it first
+        server.drop(server.holder)
+        other = server.connect()
+        server.holder = other
+        with pytest.raises(worker.AlreadyRunning):
+            worker.run_every(60, check_lock, runs=3, clock=lambda: 0.0, sleep=lambda seconds: None)
+
+    assert server.holder is other
+
+
+# dashboard data
+
+def test_delta_refresh_matches_full_load(tmp_path, monkeypatch):
+    monkeypatch.setenv('DATABASE_PATH', 'sqlite:///' + str(tmp_path / 'posts.db'))
+    data = stored_posts()
+    cutoff = data['post_datetime'].quantile(0.8)
+    data.loc[data['post_datetime'] < cutoff].to_sql('rooms', con=storage.get_engine(), index=False)
+
+    monkeypatch.setattr(dataset, '_snapshot', None)
+    loaded = dataset.refresh_snapshot()
+
+    # newer posts, plus one posted before the newest loaded post but stored late
+    late = data.loc[data['post_datetime'] < cutoff].iloc[:1].copy()
+    late['id'] = late['id'] + '_late'
+    late['post_datetime'] = loaded.data['post_datetime'].max() - pd.Timedelta(hours=3)
+    pd.concat([data.loc[data['post_datetime'] >= cutoff], late]).to_sql(
+        'rooms', con=storage.get_engine(), index=False, if_exists='append')
+
+    refreshed = dataset.refresh_snapshot()
+    monkeypatch.setattr(dataset, '_snapshot', None)
+    full = dataset.refresh_snapshot()
+
+    assert len(refreshed.data) == len(full.data) == len(data) + 1
+    assert len(refreshed.data) > len(loaded.data)
+
+    def rows(snapshot):
+        columns = ['id', 'post_datetime', 'neighborhood', 'post_price', 'size']
+        posts = dataset.post_rows(snapshot, np.arange(len(snapshot.data)), columns)
+        return posts.sort_values('id').reset_index(drop=True).astype({'neighborhood': object})
+
+    pd.testing.assert_frame_equal(rows(refreshed), rows(full))
+    pd.testing.assert_frame_equal(sorted_cells(refreshed.cube), sorted_cells(full.cube))
+    storage.dispose()
+
+
+def test_refresh_publishes_new_snapshot(tmp_path, monkeypatch):
+    monkeypatch.setenv('DATABASE_PATH', 'sqlite:///' + str(tmp_path / 'posts.db'))
+    monkeypatch.setattr(dataset, '_snapshot', None)
+    data = stored_posts().sort_values('post_datetime')
+    data.iloc[:-1000].to_sql('rooms', con=storage.get_engine(), index=False)
+
+    first = dataset.refresh_snapshot()
+    first_rows = first.data.copy()
+    assert dataset.refresh_snapshot() is first
+
+    data.iloc[-1000:].to_sql('rooms', con=storage.get_engine(), index=False, if_exists='append')
+    second = dataset.refresh_snapshot()
+
+    # readers holding the old snapshot see it unchanged
+    assert dataset.current_snapshot() is second
+    assert (first.version, second.version) == (1, 2)
+    pd.testing.assert_frame_equal(first.data, first_rows)
+    assert len(second.data) == len(data)
+
+    # the neighborhoods' row index covers the new posts
+    for hood in ['East Village', 'Upper West Side']:
+        rows = np.sort(second.neighborhood_rows[hood])
+        assert (rows == np.flatnonzero(second.data['neighborhood'].values == hood)).all()
+    storage.dispose()
+
+
+def test_refresh_loads_posts_backfilled_behind_it(tmp_path, monkeypatch):
+    monkeypatch.setenv('DATABASE_PATH', 'sqlite:///' + str(tmp_path / 'posts.db'))
+    monkeypatch.setattr(dataset, '_snapshot', None)
+    data = stored_posts().sort_values('post_datetime')
+    data.iloc[:0].to_sql('rooms', con=storage.get_engine(), index=False)
+    data.iloc[200:].to_csv(str(tmp_path / 'recent.csv'), index=False)
+    data.iloc[:200].to_csv(str(tmp_path / 'oldest.csv'), index=False)
+
+    backfill_data_records(str(tmp_path / 'recent.csv'), 'rooms')
+    first = dataset.refresh_snapshot()
+    assert len(first.data) == len(data) - 200
+
+    # saved and mapped again, as on a restart, then the oldest posts are stored
+    persist.save(first, str(tmp_path / 'snapshot'))
+    dataset.publish(*persist.load(str(tmp_path / 'snapshot')))
+    backfill_data_records(str(tmp_path / 'oldest.csv'), 'rooms')
+
+    second = dataset.refresh_snapshot()
+    assert len(second.data) == len(data)
+    assert second.cube['posts'].sum() == len(data)
+    assert dataset.refresh_snapshot() is second
+    storage.dispose()
+
+
+def test_compact_posts_round_trip(room_posts):
+    posts = room_posts.copy()
+    posts.loc[posts.index[0], 'id'] = 'backfilled-1'
+
+    half = len(posts) // 2
+    data, text = dataset.append_posts(*(dataset.compact(posts.iloc[:half]) + dataset.compact(posts.iloc[half:])))
+    snapshot = dataset.build_snapshot(data, text, version=1)
+
+    columns = ['region', 'post_datetime', 'neighborhood', 'post_title_text', 'post_price', 'post_link', 'id',
+               'post_date', 'size']
+    rows = dataset.post_rows(snapshot, np.arange(len(posts)), columns)
+    for column in columns:
+        assert (rows[column].astype(object).values == posts[column].astype(object).values).all(), column
+
+    # a fraction of the memory of the derived frame
+    usage = dataset.memory_usage(snapshot)
+    assert sum(usage.values()) < posts.memory_usage(deep=True).sum() / 2
+
+
+def test_saved_snapshot_round_trip(room_posts, tmp_path):
+    snapshot = dataset.build_snapshot(*dataset.compact(room_posts), version=1)
+    path = str(tmp_path / 'snapshot')
+    persist.save(snapshot, path)
+    persist.save(snapshot, path)
+
+    data, text, indexes = persist.load(path)
+    pd.testing.assert_frame_equal(data, snapshot.data)
+    pd.testing.assert_frame_equal(indexes['cube'], snapshot.cube)
+    pd.testing.assert_frame_equal(indexes['listing_cube'], snapshot.listing_cube)
+    loaded = dataset.build_snapshot(data, text, 1, indexes)
+    assert loaded.tag == snapshot.tag
+    assert loaded.sorted_hoods == snapshot.sorted_hoods
+    assert (loaded.text.ids(np.arange(len(data))) == room_posts['id'].values).all()
+
+    # mapped, not read into each process
+    assert isinstance(indexes['recent_rank'], np.memmap)
+    assert isinstance(text.titles.codes, np.memmap)
+
+    assert persist.load(str(tmp_path / 'nothing saved')) is None
+
+
+def test_saving_a_snapshot_swaps_the_current_version(room_posts, tmp_path):
+    path = str(tmp_path / 'snapshot')
+    # a directory shared with other files
+    os.makedirs(os.path.join(path, '.git'))
+    os.makedirs(os.path.join(path, 'notes'))
+    versions = []
+    for end in [1000, 2000, 3000]:
+        versions.append(persist.save(dataset.build_snapshot(*dataset.compact(room_posts.iloc[:end]), version=1), path))
+
+    assert persist.current_version(path) == versions[-1]
+    assert len(persist.load(path)[0]) == 3000
+
+    # the version just replaced is kept for processes still loading it, older ones are removed
+    saved = [name for name in os.listdir(path) if os.path.isdir(os.path.join(path, name)) and name != 'current']
+    assert sorted(saved) == sorted(versions[1:] + ['.git', 'notes'])
+
+
+def test_one_process_publishes_snapshots(tmp_path, monkeypatch):
+    path = str(tmp_path / 'snapshot')
+    monkeypatch.setattr(persist, '_publisher_lock', None)
+    assert persist.try_publisher_lock(path)
+    assert persist.try_publisher_lock(path)
+
+    # another process asking for it is turned away while this one holds it
+    pid = os.fork()
+    if pid == 0:
+        persist._publisher_lock = None
+        os._exit(0 if not persist.try_publisher_lock(path) else 1)
+    assert os.waitpid(pid, 0)[1] == 0
+
+    persist._publisher_lock.close()
+
+
+def test_saved_snapshot_of_another_schema_is_ignored(room_posts, tmp_path, monkeypatch):
+    path = str(tmp_path / 'snapshot')
+    persist.save(dataset.build_snapshot(*dataset.compact(room_posts), version=1), path)
+
+    monkeypatch.setattr(persist, 'SCHEMA_VERSION', persist.SCHEMA_VERSION + 1)
+    assert persist.load(path) is None
+
+    # the same posts saved again under the new schema are written anew, not relinked
+    persist.save(dataset.build_snapshot(*dataset.compact(room_posts), version=1), path)
+    assert len(persist.load(path)[0]) == len(room_posts)
+
+
+@pytest.fixture(scope='module')
+def stored_100k_posts(tmp_path_factory):
+    """about 100k posts in a sqlite database and saved as a snapshot"""
+    path = tmp_path_factory.mktemp('startup')
+    posts = pd.concat([stored_posts()] * 20, ignore_index=True)
+    posts['id'] = posts['id'] + '_' + (posts.index // 4916).astype(str)
+
+    url = 'sqlite:///' + str(path / 'posts.db')
+    posts.to_sql('rooms', con=create_engine(url), index=False)
+    persist.save(dataset.build_snapshot(*dataset.compact(derive_columns(posts)), version=1), str(path / 'snapshot'))
+
+    return url, str(path / 'snapshot')
+
+
+@pytest.mark.benchmark(group='startup, 100k posts')
+def test_benchmark_start_from_database(benchmark, stored_100k_posts, monkeypatch):
+    monkeypatch.setenv('DATABASE_PATH', stored_100k_posts[0])
+    benchmark.pedantic(lambda: dataset.build_snapshot(*dataset.compact(load_apartment_data()), version=1), rounds=1)
+    storage.dispose()
+
+
+@pytest.mark.benchmark(group='startup, 100k posts')
+def test_benchmark_start_from_saved_snapshot(benchmark, stored_100k_posts):
+    def start():
+        data, text, indexes = persist.load(stored_100k_posts[1])
+        return dataset.build_snapshot(data, text, 1, indexes)
+
+    benchmark.pedantic(start, rounds=3)
+
+
+def bundled_titles():
+    """every post title in the bundled csvs"""
+    return pd.concat([
+        pd.read_csv('apartment_data.csv')['post_title_text'],
+        pd.read_csv('full_apartment_data.csv')['post_title_text'],
+    ], ignore_index=True)
+
+
+def test_classify_apt_sizes_matches_determine_apt_size():
+    titles = pd.concat([bundled_titles(), pd.Series([
+        'STUDIO with 5BR house share', 'one bedroom in a 2 bedroom', '3bd', 'a 4 bed', '5 bdr', '',
+        'room.* in (1 br) [2 bd]?',
+    ])], ignore_index=True)
+
+    expected = titles.map(determine_apt_size)
+    assert expected.nunique() == 7
+    pd.testing.assert_series_equal(classify_apt_sizes(titles), expected, check_names=False)
+
+
+@pytest.fixture(scope='module')
+def many_titles():
+    """a million titles drawn from the bundled ones, numbered so that none repeat"""
+    titles = bundled_titles().sample(1000000, replace=True, random_state=0).reset_index(drop=True)
+    return titles + ' #' + titles.index.astype(str)
+
+
+@pytest.mark.benchmark(group='apartment sizes 100k')
+def test_benchmark_determine_apt_size_rowwise(benchmark, many_titles):
+    data = pd.DataFrame({'post_title_text': many_titles.iloc[:100000]})
+    benchmark.pedantic(
+        lambda: data.apply(lambda x: determine_apt_size(x['post_title_text']), axis=1), rounds=1)
+
+
+@pytest.mark.benchmark(group='apartment sizes 100k')
+def test_benchmark_classify_apt_sizes(benchmark, many_titles):
+    benchmark.pedantic(classify_apt_sizes, args=(many_titles.iloc[:100000],), rounds=3)
+
+
+@pytest.mark.slow
+@pytest.mark.benchmark(group='apartment sizes 1M')
+def test_benchmark_classify_apt_sizes_1m(benchmark, many_titles):
+    benchmark.pedantic(classify_apt_sizes, args=(many_titles,), rounds=1)
+
+
+# deal scores
+
+def deal_scores_by_loop(data):
+    """each post's deal_percentile and deal_zscore, one post at a time"""
+    day = data['post_day'].values
+    cohort = deals.cohorts(data)
+    price = data['post_price'].values
+
+    percentiles, zscores = [], []
+    for i in range(len(data)):
+        window = price[(cohort == cohort[i]) & (day > day[i] - deals.WINDOW_DAYS) & (day <= day[i])]
+        if len(window) < deals.MIN_COHORT:
+            percentiles.append(np.nan)
+            zscores.append(np.nan)
+            continue
+
+        percentiles.append(np.round(100.0 * ((window < price[i]).sum() + 0.5 * (window == price[i]).sum())
+                                    / len(window)))
+        zscores.append(0.0 if window.std() == 0 else (price[i] - window.mean()) / window.std())
+
+    return np.array(percentiles), np.array(zscores)
+
+
+def test_deal_scores_match_loop(room_posts):
+    data = dataset.compact(room_posts)[0]
+    percentiles, zscores = deal_scores_by_loop(data)
+
+    np.testing.assert_allclose(data['deal_percentile'].values, percentiles)
+    np.testing.assert_allclose(data['deal_zscore'].values, zscores, atol=1e-4)
+    assert np.isfinite(percentiles).mean() > 0.5
+
+
+def test_appended_posts_rescore_their_window(room_posts):
+    posts = room_posts.sort_values('post_datetime')
+    split = len(posts) * 3 // 4
+    data, text = dataset.append_posts(*(dataset.compact(posts.iloc[:split]) + dataset.compact(posts.iloc[split:])))
+    whole = dataset.compact(posts)[0]
+
+    for column in deals.SCORE_COLUMNS:
+        np.testing.assert_allclose(data[column].values, whole[column].values, atol=1e-4)
+
+
+@pytest.fixture(scope='module')
+def million_compact_posts():
+    rng = np.random.RandomState(0)
+    n = 1000000
+    return pd.DataFrame({
+        'post_day': (18353 + rng.randint(0, 730, n)).astype(np.int32),
+        'neighborhood': pd.Categorical.from_codes(rng.randint(0, 200, n), ['Neighborhood ' + str(i) for i in range(200)]),
+        'post_price': (rng.randint(800, 4000, n) // 25 * 25).astype(np.int32),
+        'size': pd.Categorical.from_codes(rng.randint(0, 4, n), ['other', 'studio', 'one bedroom', 'two bedroom']),
+    })
+
+
+@pytest.mark.slow
+@pytest.mark.benchmark(group='deal scores 1M')
+def test_benchmark_deal_scores_1m(benchmark, million_compact_posts):
+    benchmark.pedantic(deals.score_posts, args=(million_compact_posts,), rounds=1)
+
+
+# reposts
+
+def test_reposts_cluster_into_listings():
+    posts = pd.DataFrame([
+        ('Sunny room in the heart of Williamsburg!', 'Williamsburg', 1200),
+        ('sunny room in the heart of williamsburg', 'Williamsburg', 1150),
+        ('Cozy Sunny Room In The Heart Of Williamsburg', 'Williamsburg', 1200),
+        # the same title somewhere else, or at a price far from the others
+        ('Sunny room in the heart of Williamsburg!', 'Bushwick', 1200),
+        ('Sunny room in the heart of Williamsburg!', 'Williamsburg', 1800),
+        ('Large private room near the park', 'Williamsburg', 1200),
+        ('', 'Williamsburg', 1200),
+        ('', 'Williamsburg', 1200),
+    ], columns=['title', 'neighborhood', 'post_price'])
+    posts['neighborhood'] = posts['neighborhood'].astype('category')
+
+    ids = reposts.cluster_posts(posts, dataset.Strings.factorize(posts['title']))
+
+    assert ids.tolist() == [0, 0, 0, 3, 4, 5, 6, 7]
+
+
+def test_appended_posts_join_their_listings(room_posts):
+    posts = room_posts.sort_values('post_datetime')
+    split = len(posts) * 3 // 4
+    data, text = dataset.append_posts(*(dataset.compact(posts.iloc[:split]) + dataset.compact(posts.iloc[split:])))
+    whole = dataset.compact(posts)[0]
+
+    assert (data['listing_cluster_id'].values == whole['listing_cluster_id'].values).all()
+    assert whole['listing_cluster_id'].nunique() < len(whole)
+
+    # the listing cube counts each listing once
+    snapshot = dataset.build_snapshot(data, text, version=1)
+    assert snapshot.listing_cube['posts'].sum() == whole['listing_cluster_id'].nunique()
+
+
+@pytest.fixture(scope='module')
+def reposted_500k_titles():
+    rng = np.random.RandomState(0)
+    words = np.array(['sunny', 'large', 'private', 'room', 'in', 'near', 'the', 'park', 'train', 'bright',
+                      'cozy', 'furnished', 'shared', 'apartment', 'quiet', 'street', 'new', 'renovated'])
+    n, listings = 500000, 200000
+    titles = [' '.join(words[rng.randint(0, len(words), 7)]) + ' #' + str(i) for i in range(listings)]
+
+    # each post a listing's title, a third of them with a word dropped
+    listing = rng.randint(0, listings, n)
+    titles = [titles[i] if drop else titles[i].split(' ', 1)[1] for i, drop in zip(listing, rng.rand(n) > 1 / 3)]
+    posts = pd.DataFrame({
+        'neighborhood': pd.Categorical.from_codes(listing % 200, ['Neighborhood ' + str(i) for i in range(200)]),
+        'post_price': (800 + listing % 3200).astype(np.int32),
+    })
+
+    return posts, dataset.Strings.factorize(titles)
+
+
+@pytest.mark.slow
+@pytest.mark.benchmark(group='repost clusters 500k')
+def test_benchmark_cluster_posts_500k(benchmark, reposted_500k_titles):
+    benchmark.pedantic(reposts.cluster_posts, args=reposted_500k_titles, rounds=1)
+
+
+# chart aggregations
+
+def posts_per_date_by_loop(apartment_data):
+    """the dashboard's old approach, re-filtering the frame for each date"""
+    all_dates = []
+    for d in apartment_data['post_date'].unique():
+        df = apartment_data.loc[apartment_data['post_date'] == d]
+        dfx = pd.DataFrame(df['neighborhood'].value_counts()).rename(columns={'neighborhood': 'posts'})
+        dfx['neighborhood'] = dfx.index
+        dfx = dfx.reset_index(drop=True)
+        dfx['post_date'] = d
+        all_dates.append(dfx)
+
+    return pd.concat(all_dates, sort=False)
+
+
+def median_price_per_date_by_loop(apartment_data):
+    """the dashboard's old approach, a pivot table for each date"""
+    all_prices = []
+    for d in apartment_data['post_date'].unique():
+        df = apartment_data.loc[apartment_data['post_date'] == d]
+        dfx = pd.DataFrame(pd.pivot_table(df, values='post_price', index='neighborhood', aggfunc=np.median)).rename(
+            columns={'post_price': 'median_price'})
+        dfx['neighborhood'] = dfx.index
+        dfx = dfx.reset_index(drop=True)
+        dfx['post_date'] = d
+        all_prices.append(dfx)
+
+    return pd.concat(all_prices, sort=False)
+
+
+def tidy(summary):
+    """per date summary with neighborhood as a column, in a fixed order"""
+    if 'neighborhood' not in summary.columns:
+        summary = summary.reset_index()
+
+    summary = summary.sort_values(['neighborhood', 'post_date']).reset_index(drop=True)
+    summary['neighborhood'] = summary['neighborhood'].astype(object)
+
+    return summary[['neighborhood', 'post_date'] + [c for c in summary.columns if c not in ('neighborhood', 'post_date')]]
+
+
+@pytest.fixture(scope='module')
+def room_posts():
+    return derive_columns(stored_posts())
+
+
+@pytest.fixture(scope='module')
+def two_years_of_posts():
+    """two years of posts across 200 neighborhoods, about one per neighborhood a day"""
+    rng = np.random.RandomState(0)
+    n = 146000
+    dates = pd.date_range('2020-04-01', periods=730).date
+    return pd.DataFrame({
+        'post_date': dates[rng.randint(0, len(dates), n)],
+        'neighborhood': pd.Series(rng.randint(0, 200, n)).map(lambda i: 'Neighborhood ' + str(i)),
+        'post_price': rng.randint(800, 4000, n),
+    })
+
+
+def by_date(summary):
+    """a summary from the old loops, with post_date as the cube's dates"""
+    summary = summary.copy()
+    summary['post_date'] = pd.to_datetime(summary['post_date'])
+
+    return tidy(summary)
+
+
+def all_time_prices_by_pivot(apartment_data):
+    """all-time median and average price per neighborhood, the way the dashboard used to"""
+    prices = []
+    for aggfunc in [np.median, np.mean]:
+        df = pd.pivot_table(apartment_data, index='neighborhood', values='post_price', aggfunc=aggfunc)
+        df['neighborhood'] = df.index
+        df['post_price'] = round(df['post_price'], 0)
+        prices.append(df.reset_index(drop=True))
+
+    return prices
+
+
+def test_per_date_summaries_match_loops(room_posts):
+    cells = aggregations.build_cube(dataset.compact(room_posts)[0])
+
+    posts = aggregations.cube_posts_per_date(cells)
+    pd.testing.assert_frame_equal(tidy(posts), by_date(posts_per_date_by_loop(room_posts)), check_dtype=False)
+
+    # medians from the price sketches, within a bucket of exact
+    prices = tidy(aggregations.cube_price_quantile_per_date(cells, 0.5))
+    expected = by_date(median_price_per_date_by_loop(room_posts))
+    assert (prices['post_date'] == expected['post_date']).all()
+    assert (prices['price'] - expected['median_price']).abs().max() < aggregations.PRICE_BUCKET
+
+    east_village = aggregations.neighborhood_slice(posts, 'East Village')
+    assert len(east_village) > 0
+    assert east_village['post_date'].is_monotonic_increasing
+    assert len(aggregations.neighborhood_slice(posts, 'not a neighborhood')) == 0
+
+
+def test_all_time_prices_match_pivot_tables(room_posts):
+    cells = aggregations.build_cube(dataset.compact(room_posts)[0])
+    (df_median, df_mean), (median, mean) = aggregations.cube_all_time_prices(cells), all_time_prices_by_pivot(room_posts)
+
+    pd.testing.assert_frame_equal(df_mean, mean, check_dtype=False)
+    assert (df_median['neighborhood'] == median['neighborhood']).all()
+    assert (df_median['post_price'] - median['post_price']).abs().max() < aggregations.PRICE_BUCKET
+
+
+@pytest.mark.slow
+@pytest.mark.benchmark(group='posts per date, 2 years x 200 neighborhoods')
+def test_benchmark_posts_per_date_by_loop(benchmark, two_years_of_posts):
+    benchmark.pedantic(posts_per_date_by_loop, args=(two_years_of_posts,), rounds=1)
+
+
+@pytest.mark.benchmark(group='posts per date, 2 years x 200 neighborhoods')
+def test_benchmark_posts_per_date(benchmark, two_years_of_posts):
+    cube = aggregations.build_cube(with_post_day(two_years_of_posts.assign(size='other')))
+    benchmark.pedantic(aggregations.cube_posts_per_date, args=(cube,), rounds=3)
+
+
+@pytest.mark.slow
+@pytest.mark.benchmark(group='median price per date, 2 years x 200 neighborhoods')
+def test_benchmark_median_price_per_date_by_loop(benchmark, two_years_of_posts):
+    benchmark.pedantic(median_price_per_date_by_loop, args=(two_years_of_posts,), rounds=1)
+
+
+@pytest.mark.benchmark(group='median price per date, 2 years x 200 neighborhoods')
+def test_benchmark_median_price_per_date(benchmark, two_years_of_posts):
+    cube = aggregations.build_cube(with_post_day(two_years_of_posts.assign(size='other')))
+    benchmark.pedantic(aggregations.cube_price_quantile_per_date, args=(cube, 0.5), rounds=3)
+
+
+def raw_selection(apartment_data, neighborhoods, price_range, sizes):
+    """posts within the selections, filtered the way the dashboard used to"""
+    return apartment_data.loc[
+        apartment_data['neighborhood'].isin(neighborhoods)
+        & (apartment_data['post_price'] >= price_range[0])
+        & (apartment_data['post_price'] <= price_range[1])
+        & apartment_data['size'].isin(sizes)
+    ]
+
+
+@pytest.mark.parametrize('price_range', [(0, 100000), (1000, 1500), (1050, 1100), (2000, 2000)])
+def test_cube_matches_raw_posts(room_posts, price_range):
+    cube = aggregations.build_cube(dataset.compact(room_posts)[0])
+    neighborhoods = room_posts['neighborhood'].value_counts().index[:10].tolist()
+    sizes = ['other', 'studio', 'two bedroom']
+
+    cells = aggregations.select_cube(cube, neighborhoods, price_range, sizes)
+    raw = raw_selection(room_posts, neighborhoods, price_range, sizes)
+    assert cells['posts'].sum() == len(raw)
+
+    expected = by_date(posts_per_date_by_loop(raw))
+    pd.testing.assert_frame_equal(tidy(aggregations.cube_posts_per_date(cells)), expected, check_dtype=False)
+
+    # medians from the price sketches, within a bucket of exact
+    expected = by_date(median_price_per_date_by_loop(raw))
+    got = tidy(aggregations.cube_price_quantile_per_date(cells, 0.5))
+    assert (got['price'] - expected['median_price']).abs().max() < aggregations.PRICE_BUCKET
+
+    (got_median, got_mean), (median, mean) = aggregations.cube_all_time_prices(cells), all_time_prices_by_pivot(raw)
+    pd.testing.assert_frame_equal(got_mean, mean, check_dtype=False)
+    assert (got_median['post_price'] - median['post_price']).abs().max() < aggregations.PRICE_BUCKET
+    assert (got_median['neighborhood'] == median['neighborhood']).all()
+
+
+def test_cube_stops_growing_with_posts(room_posts):
+    data = dataset.compact(room_posts)[0]
+    rng = np.random.RandomState(0)
+
+    def more_posts(times):
+        # more posts over the same dates, at prices near the same ones
+        more = aggregations.take_rows(data, rng.randint(0, len(data), len(data) * times))
+        more['post_price'] = (more['post_price'].values + rng.randint(-2, 3, len(more)) * 10).astype(np.int32)
+        return more
+
+    # four times the posts fill the same cells
+    assert len(aggregations.build_cube(more_posts(40))) < len(aggregations.build_cube(more_posts(10))) * 1.1
+
+
+def test_price_histogram_matches_raw_posts(room_posts):
+    cube = aggregations.build_cube(dataset.compact(room_posts)[0])
+    neighborhoods = room_posts['neighborhood'].value_counts().index[:5].tolist()
+    cells = aggregations.select_cube(cube, neighborhoods, (1000, 2000), ['other', 'studio'])
+    raw = raw_selection(room_posts, neighborhoods, (1000, 2000), ['other', 'studio'])
+
+    histogram = aggregations.cube_price_histogram(cells, (1000, 2000))
+    assert histogram['posts'].sum() == len(raw)
+    for neighborhood in neighborhoods:
+        prices = raw.loc[raw['neighborhood'] == neighborhood, 'post_price']
+        # the last bucket is closed, posts at $2000 are drawn in the one from 1950 to 2000
+        buckets = np.minimum(prices // aggregations.PRICE_BUCKET * aggregations.PRICE_BUCKET,
+                             2000 - aggregations.PRICE_BUCKET)
+        expected = prices.groupby(buckets).size()
+
+        bins = aggregations.neighborhood_slice(histogram, neighborhood)
+        assert bins['price_bucket'].tolist() == expected.index.tolist()
+        assert bins['posts'].tolist() == expected.tolist()
+        # one bar per bucket of the slider's range, however many posts
+        assert len(bins) <= 1000 // aggregations.PRICE_BUCKET
+    assert (raw['post_price'] == 2000).any()
+
+
+def test_sketch_medians_on_bucket_edges_are_exact():
+    cells = pd.DataFrame({
+        'neighborhood': ['odd', 'odd', 'odd', 'even', 'even', 'even'],
+        'price_bucket': [1000, 1200, 1500, 900, 1100, 1300],
+        'on_edge': [True, True, True, True, True, False],
+        'posts': [2, 1, 2, 1, 1, 2],
+    })
+    sketches = aggregations.price_sketches(cells, ['neighborhood'])
+    medians = aggregations.sketch_quantiles(sketches, ['neighborhood'], 0.5)
+
+    # odd: 1000 1000 1200 1500 1500, even: 900 1100 and two inside 1300 to 1350
+    assert medians['odd'] == 1200
+    assert 1200 < medians['even'] < 1225
+
+    assert len(aggregations.sketch_quantiles(sketches.iloc[:0], ['neighborhood'], 0.5)) == 0
+
+
+def test_sketch_quantiles_of_groups_without_posts_are_nan():
+    cells = pd.DataFrame({
+        'neighborhood': ['busy', 'busy', 'empty', 'empty', 'last'],
+        'price_bucket': [1000, 1500, 3800, 3900, 1200],
+        'on_edge': [True, True, True, True, True],
+        'posts': [1, 1, 0, 0, 0],
+    })
+    medians = aggregations.sketch_quantiles(aggregations.price_sketches(cells, ['neighborhood']), ['neighborhood'], 0.5)
+
+    assert medians['busy'] == 1250
+    assert np.isnan(medians['empty']) and np.isnan(medians['last'])
+
+    # nor are cells without posts kept in a cube counted elsewhere
+    counts = cells.assign(post_date='2020-05-01', size='other', price_sum=cells['posts'] * cells['price_bucket'])
+    assert aggregations.cube_from_counts(counts)['neighborhood'].tolist() == ['busy', 'busy']
+
+
+def test_merged_cubes_count_both(room_posts):
+    half = len(room_posts) // 2
+    first = aggregations.build_cube(dataset.compact(room_posts.iloc[:half])[0])
+    second = aggregations.build_cube(dataset.compact(room_posts.iloc[half:])[0])
+    whole = aggregations.build_cube(dataset.compact(room_posts)[0])
+
+    pd.testing.assert_frame_equal(sorted_cells(aggregations.merge_cubes(first, second)), sorted_cells(whole))
+
+
+@pytest.mark.parametrize('path', ['apartment_data.csv', 'full_apartment_data.csv'])
+@pytest.mark.parametrize('keys', [['neighborhood', 'post_date'], ['neighborhood'], ['neighborhood', 'size']])
+def test_sketch_quantiles_within_a_bucket(path, keys):
+    posts = pd.read_csv(path)
+    posts['post_datetime'] = pd.to_datetime(posts['post_datetime'])
+    posts = derive_columns(posts)
+    posts['post_date'] = pd.to_datetime(posts['post_date'])
+    sketches = aggregations.price_sketches(aggregations.build_cube(dataset.compact(posts)[0]), keys)
+
+    for quantile in [0.25, 0.5, 0.75, 0.9]:
+        exact = posts.groupby(keys)['post_price'].quantile(quantile)
+        error = (aggregations.sketch_quantiles(sketches, keys, quantile).reindex(exact.index) - exact).abs()
+
+        assert error.max() < aggregations.PRICE_BUCKET
+        # rents are mostly round amounts, so most often the estimate is off by much less
+        assert error.mean() < aggregations.PRICE_BUCKET / 4
+
+
+def with_post_day(apartment_data):
+    """posts with post_day, the days since 1970 a cube is built from"""
+    return apartment_data.assign(
+        post_day=pd.to_datetime(apartment_data['post_date']).values.astype('datetime64[D]').astype(np.int32))
+
+
+@pytest.fixture(scope='module')
+def two_years_of_sized_posts(two_years_of_posts):
+    rng = np.random.RandomState(1)
+    sizes = np.array(['other', 'studio', 'one bedroom', 'two bedroom'], dtype=object)
+    # most real posts ask a round price
+    return two_years_of_posts.assign(
+        size=sizes[rng.randint(0, len(sizes), len(two_years_of_posts))],
+        post_price=two_years_of_posts['post_price'] // 25 * 25,
+    )
+
+
+def median_price_per_date_from_posts(apartment_data, neighborhoods):
+    raw = raw_selection(apartment_data, neighborhoods, (1000, 3000), ['studio', 'one bedroom'])
+    return raw.groupby(['neighborhood', 'post_date'], sort=True)['post_price'].median().reset_index(level='post_date')
+
+
+def median_price_per_date_from_cube(cube, neighborhoods):
+    cells = aggregations.select_cube(cube, neighborhoods, (1000, 3000), ['studio', 'one bedroom'])
+    return aggregations.cube_price_quantile_per_date(cells, 0.5)
+
+
+@pytest.mark.benchmark(group='median price per date for a selection, 2 years x 200 neighborhoods')
+def test_benchmark_selection_from_posts(benchmark, two_years_of_sized_posts):
+    neighborhoods = ['Neighborhood ' + str(i) for i in range(20)]
+    benchmark(median_price_per_date_from_posts, two_years_of_sized_posts, neighborhoods)
+
+
+@pytest.mark.benchmark(group='median price per date for a selection, 2 years x 200 neighborhoods')
+def test_benchmark_selection_from_cube(benchmark, two_years_of_sized_posts):
+    cube = aggregations.build_cube(with_post_day(two_years_of_sized_posts))
+    neighborhoods = ['Neighborhood ' + str(i) for i in range(20)]
+    benchmark(median_price_per_date_from_cube, cube, neighborhoods)
+
+
+# callback cache
+
+def test_result_cache_evicts_least_recently_used():
+    cache = ResultCache(max_entries=2)
+    cache.put('a', 1, 'A')
+    cache.put('b', 1, 'B')
+    assert cache.get('a', 1) == (True, 'A')
+
+    cache.put('c', 1, 'C')
+    assert cache.get('b', 1) == (False, None)
+    assert cache.get('a', 1) == (True, 'A')
+
+    # a new dataset version drops everything
+    assert cache.get('a', 2) == (False, None)
+    assert len(cache) == 0
+    assert cache.stats() == {'hits': 2, 'misses': 2, 'entries': 0}
+
+
+def test_memoize_normalizes_selections():
+    calls = []
+    version = [1]
+
+    @memoize(ResultCache(), lambda: version[0])
+    def callback(neighborhoods, price_range, sizes):
+        calls.append(neighborhoods)
+        return len(calls)
+
+    assert callback(['Bushwick', 'Astoria'], [1000, 2000], ['studio']) == 1
+    assert callback(['Astoria', 'Bushwick'], [1000, 2000], ['studio']) == 1
+    assert callback(['Astoria'], [1000, 2000], ['studio']) == 2
+
+    version[0] = 2
+    assert callback(['Astoria'], [1000, 2000], ['studio']) == 3
+
+
+def test_disk_result_cache_is_shared(tmp_path):
+    first = DiskResultCache(str(tmp_path), max_entries=2)
+    second = DiskResultCache(str(tmp_path), max_entries=2)
+
+    first.put('a', '10_1', {'data': [1, 2]})
+    assert second.get('a', '10_1') == (True, {'data': [1, 2]})
+
+    second.put('b', '10_1', 'B')
+    second.put('c', '10_1', 'C')
+    assert len(first) == 2
+
+    # a newer dataset seen by either worker clears the directory of the old one
+    first.put('a', '11_2', 'A')
+    assert len(second) == 1
+    assert second.get('b', '11_2') == (False, None)
+
+
+# shared filters
+
+def test_one_scan_per_interaction(room_posts):
+    snapshot = dataset.build_snapshot(*dataset.compact(room_posts), version=1)
+    neighborhoods = ['East Village', 'Bushwick']
+    sizes = ['other', 'studio']
+    before = filters.scans()
+
+    # the callbacks fired by one change, each asking for the same selections
+    for hoods in [neighborhoods, neighborhoods[::-1], neighborhoods]:
+        cells = filters.selected_cells(snapshot, hoods, [1000, 2000], sizes)
+    posts = filters.selected_posts(snapshot, neighborhoods, [1000, 2000], sizes)
+
+    after = filters.scans()
+    assert after['cube'] - before.get('cube', 0) == 1
+    assert after['posts'] - before.get('posts', 0) == 1
+
+    expected = raw_selection(room_posts, neighborhoods, (1000, 2000), sizes)
+    assert cells['posts'].sum() == len(expected)
+    assert (snapshot.text.ids(posts) == expected['id'].values).all()
+
+    # a new dataset version computes them again
+    filters.selected_cells(snapshot._replace(version=2), neighborhoods, [1000, 2000], sizes)
+    assert filters.scans()['cube'] - after['cube'] == 1
+
+
+
+def test_different_selections_are_computed_side_by_side(room_posts):
+    snapshot = dataset.build_snapshot(*dataset.compact(room_posts), version=1)
+    both_computing = threading.Barrier(2, timeout=5)
+    computed = []
+
+    def compute(hood):
+        # only returns once the other selection is being computed too
+        both_computing.wait()
+        computed.append(hood)
+        return hood
+
+    with ThreadPoolExecutor(max_workers=6) as executor:
+        selections = list(executor.map(
+            lambda hood: filters._shared('side by side', snapshot, lambda: compute(hood), [hood]),
+            ['Bushwick', 'Harlem'] * 3,
+        ))
+
+    # each computed once, the callers asking for the same one waited for it
+    assert selections == ['Bushwick', 'Harlem'] * 3
+    assert sorted(computed) == ['Bushwick', 'Harlem']
+    assert filters.scans()['side by side'] == 2
+
+
+@pytest.mark.parametrize('sort_by', [[], [{'column_id': 'post_date', 'direction': 'asc'}],
+                                     [{'column_id': 'post_price', 'direction': 'desc'}]])
+def test_table_pages_match_sorted_posts(room_posts, sort_by):
+    snapshot = dataset.build_snapshot(*dataset.compact(room_posts.sample(frac=1, random_state=0)), version=1)
+    neighborhoods = snapshot.sorted_hoods[:5]
+    columns = ['neighborhood', 'post_price', 'post_datetime']
+
+    posts = snapshot.data.iloc[filters.select_posts(snapshot, neighborhoods, [800, 2500], snapshot.sizes)]
+    column, ascending = 'post_datetime', False
+    if sort_by:
+        column = 'post_datetime' if sort_by[0]['column_id'] == 'post_date' else sort_by[0]['column_id']
+        ascending = sort_by[0]['direction'] == 'asc'
+    expected = posts.sort_values(column, ascending=ascending)[columns]
+
+    positions = filters.sorted_posts(snapshot, neighborhoods, [800, 2500], snapshot.sizes, sort_by)
+    pages = [filters.page_of_posts(snapshot, positions, page, 25, columns) for page in range(len(positions) // 25 + 1)]
+    assert all(len(page) <= 25 for page in pages)
+
+    # ties may come in either order, the sort column may not
+    got = pd.concat(pages)
+    assert len(got) == len(expected)
+    assert (got[column].values == expected[column].values).all()
+    assert sorted(got.index) == sorted(expected.index)
+
+
+# record and replay
+
+class FakeResponse(object):
+    def __init__(self, text):
+        self.status_code = 200
+        self.text = text
+
+
+class FakeSession(object):
+    """stands in for the network, counting requests"""
+    def __init__(self, text):
+        self.text = text
+        self.requests = 0
+
+    def get(self, url, **kwargs):
+        self.requests += 1
+        return FakeResponse(self.text)
+
+    def close(self):
+        pass
+
+
+def test_record_then_replay(tmp_path):
+    network = FakeSession(synthetic_page(0, 3))
+    recorder = RecordingSession(ResponseStore(str(tmp_path)), session=network)
+    with FetchEngine(rate=None, session=recorder) as engine:
+        recorded = get_apartment_data({'manhattan': SEARCHES['manhattan']}, engine)
+
+    # a fresh store reads the index back from disk
+    store = ResponseStore(str(tmp_path))
+    assert store.urls() == [SEARCHES['manhattan']]
+    with FetchEngine(rate=None, session=ReplaySession(store)) as engine:
+        replayed = get_apartment_data({'manhattan': SEARCHES['manhattan']}, engine)
+
+    assert network.requests == 1
+    pd.testing.assert_frame_equal(recorded, replayed)
+
+    with pytest.raises(MissingRecording):
+        ReplaySession(store).get(SEARCHES['brooklyn'])
+
+
+
+# fetching
+
+class FakeClock(object):
+    """monotonic time that only moves when slept through"""
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += seconds
+
+
+def test_token_bucket_rate_and_burst():
+    clock = FakeClock()
+    bucket = TokenBucket(rate=2, capacity=3, clock=clock, sleep=clock.sleep)
+
+    # a burst of three goes out at once, then one every half second
+    waits = [bucket.acquire() for _ in range(7)]
+    assert waits == [0, 0, 0, 0.5, 0.5, 0.5, 0.5]
+    assert clock.now == 2.0
+
+    # idle time refills the bucket, but never past its capacity
+    clock.sleep(60)
+    assert [bucket.acquire() for _ in range(4)] == [0, 0, 0, 0.5]
+
+
+def test_default_rate_spaces_requests_a_second_apart():
+    clock = FakeClock()
+    bucket = TokenBucket(clock=clock, sleep=clock.sleep)
+
+    for _ in range(10):
+        bucket.acquire()
+
+    assert clock.now == 9.0
+
+
+class SlowSession(FakeSession):
+    """answers after a delay, tracking how many requests are in flight at once"""
+    def __init__(self, text, delay):
+        super(SlowSession, self).__init__(text)
+        self.delay = delay
+        self.in_flight = 0
+        self.most_in_flight = 0
+        self._lock = threading.Lock()
+
+    def get(self, url, **kwargs):
+        with self._lock:
+            self.in_flight += 1
+            self.most_in_flight = max(self.most_in_flight, self.in_flight)
+        time.sleep(self.delay)
+        with self._lock:
+            self.in_flight -= 1
+
+        return super(SlowSession, self).get(url, **kwargs)
+
+
+def test_fetch_all_overlaps_requests():
+    session = SlowSession('page', delay=0.2)
+    with FetchEngine(rate=None, max_workers=5, session=session) as engine:
+        start = time.perf_counter()
+        results = engine.fetch_all(SEARCHES)
+        elapsed = time.perf_counter() - start
+
+    assert sorted(results) == sorted(SEARCHES)
+    assert all(result.text == 'page' for result in results.values())
+    assert session.most_in_flight == len(SEARCHES)
+    assert elapsed < 0.2 * len(SEARCHES)
+
+
+
+class PagedSession(FakeSession):
+    """serves a page per url, remembering the urls asked for"""
+    def __init__(self, pages):
+        super(PagedSession, self).__init__(None)
+        self.pages = pages
+        self.urls = []
+
+    def get(self, url, **kwargs):
+        self.requests += 1
+        self.urls.append(url)
+        return FakeResponse(self.pages[url])
+
+
+def test_paging_stops_on_short_or_known_pages():
+    full, short = RESULTS_PER_PAGE, RESULTS_PER_PAGE // 2
+    searches = {location: SEARCHES[location] for location in ['manhattan', 'brooklyn', 'queens', 'bronx']}
+    pages = {
+        # a full page then a short last page
+        'manhattan': [synthetic_page(0, full, 'mnh'), synthetic_page(full, short, 'mnh')],
+        # a full page of posts already stored
+        'brooklyn': [synthetic_page(1000, full, 'brk'), synthetic_page(1000 + full, full, 'brk')],
+        # half the first page already stored, then a short last page
+        'queens': [synthetic_page(2000, full, 'que'), synthetic_page(2000 + full, short, 'que')],
+        # more full pages than max_pages
+        'bronx': [synthetic_page(3000 + n * full, full, 'brx') for n in range(5)],
+    }
+    session = PagedSession({
+        page_url(searches[location], n * RESULTS_PER_PAGE): html
+        for location, htmls in pages.items() for n, html in enumerate(htmls)
+    })
+
+    def links(html):
+        return [record[-1] for record in parse_results_page(html, 'stored')[1]]
+    known_links = set(links(pages['brooklyn'][0]) + links(pages['queens'][0])[:short])
+
+    with FetchEngine(rate=None, session=session) as engine:
+        data = get_apartment_data(searches, engine, known_links=known_links, max_pages=3)
+
+    pages_fetched = {location: len([url for url in session.urls if url.startswith(link.split('?')[0])])
+                     for location, link in searches.items()}
+    assert pages_fetched == {'manhattan': 2, 'brooklyn': 1, 'queens': 2, 'bronx': 3}
+    assert data.groupby('region').size().to_dict() == {
+        'manhattan': full + short, 'brooklyn': full, 'queens': full + short, 'bronx': 3 * full,
+    }
+
+
+@pytest.fixture(scope='module', params=[1000, 10000, pytest.param(100000, marks=pytest.mark.slow)])
+def replay_store(request, tmp_path_factory):
+    n_posts = request.param
+    return n_posts, synthetic_store(tmp_path_factory.mktemp('responses'), n_posts)
+
+
+@pytest.mark.benchmark(group='replayed scrape throughput')
+def test_benchmark_replayed_scrape(benchmark, replay_store):
+    """fetch, parse and normalize every page of a replayed scrape"""
+    n_posts, store = replay_store
+    max_pages = n_posts // len(SEARCHES) // RESULTS_PER_PAGE + 1
+
+    def scrape():
+        with FetchEngine(rate=None, session=ReplaySession(store)) as engine:
+            return get_apartment_data(SEARCHES, engine, max_pages=max_pages)
+
+    data = benchmark.pedantic(scrape, rounds=1 if n_posts >= 100000 else 3)
+
+    assert len(data) == n_posts
+    benchmark.extra_info['posts'] = n_posts
+    # no stats with --benchmark-disable
+    if benchmark.stats is not None:
+        benchmark.extra_info['posts_per_sec'] = round(n_posts / benchmark.stats.stats.mean)
+
+
+@pytest.mark.benchmark(group='parse recorded pages')
+@pytest.mark.parametrize('name', available_parsers())
+def test_benchmark_recorded_pages(benchmark, name):
+    """parse pages saved with apartment_search.py --record, when there are any"""
+    store = ResponseStore(os.environ.get('SCRAPE_FIXTURES', DEFAULT_STORE))
+    if len(store) == 0:
+        pytest.skip('no recorded pages, run apartment_search.py --record ' + DEFAULT_STORE)
+
+    parser = get_parser(name)
+    pages = [store.load(url).text for url in store.urls()]
+
+    benchmark(lambda: [parser.parse(html, 'recorded') for html in pages])
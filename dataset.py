@@ -0,0 +1,542 @@
+"""the dashboard's in-memory copy of the room share posts
+
+a snapshot holds the posts compacted: categorical neighborhood, size and region, int32
+prices and a post_day of days since 1970 in place of post_date, plus each post's deal
+scores from deals.py and its listing_cluster_id from reposts.py. the titles, links and
+ids are kept apart in a PostText, and only read to show a page of the table.
+
+a snapshot is built from arrays that may be mapped from a saved copy shared with other
+processes, see persist.py, so nothing here modifies a snapshot's arrays in place
+"""
+import datetime as dt
+import threading
+from collections import namedtuple
+
+import numpy as np
+import pandas as pd
+from pandas.api.types import union_categoricals
+import sqlalchemy
+
+import storage
+from aggregations import build_cube, merge_cubes, replace_dates, take_rows
+from deals import add_scores
+from reposts import add_clusters
+
+
+# how far behind the newest post a refresh looks again, so posts stored late by a slow
+# scrape are still picked up. a refresh also looks back to the oldest post of each batch
+# signalled since the snapshot's updated_through, however old, like a backfill's
+REFRESH_OVERLAP = dt.timedelta(days=2)
+
+# how far behind its updated_through a refresh reads the signalled batches again, for
+# one that was signalled earlier than the newest seen but committed after it
+UPDATE_OVERLAP = dt.timedelta(minutes=10)
+
+# with the cube read from the database's rollups, the posts loaded for the table are
+# those up to this long before the newest one, see rollups.py
+RECENT_POST_DAYS = dt.timedelta(days=30)
+
+
+# a published dataset: the derived frame plus the lookups the dashboard needs from it.
+# never modified once published, a refresh builds a new one and swaps it in
+Snapshot = namedtuple('Snapshot', [
+    'version',
+    'tag',
+    'loaded_at',
+    'data',
+    'text',
+    'sorted_hoods',
+    'sizes',
+    'most_common_neighborhoods',
+    'neighborhood_rows',
+    'neighborhood_prices',
+    'recent_rank',
+    'cube',
+    'listing_cube',
+    'updated_through',
+])
+
+_snapshot = None
+_publish_lock = threading.Lock()
+
+
+# keywords that mark each apartment size, in order of precedence
+APT_SIZE_KEYWORDS = [
+    ('studio', ['studio']),
+    ('five bedroom', ['5br', 'five bedroom', '5 bedroom', '5 br', '5 bdr', '5bdr', '5bd', '5 bed', '5 bd']),
+    ('four bedroom', ['4br', 'four bedroom', '4 bedroom', '4 br', '4 bdr', '4bdr', '4bd', '4 bed', '4 bd']),
+    ('three bedroom', ['3br', 'three bedroom', '3 bedroom', '3 br', '3 bdr', '3bdr', '3bd', '3 bed', '3 bd']),
+    ('two bedroom', ['2br', 'two bedroom', '2 bedroom', '2 br', '2 bdr', '2bdr', '2bd', '2 bed', '2 bd']),
+    ('one bedroom', ['1br', 'one bedroom', '1 bedroom', '1 br', '1 bdr', '1bdr', '1bd', '1 bed', '1 bd']),
+]
+
+# the same keywords as bytes for classify_apt_sizes, leaving out any keyword that contains
+# a shorter one for the same size, since a title with the longer one has the shorter too
+APT_SIZE_KEYWORD_BYTES = [
+    (apt_size, [word.encode('utf-8') for word in words if not any(other != word and other in word for other in words)])
+    for apt_size, words in APT_SIZE_KEYWORDS
+]
+
+
+# estimate apartment size/bedrooms
+def determine_apt_size(post_title):
+    """size of the apartment in a single post title"""
+    post_title = post_title.lower()
+
+    for apt_size, words in APT_SIZE_KEYWORDS:
+        if any(word in post_title for word in words):
+            return apt_size
+
+    return 'other'
+
+
+def find_all(text, word):
+    """every position of word in text"""
+    positions = []
+    i = text.find(word)
+    while i != -1:
+        positions.append(i)
+        i = text.find(word, i + 1)
+
+    return np.array(positions, dtype=np.int64)
+
+
+def classify_apt_sizes(post_titles):
+    """size of the apartment for a whole series of post titles, same labels as determine_apt_size
+
+    each distinct title is classified once. the distinct titles are joined into one
+    lowercase byte string, each keyword is found with a single scan through it, and the
+    matches are mapped back to their titles by offset
+    """
+    codes, titles = pd.factorize(post_titles)
+
+    encoded = [title.lower().encode('utf-8') for title in titles]
+    text = b'\n'.join(encoded)
+    ends = np.cumsum(np.fromiter(map(len, encoded), dtype=np.int64, count=len(encoded)) + 1)
+
+    # position of each title's size in the precedence list, starting at other.
+    # sizes are applied from lowest precedence up so the highest one found wins
+    sizes = np.full(len(titles), len(APT_SIZE_KEYWORD_BYTES), dtype=np.intp)
+    for rank in reversed(range(len(APT_SIZE_KEYWORD_BYTES))):
+        apt_size, words = APT_SIZE_KEYWORD_BYTES[rank]
+        for word in words:
+            sizes[np.searchsorted(ends, find_all(text, word), side='right')] = rank
+
+    # missing titles have code -1, which picks the trailing other
+    labels = np.array([apt_size for apt_size, words in APT_SIZE_KEYWORD_BYTES] + ['other'], dtype=object)
+    title_sizes = np.append(labels[sizes], 'other')
+
+    return pd.Series(title_sizes[codes], index=post_titles.index, dtype=object)
+
+
+def derive_columns(apartment_data):
+    """adds the dashboard's columns to rows fresh from the database"""
+    apartment_data['post_datetime'] = pd.to_datetime(apartment_data['post_datetime'])
+
+    apartment_data['post_date'] = apartment_data['post_datetime'].dt.date
+
+    apartment_data['post_title_text'] = apartment_data['post_title_text'].str.lower()
+
+    # determine size of the apartment
+    apartment_data['size'] = classify_apt_sizes(apartment_data['post_title_text'])
+
+    return apartment_data
+
+
+def load_apartment_data():
+    """room posts with derived columns"""
+    sql = """
+    SELECT * FROM rooms;
+    """
+    return derive_columns(storage.read_sql(sql))
+
+
+def newest_post_time():
+    """time of the newest room post stored, None when there are none"""
+    newest = storage.read_sql('SELECT MAX(post_datetime) AS newest FROM rooms')['newest'][0]
+
+    return None if pd.isnull(newest) else pd.Timestamp(newest)
+
+
+def load_new_posts(since, recent_ids):
+    """room posts from since onwards with derived columns, less those with recent_ids"""
+    sql = sqlalchemy.text("""
+    SELECT * FROM rooms WHERE post_datetime >= :since;
+    """)
+    new_rows = storage.read_sql(sql, params={'since': since.to_pydatetime()})
+
+    # the overlap brings back rows already loaded
+    new_rows = new_rows.loc[~new_rows['id'].isin(recent_ids)]
+
+    return derive_columns(new_rows)
+
+
+# columns of the compacted posts kept as categoricals
+CATEGORY_COLUMNS = ['region', 'neighborhood', 'size']
+
+# columns held by a snapshot's PostText
+TEXT_COLUMNS = ['post_title_text', 'post_link', 'id']
+
+
+class Strings(object):
+    """a column of strings as codes into an array of its distinct values
+
+    the values are python strings, or fixed width utf-8 bytes when mapped from a saved
+    snapshot, decoded only for the rows read
+    """
+
+    def __init__(self, codes, values):
+        self.codes = codes
+        self.values = values
+
+    @classmethod
+    def factorize(cls, strings):
+        codes, values = pd.factorize(pd.Series(strings).fillna('').values)
+        return cls(codes.astype(np.int32), np.asarray(values, dtype=object))
+
+    def __len__(self):
+        return len(self.codes)
+
+    def distinct(self):
+        """the distinct values as python strings"""
+        if self.values.dtype.kind == 'S':
+            return np.array([value.decode('utf-8') for value in self.values], dtype=object)
+
+        return self.values
+
+    def take(self, positions):
+        """the strings at positions"""
+        values = self.values[self.codes[positions]]
+        if values.dtype.kind == 'S':
+            return np.array([value.decode('utf-8') for value in values], dtype=object)
+
+        return values
+
+    def append(self, other):
+        """these strings followed by other's, sharing their distinct values"""
+        values = self.distinct()
+        other_values = other.distinct()
+
+        # other's values are distinct already, so any not found are new
+        found = pd.Index(values).get_indexer(other_values)
+        new = found == -1
+        found[new] = len(values) + np.arange(new.sum())
+
+        return Strings(
+            np.concatenate([self.codes, found[other.codes].astype(np.int32)]),
+            np.concatenate([values, other_values[new]]),
+        )
+
+    def memory_usage(self):
+        """bytes held, counting each distinct string once"""
+        if self.values.dtype.kind == 'S':
+            return self.codes.nbytes + self.values.nbytes
+
+        return self.codes.nbytes + pd.Series(self.values).memory_usage(deep=True, index=False)
+
+
+class PostText(object):
+    """titles, links and ids of the posts, kept apart from the columns the charts scan
+
+    titles and links are dictionary encoded, since the same post is stored again on
+    each day it is seen. an id is its link plus the day it was stored, so only that
+    suffix is kept, or the whole id when it doesn't start with the link
+    """
+
+    def __init__(self, titles, links, id_suffixes, own_ids):
+        self.titles = titles
+        self.links = links
+        self.id_suffixes = id_suffixes
+        self.own_ids = own_ids
+
+    @classmethod
+    def from_frame(cls, apartment_data):
+        links = apartment_data['post_link'].values
+        ids = apartment_data['id'].values
+        own_ids = np.array([not post_id.startswith(link) for post_id, link in zip(ids, links)], dtype=bool)
+        suffixes = [post_id if own else post_id[len(link):] for post_id, link, own in zip(ids, links, own_ids)]
+
+        return cls(
+            Strings.factorize(apartment_data['post_title_text'].values),
+            Strings.factorize(links),
+            Strings.factorize(suffixes),
+            own_ids,
+        )
+
+    def __len__(self):
+        return len(self.own_ids)
+
+    def append(self, other):
+        """text of these posts followed by other's"""
+        return PostText(
+            self.titles.append(other.titles),
+            self.links.append(other.links),
+            self.id_suffixes.append(other.id_suffixes),
+            np.concatenate([self.own_ids, other.own_ids]),
+        )
+
+    def ids(self, positions):
+        """ids of the posts at positions"""
+        links = self.links.take(positions)
+        suffixes = self.id_suffixes.take(positions)
+
+        return np.where(self.own_ids[positions], suffixes, links + suffixes)
+
+    def take(self, positions, columns):
+        """frame of the text columns of the posts at positions"""
+        text = {
+            'post_title_text': lambda: self.titles.take(positions),
+            'post_link': lambda: self.links.take(positions),
+            'id': lambda: self.ids(positions),
+        }
+
+        return pd.DataFrame({column: text[column]() for column in columns}, index=positions)
+
+    def memory_usage(self):
+        """bytes held, counting each distinct string once"""
+        return self.own_ids.nbytes + sum(
+            strings.memory_usage() for strings in [self.titles, self.links, self.id_suffixes])
+
+
+def compact(apartment_data):
+    """(data, text) of derived posts, for a snapshot"""
+    data = pd.DataFrame({
+        'region': apartment_data['region'].astype('category'),
+        'post_datetime': apartment_data['post_datetime'],
+        'post_day': apartment_data['post_datetime'].values.astype('datetime64[D]').astype(np.int32),
+        'neighborhood': apartment_data['neighborhood'].astype('category'),
+        'post_price': apartment_data['post_price'].astype(np.int32),
+        'size': apartment_data['size'].astype('category'),
+    }).reset_index(drop=True)
+    text = PostText.from_frame(apartment_data)
+
+    return add_clusters(add_scores(data), text.titles), text
+
+
+def append_posts(data, text, new_data, new_text):
+    """(data, text) of compacted posts followed by new ones, the posts they could change
+    rescored and the new ones matched to the listings before them
+    """
+    combined = pd.concat([data, new_data], ignore_index=True, sort=False)
+    for column in CATEGORY_COLUMNS:
+        combined[column] = union_categoricals([data[column], new_data[column]], sort_categories=True)
+    text = text.append(new_text)
+
+    return add_clusters(add_scores(combined, len(data)), text.titles, len(data)), text
+
+
+def post_rows(snapshot, positions, columns):
+    """the posts at positions with the given columns, text and post_date put back"""
+    text = snapshot.text.take(positions, [column for column in columns if column in TEXT_COLUMNS])
+
+    values = {}
+    for column in columns:
+        if column in TEXT_COLUMNS:
+            values[column] = text[column].values
+        elif column == 'post_date':
+            values[column] = pd.to_datetime(snapshot.data['post_day'].values[positions], unit='D').date
+        else:
+            # a column at a time, see take_rows
+            values[column] = snapshot.data[column].values[positions]
+
+    return pd.DataFrame(values, index=positions, columns=columns)
+
+
+# find the most common neighborhoods
+def get_most_common_neighborhoods(apartment_data, counts=None):
+    """"""
+
+    most_common = pd.DataFrame(
+        apartment_data['neighborhood'].value_counts() if counts is None else counts
+    ).rename(
+        columns={
+            'neighborhood': 'count'
+        }
+    )
+    most_common['neighborhood'] = most_common.index
+    most_common = most_common.reset_index(drop=True)
+
+    # get neighborhoods with at least 30 results
+    most_common_neighborhoods = most_common.loc[most_common['count'] >= 30]
+
+    return most_common_neighborhoods
+
+
+def build_indexes(data, cube=None):
+    """{name: index} of the lookups over compacted posts a snapshot holds
+
+    cube, when given, counts the same posts, or every post while data holds only the
+    recent ones, as when it is read from the database's rollups. the neighborhoods and
+    sizes offered then come from the cube
+    """
+    # row positions of each neighborhood's posts in order of price, with those prices,
+    # so a price range within a neighborhood is a searchsorted slice
+    prices = data['post_price'].values
+    by_price = np.argsort(prices, kind='mergesort')
+    codes = data['neighborhood'].cat.codes.values[by_price]
+    rows = by_price[np.argsort(codes, kind='mergesort')]
+    bounds = np.searchsorted(np.sort(codes), np.arange(len(data['neighborhood'].cat.categories) + 1))
+
+    neighborhood_rows = {}
+    for i, hood in enumerate(data['neighborhood'].cat.categories):
+        if bounds[i + 1] > bounds[i]:
+            neighborhood_rows[hood] = rows[bounds[i]:bounds[i + 1]]
+    neighborhood_prices = {hood: prices[hood_rows] for hood, hood_rows in neighborhood_rows.items()}
+
+    # rank of each row by post time, newest first, so any selection of rows sorts by a lookup
+    recent_rank = np.empty(len(data), dtype=np.int64)
+    recent_rank[np.argsort(data['post_datetime'].values, kind='mergesort')[::-1]] = np.arange(len(data))
+
+    # count of posts and the newest post time, the same in every process that loaded the same posts
+    tag = str(len(data))
+    if len(data) > 0:
+        tag += '_' + data['post_datetime'].max().strftime('%Y%m%d%H%M%S')
+
+    if cube is None:
+        cube = build_cube(data)
+
+    if cube['posts'].sum() == len(data):
+        counts = data['neighborhood'].value_counts()
+        sizes = data['size'].unique().tolist()
+    else:
+        tag += '_' + str(cube['posts'].sum())
+        counts = cube.groupby('neighborhood', observed=True)['posts'].sum().sort_values(
+            ascending=False, kind='mergesort').rename('neighborhood')
+        counts.index = counts.index.astype(object)
+        sizes = cube['size'].unique().tolist()
+
+    # the first post of each listing, for charts counting reposts once
+    firsts = np.flatnonzero(data['listing_cluster_id'].values == np.arange(len(data)))
+
+    return {
+        'tag': tag,
+        # get count of all neighborhoods as a list
+        'sorted_hoods': counts.index.tolist(),
+        'sizes': sizes,
+        'most_common_neighborhoods': get_most_common_neighborhoods(data, counts),
+        'neighborhood_rows': neighborhood_rows,
+        'neighborhood_prices': neighborhood_prices,
+        'recent_rank': recent_rank,
+        'cube': cube,
+        'listing_cube': build_cube(take_rows(data, firsts)),
+    }
+
+
+def build_snapshot(data, text, version, indexes=None):
+    """snapshot of compacted posts and their text, with its lookups computed up front
+    unless they are given, as when mapped from a saved snapshot
+    """
+    if indexes is None:
+        indexes = build_indexes(data)
+
+    return Snapshot(
+        version=version,
+        tag=indexes['tag'],
+        loaded_at=dt.datetime.now(),
+        data=data,
+        text=text,
+        sorted_hoods=indexes['sorted_hoods'],
+        sizes=indexes['sizes'],
+        most_common_neighborhoods=indexes['most_common_neighborhoods'],
+        neighborhood_rows=indexes['neighborhood_rows'],
+        neighborhood_prices=indexes['neighborhood_prices'],
+        recent_rank=indexes['recent_rank'],
+        cube=indexes['cube'],
+        listing_cube=indexes['listing_cube'],
+        updated_through=indexes.get('updated_through'),
+    )
+
+
+def current_snapshot():
+    """the latest published snapshot, read it once per request and use that throughout"""
+    return _snapshot
+
+
+def publish(data, text, indexes=None):
+    """build a snapshot of compacted posts and make it the current one with a single swap"""
+    global _snapshot
+
+    with _publish_lock:
+        version = 1 if _snapshot is None else _snapshot.version + 1
+        snapshot = build_snapshot(data, text, version, indexes)
+        _snapshot = snapshot
+
+    return snapshot
+
+
+def refresh_snapshot(load_cube=None):
+    """load posts added since the current snapshot and publish the result
+
+    the posts looked at reach back to the oldest of any batch signalled in data_updates
+    since the snapshot's updated_through, so posts stored late with older times are
+    loaded too
+
+    load_cube, when given, returns the cube of every post counted elsewhere, like
+    rollups.load_cube, or only its cells from a date on. then only posts from
+    RECENT_POST_DAYS before the newest one are loaded, for the table, and a refresh
+    reads again only the cells of the dates its new posts were on
+    """
+    snapshot = current_snapshot()
+
+    if snapshot is None or len(snapshot.data) == 0:
+        # read before the posts, so any stored meanwhile are looked for again next time
+        updated_through = storage.latest_data_update()
+        cube = None if load_cube is None else load_cube()
+        newest = None if cube is None else newest_post_time()
+        if newest is None:
+            data, text = compact(load_apartment_data())
+        else:
+            data, text = compact(load_new_posts(newest - RECENT_POST_DAYS, []))
+
+        return publish(data, text, dict(build_indexes(data, cube), updated_through=updated_through))
+
+    after = None if snapshot.updated_through is None else snapshot.updated_through - UPDATE_OVERLAP
+    updated_through, oldest = storage.data_updates_since(after)
+
+    since = snapshot.data['post_datetime'].max() - REFRESH_OVERLAP
+    if oldest is not None:
+        since = min(since, oldest)
+    recent = np.flatnonzero((snapshot.data['post_datetime'] >= since).values)
+
+    new_rows = load_new_posts(since, snapshot.text.ids(recent))
+    if len(new_rows) == 0:
+        return snapshot
+    first = new_rows['post_datetime'].min()
+
+    # with the cube from elsewhere, posts older than the table's are counted in the cube only
+    if load_cube is not None:
+        new_rows = new_rows.loc[new_rows['post_datetime'] >= snapshot.data['post_datetime'].min()]
+
+    data, text = snapshot.data, snapshot.text
+    if len(new_rows) > 0:
+        new_data, new_text = compact(new_rows)
+        data, text = append_posts(data, text, new_data, new_text)
+
+    # the new posts are counted into the current cube rather than counting them all again
+    if load_cube is None:
+        cube = merge_cubes(snapshot.cube, build_cube(new_data))
+    else:
+        cube = replace_dates(snapshot.cube, load_cube(first), first)
+
+    return publish(data, text, dict(build_indexes(data, cube), updated_through=updated_through))
+
+
+def memory_usage(snapshot):
+    """{part: bytes} held by a snapshot's posts, their text and the indexes over them"""
+    indexes = snapshot.recent_rank.nbytes
+    for hood, rows in snapshot.neighborhood_rows.items():
+        indexes += rows.nbytes + snapshot.neighborhood_prices[hood].nbytes
+
+    return {
+        'posts': int(snapshot.data.memory_usage(deep=True).sum()),
+        'text': int(snapshot.text.memory_usage()),
+        'indexes': int(indexes),
+    }
+
+
+def report(snapshot):
+    """print the bytes held per post"""
+    usage = memory_usage(snapshot)
+    posts = max(1, len(snapshot.data))
+    print('memory per post: ' + ', '.join(part + ' ' + str(round(usage[part] / posts)) + 'B' for part in usage)
+          + ', ' + str(round(sum(usage.values()) / posts)) + 'B in total.')
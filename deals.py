@@ -0,0 +1,123 @@
+"""how good a deal each post is, next to similar posts shortly before it
+
+a post's cohort is the posts in its neighborhood of its size over the WINDOW_DAYS up to
+and including its day. deal_percentile is the percent of its cohort asking less, ties
+counted half, and deal_zscore is how many standard deviations its price is from the
+cohort's mean, so a low percentile or a negative z-score is a cheap post for what it
+is. cohorts of fewer than MIN_COHORT posts are too small to say and score NaN.
+
+scores are computed for the compacted posts of a snapshot, all at once. the z-scores
+come from running sums through the posts in cohort and day order. the percentiles rank
+each day's posts against the sorted posts of its window, one day at a time rather than
+one post at a time.
+"""
+import numpy as np
+
+
+# days of posts each post is compared against, its own day included
+WINDOW_DAYS = 30
+
+# fewest posts in a cohort worth scoring against
+MIN_COHORT = 5
+
+SCORE_COLUMNS = ['deal_percentile', 'deal_zscore']
+
+
+def cohorts(data):
+    """code of each post's neighborhood and size together"""
+    sizes = len(data['size'].cat.categories)
+
+    return data['neighborhood'].cat.codes.values.astype(np.int64) * sizes + data['size'].cat.codes.values
+
+
+def score_posts(data, positions=None):
+    """(deal_percentile, deal_zscore) arrays of the posts at positions, every post when None,
+    each scored against all the posts in data
+    """
+    if positions is None:
+        positions = np.arange(len(data))
+    percentiles = np.full(len(positions), np.nan, dtype=np.float32)
+    zscores = np.full(len(positions), np.nan, dtype=np.float32)
+    if len(positions) == 0:
+        return percentiles, zscores
+
+    cohort = cohorts(data)
+    day = data['post_day'].values.astype(np.int64)
+    price = data['post_price'].values.astype(np.int64)
+
+    # posts in cohort then day order, with running counts and sums of price through them,
+    # so a cohort's window is the difference of two of them
+    days = day - day.min() + WINDOW_DAYS
+    key = cohort * (days.max() + 1) + days
+    order = np.argsort(key, kind='mergesort')
+    key = key[order]
+    sums = np.concatenate([[0.0], np.cumsum(price[order], dtype=np.float64)])
+    squares = np.concatenate([[0.0], np.cumsum(price[order].astype(np.float64) ** 2)])
+
+    query = cohort[positions] * (days.max() + 1) + days[positions]
+    high = np.searchsorted(key, query, side='right')
+    low = np.searchsorted(key, query - WINDOW_DAYS, side='right')
+    count = high - low
+    mean = (sums[high] - sums[low]) / count
+    std = np.sqrt(np.maximum((squares[high] - squares[low]) / count - mean ** 2, 0))
+
+    # a cohort all at one price has nobody cheaper or dearer
+    with np.errstate(divide='ignore', invalid='ignore'):
+        z = np.where(std > 0, (price[positions] - mean) / np.where(std > 0, std, 1), 0.0)
+
+    # each post's price within its cohort, so a window sorted once ranks every cohort in it
+    prices = price - price.min()
+    ranked = cohort * (prices.max() + 1) + prices
+    floor = cohort * (prices.max() + 1)
+
+    by_day = np.argsort(day, kind='mergesort')
+    window_days = day[by_day]
+    queries = np.argsort(day[positions], kind='mergesort')
+    query_days = day[positions][queries]
+    starts = np.flatnonzero(np.diff(query_days, prepend=query_days[0] - 1))
+    ends = np.append(starts[1:], len(queries))
+
+    below = np.empty(len(positions), dtype=np.int64)
+    equal = np.empty(len(positions), dtype=np.int64)
+    for start, end in zip(starts, ends):
+        d = query_days[start]
+        window = np.sort(ranked[by_day[np.searchsorted(window_days, d - WINDOW_DAYS, side='right'):
+                                       np.searchsorted(window_days, d, side='right')]])
+
+        these = queries[start:end]
+        posts = positions[these]
+        first = np.searchsorted(window, ranked[posts], side='left')
+        below[these] = first - np.searchsorted(window, floor[posts], side='left')
+        equal[these] = np.searchsorted(window, ranked[posts], side='right') - first
+
+    scored = count >= MIN_COHORT
+    percentiles[scored] = np.round(100.0 * (below + 0.5 * equal) / count)[scored]
+    zscores[scored] = z[scored]
+
+    return percentiles, zscores
+
+
+def add_scores(data, first_new=0):
+    """sets the score columns of compacted posts not yet published
+
+    posts before first_new keep the scores they have unless posts from first_new on
+    are in their window, so appending a refresh's posts rescores only the days since
+    """
+    if first_new == 0 or any(column not in data for column in SCORE_COLUMNS):
+        rescored = np.arange(len(data))
+    elif first_new >= len(data):
+        return data
+    else:
+        day = data['post_day'].values
+        rescored = np.flatnonzero(day >= day[first_new:].min())
+        rescored = np.union1d(rescored, np.arange(first_new, len(data)))
+
+    percentiles, zscores = score_posts(data, rescored)
+    for column, scores in zip(SCORE_COLUMNS, [percentiles, zscores]):
+        values = np.full(len(data), np.nan, dtype=np.float32)
+        if column in data:
+            values[:] = data[column].values
+        values[rescored] = scores
+        data[column] = values
+
+    return data
@@ -0,0 +1,139 @@
+"""concurrent, rate-limited fetching of craigslist search pages"""
+import threading
+import time
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlparse
+
+import requests
+from requests.adapters import HTTPAdapter
+
+
+# politeness limits, applied per host
+# sustained requests per second and how many requests may go out back to back,
+# one at a time so the pages of a scrape stay at least a second apart
+REQUESTS_PER_SECOND = 1.0
+BURST = 1
+
+# number of requests in flight at once
+MAX_WORKERS = 10
+
+# seconds before a request is abandoned
+REQUEST_TIMEOUT = 30
+
+
+FetchResult = namedtuple('FetchResult', ['url', 'status_code', 'text', 'latency'])
+
+
+class TokenBucket(object):
+    """token bucket rate limiter, safe to share between threads
+
+    clock and sleep stand in for time.monotonic and time.sleep, tests pass a fake clock
+    """
+
+    def __init__(self, rate=REQUESTS_PER_SECOND, capacity=BURST, clock=time.monotonic, sleep=time.sleep):
+        self.rate = float(rate)
+        self.capacity = float(capacity)
+        self.clock = clock
+        self.sleep = sleep
+        self._tokens = float(capacity)
+        self._last = clock()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """blocks until a token is available, returns the seconds spent waiting"""
+        with self._lock:
+            now = self.clock()
+            self._tokens = min(self.capacity, self._tokens + (now - self._last) * self.rate)
+            self._last = now
+
+            # reserve the token now, going into debt if needed, so callers queue up in order
+            self._tokens -= 1
+            wait = 0.0 if self._tokens >= 0 else -self._tokens / self.rate
+
+        if wait > 0:
+            self.sleep(wait)
+
+        return wait
+
+
+def make_session(pool_size=MAX_WORKERS):
+    """requests session with a keep-alive connection pool sized for the workers"""
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+
+    return session
+
+
+class FetchEngine(object):
+    """fetches urls concurrently on a thread pool, rate limited per host
+
+    a rate of None turns the rate limit off, for sessions that never reach the network
+    """
+
+    def __init__(self, rate=REQUESTS_PER_SECOND, burst=BURST, max_workers=MAX_WORKERS,
+                 session=None, timeout=REQUEST_TIMEOUT):
+        self.rate = rate
+        self.burst = burst
+        self.timeout = timeout
+        self.session = session if session is not None else make_session(max_workers)
+        self.latencies = []
+
+        self._buckets = {}
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=max_workers)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def _bucket(self, url):
+        """one rate limiter per host"""
+        host = urlparse(url).netloc
+        with self._lock:
+            if host not in self._buckets:
+                self._buckets[host] = TokenBucket(self.rate, self.burst)
+            return self._buckets[host]
+
+    def fetch(self, url):
+        """fetch a single url, blocking on the host's rate limit first"""
+        if self.rate is not None:
+            self._bucket(url).acquire()
+
+        start = time.perf_counter()
+        response = self.session.get(url, timeout=self.timeout)
+        latency = time.perf_counter() - start
+
+        with self._lock:
+            self.latencies.append((url, latency))
+
+        return FetchResult(url, response.status_code, response.text, latency)
+
+    def submit(self, url):
+        """schedule a fetch on the pool, returns a future"""
+        return self._executor.submit(self.fetch, url)
+
+    def fetch_all(self, searches):
+        """fetch every url in a {name: url} dict at once, returns {name: FetchResult}"""
+        futures = {name: self.submit(link) for name, link in searches.items()}
+
+        return {name: future.result() for name, future in futures.items()}
+
+    def report(self):
+        """print a summary of request latencies"""
+        if len(self.latencies) == 0:
+            print('no requests made.')
+            return
+
+        latencies = sorted(latency for url, latency in self.latencies)
+        print(str(len(latencies)) + ' requests'
+              + ', median latency: ' + str(round(latencies[len(latencies) // 2], 2)) + 's'
+              + ', max latency: ' + str(round(latencies[-1], 2)) + 's')
+
+    def close(self):
+        self._executor.shutdown(wait=True)
+        self.session.close()
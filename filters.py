@@ -0,0 +1,145 @@
+"""the selections the dashboard's callbacks share
+
+one change to a dropdown fires several callbacks with the same inputs. each selection
+is computed by the first of them to ask, under a lock for its inputs, and the rest wait
+for it and reuse it for as long as the dataset version stays the same. different
+selections are computed side by side. selections are shared, never modify them
+"""
+import threading
+
+import numpy as np
+
+from aggregations import select_cube
+from cache import ResultCache, normalize
+from dataset import post_rows
+
+
+# selections kept, a few for each user interacting at once
+MAX_SELECTIONS = 32
+
+_selections = ResultCache(MAX_SELECTIONS)
+# guards the per-selection locks and the scan counts, never held while computing
+_lock = threading.Lock()
+
+# {key: [lock, callers holding or waiting on it]} for the selections being asked for
+_computing = {}
+
+# count of times each selection was computed rather than reused
+_scans = {}
+
+
+def _shared(name, snapshot, compute, *inputs):
+    key = (name,) + tuple(normalize(value) for value in inputs)
+
+    with _lock:
+        entry = _computing.setdefault(key, [threading.Lock(), 0])
+        entry[1] += 1
+
+    try:
+        with entry[0]:
+            found, selection = _selections.get(key, snapshot.version)
+            if not found:
+                selection = compute()
+                _selections.put(key, snapshot.version, selection)
+                with _lock:
+                    _scans[name] = _scans.get(name, 0) + 1
+    finally:
+        with _lock:
+            entry[1] -= 1
+            if entry[1] == 0:
+                del _computing[key]
+
+    return selection
+
+
+def selected_cells(snapshot, neighborhoods=None, price_range=None, sizes=None, listings=False):
+    """cells of the snapshot's cube within the selections, None selects everything
+
+    with listings the cells count each listing once, at its first post, rather than every repost
+    """
+    if listings:
+        return _shared('listing cube', snapshot,
+                       lambda: select_cube(snapshot.listing_cube, neighborhoods, price_range, sizes),
+                       neighborhoods, price_range, sizes)
+
+    return _shared('cube', snapshot, lambda: select_cube(snapshot.cube, neighborhoods, price_range, sizes),
+                   neighborhoods, price_range, sizes)
+
+
+def select_posts(snapshot, neighborhoods, price_range, sizes):
+    """row positions of the posts within the selections, in row order
+
+    each neighborhood's posts are held in order of price, so its price range is
+    found with searchsorted and only the posts inside it are checked for size
+    """
+    rows = []
+    for hood in neighborhoods:
+        if hood not in snapshot.neighborhood_rows:
+            continue
+
+        prices = snapshot.neighborhood_prices[hood]
+        low = np.searchsorted(prices, price_range[0], side='left')
+        high = np.searchsorted(prices, price_range[1], side='right')
+        rows.append(snapshot.neighborhood_rows[hood][low:high])
+
+    if len(rows) == 0:
+        return np.array([], dtype=np.intp)
+
+    positions = np.concatenate(rows)
+    size_codes = snapshot.data['size'].cat.categories.get_indexer(sizes)
+    positions = positions[np.isin(snapshot.data['size'].cat.codes.values[positions], size_codes)]
+
+    return np.sort(positions)
+
+
+def selected_posts(snapshot, neighborhoods, price_range, sizes):
+    """row positions of the posts within the selections, shared like selected_cells"""
+    return _shared('posts', snapshot, lambda: select_posts(snapshot, neighborhoods, price_range, sizes),
+                   neighborhoods, price_range, sizes)
+
+
+def sort_posts(snapshot, positions, sort_by):
+    """the row positions in the table's sort order, newest first when unsorted
+
+    sorting by date looks up each row's rank in the snapshot's pre-sorted post times,
+    other columns are sorted directly
+    """
+    column, ascending = 'post_date', False
+    if sort_by:
+        column, ascending = sort_by[0]['column_id'], sort_by[0]['direction'] == 'asc'
+
+    if column in ('post_date', 'post_datetime'):
+        order = np.argsort(snapshot.recent_rank[positions], kind='mergesort')
+        return positions[order[::-1]] if ascending else positions[order]
+
+    values = post_rows(snapshot, positions, [column])[column]
+
+    return values.sort_values(ascending=ascending, kind='mergesort').index.values
+
+
+def sorted_posts(snapshot, neighborhoods, price_range, sizes, sort_by):
+    """row positions of the selected posts in the table's sort order, shared like selected_cells"""
+    def compute():
+        return sort_posts(snapshot, selected_posts(snapshot, neighborhoods, price_range, sizes), sort_by)
+
+    return _shared('sorted posts', snapshot, compute, neighborhoods, price_range, sizes, sort_by)
+
+
+def page_of_posts(snapshot, positions, page_current, page_size, columns):
+    """one page of posts in the given order, only the columns shown"""
+    start = page_current * page_size
+
+    return post_rows(snapshot, positions[start:start + page_size], columns)
+
+
+def scans():
+    """{selection: times computed} since the process started"""
+    with _lock:
+        return dict(_scans)
+
+
+def report():
+    """print how often selections were computed and reused"""
+    stats = _selections.stats()
+    print('filter scans: ' + ', '.join(name + ' ' + str(count) for name, count in sorted(scans().items()))
+          + ' for ' + str(stats['hits'] + stats['misses']) + ' selections.')
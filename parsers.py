@@ -0,0 +1,190 @@
+"""backends for parsing craigslist search result pages
+
+every parser turns a results page into (posts_found, records), where records are
+(region, post_datetime, neighborhood, post_title_text, post_price, post_link) tuples.
+rows without a neighborhood or with a price that is not a plain number are skipped.
+
+the fastest installed backend is used by default: selectolax, then beautiful soup
+restricted to the result rows (on lxml when it is installed), then the plain
+beautiful soup parse of the whole page.
+"""
+from bs4 import BeautifulSoup, SoupStrainer
+
+try:
+    import lxml  # noqa: F401
+    SOUP_FEATURES = 'lxml'
+except ImportError:
+    SOUP_FEATURES = 'html.parser'
+
+try:
+    from selectolax.lexbor import LexborHTMLParser as SelectolaxHTMLParser
+except ImportError:
+    try:
+        from selectolax.parser import HTMLParser as SelectolaxHTMLParser
+    except ImportError:
+        SelectolaxHTMLParser = None
+
+
+TITLE_CLASS = 'result-title hdrlnk'
+
+
+def parse_price(text):
+    """post price from the text of the row's first link, None if it is not a number"""
+    try:
+        return int(text.strip().replace("$", ""))
+    except ValueError:
+        return None
+
+
+class SoupParser(object):
+    """parses the whole page with beautiful soup, then searches each row"""
+    name = 'soup'
+
+    def parse(self, html, location):
+        records = []
+
+        html_soup = BeautifulSoup(html, 'html.parser')
+
+        posts = html_soup.find_all('li', class_= 'result-row')
+
+        # loop through each of the posts
+        for post in posts:
+
+            # skip if the neighborhood is not available
+            if post.find('span', class_ = 'result-hood') is not None:
+
+                # get the time of the post
+                post_time = post.find('time', class_= 'result-date')
+                post_datetime = post_time['datetime']
+
+                # get the title and associated link
+                post_title = post.find('a', class_='result-title hdrlnk')
+                post_link = post_title['href']
+                post_title_text = post_title.text
+
+                # get the neighborhood
+                post_hood = post.find('span', class_= 'result-hood').text
+
+                # get the post price
+                post_price = parse_price(post.a.text)
+                if post_price is None:
+                    continue
+
+                records.append((location, post_datetime, post_hood, post_title_text, post_price, post_link))
+
+        return len(posts), records
+
+
+class StrainedSoupParser(object):
+    """only builds the result rows with beautiful soup, reading each row in one walk"""
+    name = 'strained'
+
+    def __init__(self, features=SOUP_FEATURES):
+        self.features = features
+        self.strainer = SoupStrainer('li', class_='result-row')
+
+    def parse(self, html, location):
+        records = []
+
+        html_soup = BeautifulSoup(html, self.features, parse_only=self.strainer)
+
+        posts = html_soup.find_all('li', class_='result-row')
+
+        for post in posts:
+            first_link = post_time = post_title = post_hood = None
+
+            # pick out every field in a single pass over the row
+            for tag in post.find_all(True):
+                name = tag.name
+                if name == 'a':
+                    if first_link is None:
+                        first_link = tag
+                    if post_title is None and ' '.join(tag.get('class', ())) == TITLE_CLASS:
+                        post_title = tag
+                elif name == 'time':
+                    if post_time is None and 'result-date' in tag.get('class', ()):
+                        post_time = tag
+                elif name == 'span':
+                    if post_hood is None and 'result-hood' in tag.get('class', ()):
+                        post_hood = tag
+
+            # skip if the neighborhood is not available
+            if post_hood is None:
+                continue
+
+            post_price = parse_price(first_link.text)
+            if post_price is None:
+                continue
+
+            records.append((location, post_time['datetime'], post_hood.text, post_title.text,
+                            post_price, post_title['href']))
+
+        return len(posts), records
+
+
+class SelectolaxParser(object):
+    """parses with selectolax, reading each result row in one walk"""
+    name = 'selectolax'
+
+    def parse(self, html, location):
+        records = []
+
+        posts = SelectolaxHTMLParser(html).css('li.result-row')
+
+        for post in posts:
+            first_link = post_time = post_title = post_hood = None
+
+            # pick out every field in a single pass over the row
+            for node in post.traverse(include_text=False):
+                tag = node.tag
+                if tag == 'a':
+                    if first_link is None:
+                        first_link = node
+                    if post_title is None and node.attributes.get('class') == TITLE_CLASS:
+                        post_title = node
+                elif tag == 'time':
+                    if post_time is None and 'result-date' in (node.attributes.get('class') or '').split():
+                        post_time = node
+                elif tag == 'span':
+                    if post_hood is None and 'result-hood' in (node.attributes.get('class') or '').split():
+                        post_hood = node
+
+            # skip if the neighborhood is not available
+            if post_hood is None:
+                continue
+
+            post_price = parse_price(first_link.text())
+            if post_price is None:
+                continue
+
+            records.append((location, post_time.attributes['datetime'], post_hood.text(),
+                            post_title.text(), post_price, post_title.attributes['href']))
+
+        return len(posts), records
+
+
+PARSERS = {
+    'soup': SoupParser,
+    'strained': StrainedSoupParser,
+    'selectolax': SelectolaxParser,
+}
+
+
+def available_parsers():
+    """names of the parsers that can run with the installed packages, fastest first"""
+    names = ['strained', 'soup']
+    if SelectolaxHTMLParser is not None:
+        names.insert(0, 'selectolax')
+
+    return names
+
+
+def get_parser(name=None):
+    """parser by name, or the fastest one available"""
+    if name is None:
+        name = available_parsers()[0]
+
+    if name not in available_parsers():
+        raise ValueError('parser not available: ' + str(name))
+
+    return PARSERS[name]()
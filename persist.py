@@ -0,0 +1,254 @@
+"""a snapshot saved to local files, shared by every process on the machine
+
+each saved version is a directory of .npy arrays: the numeric columns, the codes of
+each categorical, the text's distinct values as fixed width utf-8 bytes, and the
+snapshot's indexes and cubes. meta.json holds the schema version, the categories and
+the snapshot's small lookups.
+
+a version is written aside, renamed into place, then made current by swapping the
+'current' symlink, so readers only ever see whole versions. loaded with mmap_mode='r'
+the arrays are mapped rather than read, and every gunicorn worker shares one copy of
+them in the page cache.
+"""
+import fcntl
+import json
+import os
+import re
+import shutil
+
+import numpy as np
+import pandas as pd
+
+from dataset import CATEGORY_COLUMNS, PostText, Strings
+from deals import SCORE_COLUMNS
+
+
+# bump when the saved arrays change, older saves are ignored
+SCHEMA_VERSION = 5
+
+DEFAULT_PATH = 'snapshot'
+
+# names of saved versions of any schema, see version_name, the only directories save removes
+VERSION_NAME = re.compile(r'v[0-9]+_')
+
+# the compacted posts' columns and the cubes', in order
+COLUMNS = ['region', 'post_datetime', 'post_day', 'neighborhood', 'post_price', 'size'] + SCORE_COLUMNS \
+    + ['listing_cluster_id']
+CUBE_COLUMNS = ['post_date', 'neighborhood', 'size', 'price_bucket', 'on_edge', 'posts', 'price_sum']
+
+TEXT_STRINGS = ['titles', 'links', 'id_suffixes']
+
+# the snapshot's cubes, saved under these prefixes
+CUBES = {'cube': 'cube_', 'listing_cube': 'listing_cube_'}
+
+_publisher_lock = None
+
+
+def snapshot_path():
+    """where snapshots are saved, SNAPSHOT_PATH when set"""
+    return os.environ.get('SNAPSHOT_PATH', DEFAULT_PATH)
+
+
+def version_name(tag):
+    """name of the saved version of a snapshot with this tag, under this schema"""
+    return 'v' + str(SCHEMA_VERSION) + '_' + tag
+
+
+def current_version(path=None):
+    """name of the current saved version, None when nothing is saved"""
+    path = path if path is not None else snapshot_path()
+
+    try:
+        return os.readlink(os.path.join(path, 'current'))
+    except OSError:
+        return None
+
+
+def save(snapshot, path=None):
+    """write a snapshot as a new version and make it current, returns the version's name"""
+    path = path if path is not None else snapshot_path()
+    data, text = snapshot.data, snapshot.text
+
+    arrays = {
+        'post_datetime': data['post_datetime'].values.view(np.int64),
+        'post_day': data['post_day'].values,
+        'post_price': data['post_price'].values,
+        'listing_cluster_id': data['listing_cluster_id'].values,
+        'own_ids': text.own_ids,
+        'recent_rank': snapshot.recent_rank,
+    }
+    for column in SCORE_COLUMNS:
+        arrays[column] = data[column].values
+    categories = {}
+    for column in CATEGORY_COLUMNS:
+        arrays[column] = data[column].cat.codes.values
+        categories[column] = data[column].cat.categories.tolist()
+
+    for name in TEXT_STRINGS:
+        strings = getattr(text, name)
+        arrays[name + '_codes'] = strings.codes
+        arrays[name + '_values'] = np.array([value.encode('utf-8') for value in strings.distinct()], dtype=bytes)
+
+    # each neighborhood's rows and prices, end to end
+    hoods = list(snapshot.neighborhood_rows)
+    arrays['neighborhood_rows'] = np.concatenate(
+        [np.zeros(0, dtype=np.intp)] + [snapshot.neighborhood_rows[hood] for hood in hoods])
+    arrays['neighborhood_prices'] = np.concatenate(
+        [np.zeros(0, dtype=np.int32)] + [snapshot.neighborhood_prices[hood] for hood in hoods])
+    arrays['neighborhood_bounds'] = np.cumsum([0] + [len(snapshot.neighborhood_rows[hood]) for hood in hoods])
+
+    for name, prefix in CUBES.items():
+        cube = getattr(snapshot, name)
+        arrays[prefix + 'post_date'] = cube['post_date'].values.view(np.int64)
+        for column in ['price_bucket', 'on_edge', 'posts', 'price_sum']:
+            arrays[prefix + column] = cube[column].values
+        for column in ['neighborhood', 'size']:
+            arrays[prefix + column] = cube[column].cat.codes.values
+            categories[prefix + column] = cube[column].cat.categories.tolist()
+
+    meta = {
+        'schema_version': SCHEMA_VERSION,
+        'tag': snapshot.tag,
+        'posts': len(data),
+        'categories': categories,
+        'neighborhoods': hoods,
+        # the snapshot's small lookups, so loading never scans the posts
+        'sorted_hoods': snapshot.sorted_hoods,
+        'sizes': snapshot.sizes,
+        # the newest data update whose posts are in it, see dataset.refresh_snapshot
+        'updated_through': None if snapshot.updated_through is None else str(snapshot.updated_through),
+        'most_common_neighborhoods': {
+            'count': snapshot.most_common_neighborhoods['count'].tolist(),
+            'neighborhood': snapshot.most_common_neighborhoods['neighborhood'].tolist(),
+        },
+    }
+
+    # versions are named by the schema and the snapshot's tag, the same posts are only
+    # written once, and again when the schema changes
+    os.makedirs(path, exist_ok=True)
+    version = version_name(snapshot.tag)
+    target = os.path.join(path, version)
+
+    if not os.path.exists(target):
+        partial = target + '.partial.' + str(os.getpid())
+        shutil.rmtree(partial, ignore_errors=True)
+        os.makedirs(partial)
+        for name, values in arrays.items():
+            np.save(os.path.join(partial, name + '.npy'), values)
+        with open(os.path.join(partial, 'meta.json'), 'w') as f:
+            json.dump(meta, f)
+        os.rename(partial, target)
+
+    # swap the current link in one step
+    previous = current_version(path)
+    link = os.path.join(path, 'current.' + str(os.getpid()))
+    if os.path.lexists(link):
+        os.remove(link)
+    os.symlink(version, link)
+    os.replace(link, os.path.join(path, 'current'))
+
+    # keep the version just replaced for processes still loading it, drop older ones.
+    # processes with one mapped keep their copy until they let it go. anything else in
+    # the directory is left alone
+    for name in os.listdir(path):
+        if VERSION_NAME.match(name) and name not in (version, previous) and '.partial.' not in name \
+                and os.path.isdir(os.path.join(path, name)) and not os.path.islink(os.path.join(path, name)):
+            shutil.rmtree(os.path.join(path, name), ignore_errors=True)
+
+    return version
+
+
+def load(path=None, mmap_mode='r'):
+    """(data, text, indexes) of the current saved version, None when there is none of this schema"""
+    path = path if path is not None else snapshot_path()
+    version = current_version(path)
+    if version is None:
+        return None
+    directory = os.path.join(path, version)
+
+    try:
+        with open(os.path.join(directory, 'meta.json')) as f:
+            meta = json.load(f)
+    except (OSError, ValueError):
+        return None
+
+    if meta.get('schema_version') != SCHEMA_VERSION:
+        print('ignoring saved snapshot with schema version ' + str(meta.get('schema_version')) + '.')
+        return None
+
+    def array(name):
+        return np.load(os.path.join(directory, name + '.npy'), mmap_mode=mmap_mode)
+
+    def categorical(name):
+        return pd.Categorical.from_codes(array(name), meta['categories'][name])
+
+    # copy=False keeps each column on its own mapped array
+    columns = {
+        'post_datetime': array('post_datetime').view('datetime64[ns]'),
+        'post_day': array('post_day'),
+        'post_price': array('post_price'),
+        'listing_cluster_id': array('listing_cluster_id'),
+    }
+    for column in SCORE_COLUMNS:
+        columns[column] = array(column)
+    for column in CATEGORY_COLUMNS:
+        columns[column] = categorical(column)
+    data = pd.DataFrame(columns, columns=COLUMNS, copy=False)
+
+    text = PostText(*[Strings(array(name + '_codes'), array(name + '_values')) for name in TEXT_STRINGS]
+                    + [array('own_ids')])
+
+    def cube(prefix):
+        return pd.DataFrame({
+            'post_date': array(prefix + 'post_date').view('datetime64[ns]'),
+            'neighborhood': categorical(prefix + 'neighborhood'),
+            'size': categorical(prefix + 'size'),
+            'price_bucket': array(prefix + 'price_bucket'),
+            'on_edge': array(prefix + 'on_edge'),
+            'posts': array(prefix + 'posts'),
+            'price_sum': array(prefix + 'price_sum'),
+        }, columns=CUBE_COLUMNS, copy=False)
+
+    rows = array('neighborhood_rows')
+    prices = array('neighborhood_prices')
+    bounds = array('neighborhood_bounds')
+    hoods = meta['neighborhoods']
+
+    indexes = {
+        'tag': meta['tag'],
+        'sorted_hoods': meta['sorted_hoods'],
+        'sizes': meta['sizes'],
+        'most_common_neighborhoods': pd.DataFrame(meta['most_common_neighborhoods'],
+                                                  columns=['count', 'neighborhood']),
+        'neighborhood_rows': {hood: rows[bounds[i]:bounds[i + 1]] for i, hood in enumerate(hoods)},
+        'neighborhood_prices': {hood: prices[bounds[i]:bounds[i + 1]] for i, hood in enumerate(hoods)},
+        'recent_rank': array('recent_rank'),
+        'updated_through': None if meta.get('updated_through') is None else pd.Timestamp(meta['updated_through']),
+    }
+    for name, prefix in CUBES.items():
+        indexes[name] = cube(prefix)
+
+    return data, text, indexes
+
+
+def try_publisher_lock(path=None):
+    """True when this process is, or has just become, the one that saves new versions
+
+    the lock is held until the process exits, then the next process to ask takes over
+    """
+    global _publisher_lock
+
+    if _publisher_lock is not None:
+        return True
+
+    path = path if path is not None else snapshot_path()
+    os.makedirs(path, exist_ok=True)
+    f = open(os.path.join(path, 'publisher.lock'), 'w')
+    try:
+        fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        f.close()
+        return False
+
+    _publisher_lock = f
+    return True
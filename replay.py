@@ -0,0 +1,118 @@
+"""record craigslist responses to disk and replay them without the network
+
+a store is a directory holding one gzipped body per url and an index.json mapping
+each url to its file and status code. record with a RecordingSession wrapped around
+a real session, then hand a ReplaySession to the FetchEngine to scrape offline.
+"""
+import gzip
+import hashlib
+import json
+import os
+import threading
+from collections import namedtuple
+
+from fetch import make_session
+
+
+# where recordings are kept unless told otherwise
+DEFAULT_STORE = os.path.join('fixtures', 'responses')
+
+
+StoredResponse = namedtuple('StoredResponse', ['url', 'status_code', 'text'])
+
+
+class MissingRecording(LookupError):
+    """a url was requested in replay mode that was never recorded"""
+
+
+class ResponseStore(object):
+    """compressed on-disk store of response bodies keyed by url"""
+
+    def __init__(self, path=DEFAULT_STORE):
+        self.path = path
+        self._lock = threading.Lock()
+        self._index_path = os.path.join(path, 'index.json')
+
+        if os.path.exists(self._index_path):
+            with open(self._index_path) as f:
+                self.index = json.load(f)
+        else:
+            self.index = {}
+
+    def __contains__(self, url):
+        return url in self.index
+
+    def __len__(self):
+        return len(self.index)
+
+    def urls(self):
+        return sorted(self.index)
+
+    def save(self, url, status_code, text):
+        """write the body for a url and record it in the index"""
+        file_name = hashlib.sha1(url.encode('utf-8')).hexdigest() + '.html.gz'
+
+        os.makedirs(self.path, exist_ok=True)
+        with gzip.open(os.path.join(self.path, file_name), 'wt', encoding='utf-8') as f:
+            f.write(text)
+
+        with self._lock:
+            self.index[url] = {'file': file_name, 'status_code': status_code}
+            with open(self._index_path, 'w') as f:
+                json.dump(self.index, f, indent=1, sort_keys=True)
+
+    def load(self, url):
+        """stored response for a url"""
+        try:
+            entry = self.index[url]
+        except KeyError:
+            raise MissingRecording('no recording for ' + url)
+
+        with gzip.open(os.path.join(self.path, entry['file']), 'rt', encoding='utf-8') as f:
+            text = f.read()
+
+        return StoredResponse(url, entry['status_code'], text)
+
+
+class RecordingSession(object):
+    """session that fetches over the network and saves every response to a store"""
+
+    def __init__(self, store, session=None):
+        self.store = store
+        self.session = session if session is not None else make_session()
+
+    def get(self, url, **kwargs):
+        response = self.session.get(url, **kwargs)
+        self.store.save(url, response.status_code, response.text)
+
+        return response
+
+    def close(self):
+        self.session.close()
+
+
+class ReplaySession(object):
+    """session that serves responses from a store and never touches the network"""
+
+    def __init__(self, store):
+        self.store = store
+
+    def get(self, url, **kwargs):
+        return self.store.load(url)
+
+    def close(self):
+        pass
+
+
+def make_mode_session(record=None, replay=None):
+    """recording or replaying session for the scraper's --record/--replay options, None for live"""
+    if record is not None and replay is not None:
+        raise ValueError('cannot record and replay at the same time')
+
+    if record is not None:
+        return RecordingSession(ResponseStore(record))
+
+    if replay is not None:
+        return ReplaySession(ResponseStore(replay))
+
+    return None
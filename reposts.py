@@ -0,0 +1,168 @@
+"""reposts of the same room under new links, found by their titles
+
+craigslist posters repost a room every few days, often with the title reworded a
+little. posts are clustered into listings: the same neighborhood, prices within
+PRICE_TOLERANCE of each other and titles alike enough by MinHash.
+
+each distinct title is split into lowercase words, shingled into its words and
+pairs of words, and summarized by SIGNATURE_SIZE minimum hashes. LSH splits the
+signatures into BANDS bands, and posts in one neighborhood with any band the same are
+candidates, so similar titles are found without comparing every pair. within each
+band's bucket posts are compared to their neighbor in order of price only, then
+linked when their signatures agree on at least MIN_SIMILARITY of their hashes.
+
+a listing's listing_cluster_id is the position of its first post in the snapshot,
+which stays the same as posts are appended
+"""
+from itertools import chain
+
+import numpy as np
+import pandas as pd
+
+
+SIGNATURE_SIZE = 20
+BANDS = 4
+
+# least share of minimum hashes two titles share to be the same listing, about the
+# share of shingles they have in common
+MIN_SIMILARITY = 0.7
+
+# most a repost's price differs from the post before it, as a fraction
+PRICE_TOLERANCE = 0.1
+
+# days of earlier posts new posts are matched against when appended
+REPOST_WINDOW_DAYS = 60
+
+# modulus of the minhash functions, a mersenne prime so products fit in 64 bits
+_PRIME = (1 << 31) - 1
+
+_rng = np.random.RandomState(20200403)
+_A = _rng.randint(1, _PRIME, SIGNATURE_SIZE).astype(np.int64)
+_B = _rng.randint(0, _PRIME, SIGNATURE_SIZE).astype(np.int64)
+
+
+def title_words(titles):
+    """list of each title's lowercase words, runs of letters and digits"""
+    return pd.Series(titles, dtype=object).fillna('').str.lower().str.findall(r'[a-z0-9]+').tolist()
+
+
+def signatures(titles):
+    """SIGNATURE_SIZE minhashes of each title's words and pairs of words, one row per title
+
+    a title without words has a signature of -1s, and is never linked
+    """
+    words = title_words(titles)
+    counts = np.fromiter(map(len, words), dtype=np.int64, count=len(words))
+    owners = np.repeat(np.arange(len(words)), counts)
+    words = np.array(list(chain.from_iterable(words)) or [''], dtype=object)[:len(owners)]
+
+    # pairs of neighboring words in the same title, hashed from the hashes of their words
+    hashes = pd.util.hash_array(words)
+    pairs = owners[:-1] == owners[1:]
+    hashes = np.concatenate([hashes, hashes[:-1][pairs] * np.uint64(1000003) ^ hashes[1:][pairs]])
+    owners = np.concatenate([owners, owners[:-1][pairs]])
+
+    order = np.argsort(owners, kind='mergesort')
+    owners = owners[order]
+    hashes = (hashes[order] % np.uint64(_PRIME)).astype(np.int64)
+
+    signature = np.full((len(counts), SIGNATURE_SIZE), -1, dtype=np.int64)
+    worded = counts > 0
+    if worded.any():
+        starts = np.searchsorted(owners, np.flatnonzero(worded))
+        for i in range(SIGNATURE_SIZE):
+            signature[worded, i] = np.minimum.reduceat((_A[i] * hashes + _B[i]) % _PRIME, starts)
+
+    return signature
+
+
+def candidate_pairs(signature, neighborhood, price):
+    """(first, second) positions of posts worth comparing, neighbors in price in a bucket"""
+    rows = SIGNATURE_SIZE // BANDS
+    firsts, seconds = [], []
+    for band in range(BANDS):
+        key = neighborhood.astype(np.uint64)
+        for value in signature[:, band * rows:(band + 1) * rows].T:
+            key = key * np.uint64(1000003) ^ value.astype(np.uint64)
+
+        order = np.lexsort([price, key])
+        same = key[order][1:] == key[order][:-1]
+        firsts.append(order[:-1][same])
+        seconds.append(order[1:][same])
+
+    return np.concatenate(firsts), np.concatenate(seconds)
+
+
+def components(n, first, second):
+    """lowest position among the posts linked to each post, through any chain of links"""
+    labels = np.arange(n)
+
+    while True:
+        # each link hooks the higher of its two trees under the lower
+        lowest = np.minimum(labels[first], labels[second])
+        np.minimum.at(labels, labels[first], lowest)
+        np.minimum.at(labels, labels[second], lowest)
+
+        # then every post points straight at its tree's root
+        while True:
+            jumped = labels[labels]
+            if (jumped == labels).all():
+                break
+            labels = jumped
+
+        if (labels[first] == labels[second]).all():
+            return labels
+
+
+def link(signature, neighborhood, price):
+    """(first, second) positions of posts that are the same listing"""
+    first, second = candidate_pairs(signature, neighborhood, price)
+
+    similarity = (signature[first] == signature[second]).mean(axis=1)
+    prices = np.maximum(price[first], price[second])
+    close = np.abs(price[first] - price[second]) <= PRICE_TOLERANCE * prices
+    keep = (similarity >= MIN_SIMILARITY) & close & (signature[first, 0] >= 0)
+
+    return first[keep], second[keep]
+
+
+def cluster_posts(data, titles):
+    """listing_cluster_id of each compacted post, titles as a Strings of their titles"""
+    # titles are dictionary encoded, so each distinct title is hashed once
+    signature = signatures(titles.distinct())[titles.codes]
+    first, second = link(signature, data['neighborhood'].cat.codes.values,
+                         data['post_price'].values.astype(np.int64))
+
+    return components(len(data), first, second).astype(np.int32)
+
+
+def add_clusters(data, titles, first_new=0):
+    """sets the listing_cluster_id column of compacted posts not yet published
+
+    posts from first_new on are matched against each other and the posts of the
+    REPOST_WINDOW_DAYS before them, the others keep their listings unless joined
+    """
+    if first_new == 0 or 'listing_cluster_id' not in data:
+        data['listing_cluster_id'] = cluster_posts(data, titles)
+        return data
+    if first_new >= len(data):
+        return data
+
+    day = data['post_day'].values
+    recent = np.flatnonzero(day[:first_new] > day[first_new:].min() - REPOST_WINDOW_DAYS)
+    positions = np.concatenate([recent, np.arange(first_new, len(data))])
+
+    # each distinct title in the window is read and hashed once
+    _, seen, codes = np.unique(titles.codes[positions], return_index=True, return_inverse=True)
+    signature = signatures(titles.take(positions[seen]))[codes]
+    first, second = link(signature, data['neighborhood'].cat.codes.values[positions],
+                         data['post_price'].values[positions].astype(np.int64))
+    roots = components(len(positions), first, second)
+
+    # the earlier posts keep the listings they have, new ones start from their positions,
+    # and the listings of posts linked here are joined wherever their other posts are
+    labels = np.append(data['listing_cluster_id'].values[:first_new], np.arange(first_new, len(data)))
+    joined = components(len(data), labels[positions], labels[positions][roots])
+    data['listing_cluster_id'] = joined[labels].astype(np.int32)
+
+    return data
@@ -0,0 +1,136 @@
+"""daily rollups of the room posts, kept in the database beside them
+
+ROLLUP_TABLE counts the posts and sums their prices per post_date, neighborhood, size
+and price bucket, the same cells as the dashboard's cube. each batch of new posts is
+counted in as it is stored, in the same transaction, so the rollups never disagree with
+the posts.
+
+with QUERY_BACKEND=database the dashboard reads its cube from the rollups instead of
+building it from every post, and loads only the recent posts its table shows. what
+crosses the network is then the size of the rollups, at most dates x neighborhoods x
+sizes x price buckets, rather than the number of posts. a refresh reads again only the
+dates its new posts were on.
+
+the upsert is INSERT ... ON CONFLICT, which both postgres and the sqlite stand-in used
+in tests support.
+"""
+import os
+
+import pandas as pd
+from sqlalchemy import text
+
+from aggregations import CUBE_KEYS, PRICE_BUCKET, cube_from_counts
+from dataset import derive_columns
+import storage
+from storage import copy_frame
+
+
+ROLLUP_TABLE = 'daily_rollups'
+
+# the table whose posts are rolled up
+POSTS_TABLE = 'rooms'
+
+KEY_COLUMNS = CUBE_KEYS
+
+# posts read at a time when rebuilding the rollups from scratch
+REBUILD_CHUNK_SIZE = 50000
+
+
+def in_database():
+    """True when the dashboard's aggregates come from the rollups, QUERY_BACKEND=database"""
+    return os.environ.get('QUERY_BACKEND', 'memory') == 'database'
+
+
+def cube_source():
+    """load_cube when the dashboard's aggregates come from the rollups, else None"""
+    return load_cube if in_database() else None
+
+
+def rollup(posts):
+    """posts and their price totals per cell of KEY_COLUMNS, from rows as stored"""
+    derived = derive_columns(posts[['post_datetime', 'neighborhood', 'post_title_text', 'post_price']].copy())
+    derived['post_date'] = derived['post_datetime'].dt.strftime('%Y-%m-%d')
+    prices = derived['post_price'].astype(int)
+    derived['price_bucket'] = prices // PRICE_BUCKET * PRICE_BUCKET
+    derived['on_edge'] = prices % PRICE_BUCKET == 0
+
+    # scraped posts have a categorical neighborhood, only the cells posted to are kept
+    grouped = derived.groupby(KEY_COLUMNS, sort=True, observed=True)['post_price']
+    counts = pd.DataFrame({'posts': grouped.size(), 'price_sum': grouped.sum().astype(int)}).reset_index()
+
+    return counts.loc[counts['posts'] > 0].reset_index(drop=True)
+
+
+def _create_table(con):
+    con.execute(text(
+        'CREATE TABLE ' + ROLLUP_TABLE + ' ('
+        'post_date DATE NOT NULL, neighborhood TEXT NOT NULL, size TEXT NOT NULL, '
+        'price_bucket INTEGER NOT NULL, on_edge BOOLEAN NOT NULL, '
+        'posts INTEGER NOT NULL, price_sum BIGINT NOT NULL, '
+        'PRIMARY KEY (post_date, neighborhood, size, price_bucket, on_edge))'
+    ))
+
+
+def _has_rollups(con):
+    """True when the rollups exist"""
+    return con.dialect.has_table(con, ROLLUP_TABLE)
+
+
+def add_posts(con, posts):
+    """count newly stored posts into the rollups, on the connection that stored them
+
+    the first time, when there are no rollups yet, they are built from every stored post
+    """
+    if not _has_rollups(con):
+        rebuild(con)
+        return
+
+    counts = rollup(posts)
+    if len(counts) == 0:
+        return
+
+    con.execute(text(
+        'INSERT INTO ' + ROLLUP_TABLE + ' (post_date, neighborhood, size, price_bucket, on_edge, posts, price_sum) '
+        'VALUES (:post_date, :neighborhood, :size, :price_bucket, :on_edge, :posts, :price_sum) '
+        'ON CONFLICT (post_date, neighborhood, size, price_bucket, on_edge) '
+        'DO UPDATE SET posts = ' + ROLLUP_TABLE + '.posts + excluded.posts, '
+        'price_sum = ' + ROLLUP_TABLE + '.price_sum + excluded.price_sum'
+    ), counts.to_dict('records'))
+
+
+def rebuild(con):
+    """replace the rollups with counts of every stored post, returns the cells written"""
+    con.execute(text('DROP TABLE IF EXISTS ' + ROLLUP_TABLE))
+    _create_table(con)
+
+    sql = 'SELECT post_datetime, neighborhood, post_title_text, post_price FROM ' + POSTS_TABLE
+    counts = [rollup(chunk) for chunk in pd.read_sql(sql, con=con, chunksize=REBUILD_CHUNK_SIZE)]
+    if len(counts) == 0:
+        return 0
+
+    # a day's posts may be split across chunks
+    counts = pd.concat(counts).groupby(KEY_COLUMNS, sort=True)[['posts', 'price_sum']].sum().reset_index()
+
+    return copy_frame(con, ROLLUP_TABLE, counts)
+
+
+def load_counts(since=None):
+    """the cells of the rollups as a frame, those from since's date on when given, built
+    first if the posts were never rolled up
+    """
+    sql = 'SELECT post_date, neighborhood, size, price_bucket, on_edge, posts, price_sum FROM ' + ROLLUP_TABLE
+    params = {}
+    if since is not None:
+        sql += ' WHERE post_date >= :since'
+        params['since'] = since.strftime('%Y-%m-%d')
+
+    with storage.begin() as con:
+        if not _has_rollups(con):
+            rebuild(con)
+
+        return pd.read_sql(text(sql), con=con, params=params)
+
+
+def load_cube(since=None):
+    """the dashboard's cube read from the rollups, only its cells from since's date on when given"""
+    return cube_from_counts(load_counts(since))
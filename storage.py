@@ -0,0 +1,226 @@
+"""database access for the scraper and the dashboard
+
+both share one pooled engine per process. the database is DATABASE_PATH when set,
+any sqlalchemy url including sqlite for a local stand-in, otherwise the rds instance
+at HOST with PASSWORD.
+"""
+import datetime
+import io
+import os
+import threading
+import time
+from contextlib import contextmanager
+from urllib.parse import quote_plus
+
+import pandas as pd
+from sqlalchemy import create_engine, event, text
+
+
+# bounded connection pool, per process
+POOL_SIZE = 2
+MAX_OVERFLOW = 3
+
+# seconds to wait for a free connection before giving up
+POOL_TIMEOUT = 30
+
+# seconds before a pooled connection is replaced, rds drops idle connections
+POOL_RECYCLE = 1800
+
+
+_engine = None
+_engine_url = None
+_engine_lock = threading.Lock()
+
+_metrics = {}
+_metrics_lock = threading.Lock()
+
+# one row per batch of new posts, the dashboard polls it to know when to reload and
+# how far back the batches since it last loaded reach
+UPDATES_TABLE = 'data_updates'
+
+
+def database_url():
+    """url of the database to use"""
+    if 'DATABASE_PATH' in os.environ:
+        return os.environ['DATABASE_PATH']
+
+    # any character may be in the password, escaped so it can't be read as part of the url
+    return 'postgresql://duncan:' + quote_plus(os.environ['PASSWORD']) + '@' + os.environ['HOST'] + ':5432/postgres'
+
+
+def _record(name, seconds):
+    with _metrics_lock:
+        count, total = _metrics.get(name, (0, 0.0))
+        _metrics[name] = (count + 1, total + seconds)
+
+
+def _on_connect(dbapi_connection, connection_record):
+    _record('new connections', 0.0)
+
+
+def _before_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault('query_start', []).append(time.perf_counter())
+
+
+def _after_execute(conn, cursor, statement, parameters, context, executemany):
+    _record('queries', time.perf_counter() - conn.info['query_start'].pop())
+
+
+def get_engine():
+    """the process wide engine, created on first use or when the database url changes"""
+    global _engine, _engine_url
+
+    url = database_url()
+    with _engine_lock:
+        if _engine is not None and _engine_url != url:
+            _engine.dispose()
+            _engine = None
+
+        if _engine is None:
+            if url.startswith('sqlite'):
+                engine = create_engine(url)
+            else:
+                engine = create_engine(
+                    url,
+                    pool_size=POOL_SIZE,
+                    max_overflow=MAX_OVERFLOW,
+                    pool_timeout=POOL_TIMEOUT,
+                    pool_recycle=POOL_RECYCLE,
+                    pool_pre_ping=True,
+                )
+
+            event.listen(engine.pool, 'connect', _on_connect)
+            event.listen(engine, 'before_cursor_execute', _before_execute)
+            event.listen(engine, 'after_cursor_execute', _after_execute)
+            _engine = engine
+            _engine_url = url
+
+        return _engine
+
+
+@contextmanager
+def connect():
+    """pooled connection, returned to the pool afterwards"""
+    start = time.perf_counter()
+    con = get_engine().connect()
+    _record('connection checkouts', time.perf_counter() - start)
+
+    try:
+        yield con
+    finally:
+        con.close()
+
+
+@contextmanager
+def begin():
+    """pooled connection inside a transaction, committed unless an error is raised"""
+    with connect() as con:
+        with con.begin():
+            yield con
+
+
+def read_sql(sql, params=None):
+    """run a query on a pooled connection, returns a dataframe"""
+    with connect() as con:
+        return pd.read_sql(sql, con=con, params=params)
+
+
+def dispose():
+    """close every pooled connection"""
+    global _engine
+
+    with _engine_lock:
+        if _engine is not None:
+            _engine.dispose()
+            _engine = None
+
+
+def metrics():
+    """{name: (count, total seconds)} for connection checkouts, new connections and queries"""
+    with _metrics_lock:
+        return dict(_metrics)
+
+
+def report():
+    """print the connection and query timings"""
+    for name, (count, total) in sorted(metrics().items()):
+        print(name + ': ' + str(count) + ', ' + str(round(total, 3)) + 's total')
+
+
+def copy_frame(con, table, data):
+    """bulk append a dataframe to a table on an open connection, returns the rows written
+
+    on postgres the rows stream through COPY FROM STDIN from an in-memory csv buffer,
+    inside whatever transaction the connection has open. other databases, like the
+    sqlite stand-in used in tests, fall back to to_sql.
+    """
+    if len(data) == 0:
+        return 0
+
+    if con.dialect.name != 'postgresql' or con.dialect.driver != 'psycopg2':
+        data.to_sql(table, con=con, if_exists='append', index=False)
+        return len(data)
+
+    buffer = io.StringIO()
+    data.to_csv(buffer, index=False, header=False)
+    buffer.seek(0)
+
+    columns = ', '.join('"' + column + '"' for column in data.columns)
+    sql = 'COPY ' + table + ' (' + columns + ') FROM STDIN WITH (FORMAT csv)'
+
+    cursor = con.connection.cursor()
+    try:
+        cursor.copy_expert(sql, buffer)
+    finally:
+        cursor.close()
+
+    return len(data)
+
+
+def _create_updates_table(con):
+    con.execute(text('CREATE TABLE IF NOT EXISTS ' + UPDATES_TABLE
+                     + ' (updated_at TIMESTAMP, posts INTEGER, oldest_post TIMESTAMP)'))
+
+
+def _timestamp(value):
+    return None if value is None else pd.Timestamp(value)
+
+
+def signal_data_updated(con, posts, oldest_post=None):
+    """record that posts were added, on an open connection so it commits with them
+
+    oldest_post is the post_datetime of the oldest room post among them, None when no
+    room posts were added
+    """
+    _create_updates_table(con)
+    con.execute(
+        text('INSERT INTO ' + UPDATES_TABLE + ' (updated_at, posts, oldest_post) '
+             'VALUES (:updated_at, :posts, :oldest_post)'),
+        {'updated_at': datetime.datetime.now(), 'posts': posts,
+         'oldest_post': None if oldest_post is None else pd.Timestamp(oldest_post).to_pydatetime()},
+    )
+
+
+def latest_data_update():
+    """time of the newest update signalled, None before the first"""
+    with begin() as con:
+        _create_updates_table(con)
+        return _timestamp(con.execute(text('SELECT MAX(updated_at) FROM ' + UPDATES_TABLE)).scalar())
+
+
+def data_updates_since(after=None):
+    """(time of the newest update signalled, oldest room post of the updates after the
+    given time or of every update when None), each None when there is none
+    """
+    sql = 'SELECT MIN(oldest_post) FROM ' + UPDATES_TABLE
+    params = {}
+    if after is not None:
+        sql += ' WHERE updated_at > :after'
+        params['after'] = pd.Timestamp(after).to_pydatetime()
+
+    with begin() as con:
+        _create_updates_table(con)
+        latest = con.execute(text('SELECT MAX(updated_at) FROM ' + UPDATES_TABLE)).scalar()
+        oldest = con.execute(text(sql), params).scalar()
+
+    return _timestamp(latest), _timestamp(oldest)
@@ -0,0 +1,158 @@
+"""the scraper's own process: searches craigslist on a fixed schedule
+
+run as the Procfile's worker, one per deployment. a lock makes sure a second copy
+exits instead of scraping alongside the first, and is checked again before each scrape
+in case it was lost with its database connection. each scrape that stores new posts
+signals the dashboard through the database, and its web workers reload on their own.
+"""
+import argparse
+import fcntl
+import os
+import tempfile
+import time
+import zlib
+from contextlib import contextmanager
+
+from sqlalchemy import text
+from sqlalchemy.exc import DBAPIError
+
+from apartment_search import MAX_PAGES, run_apartment_search
+import storage
+
+
+# number of seconds between scrapes, every hour
+UPDATE_INTERVAL = 3600
+
+LOCK_NAME = 'apartment-search'
+
+
+class AlreadyRunning(RuntimeError):
+    """another worker holds the lock"""
+
+
+def next_run(start, period, now):
+    """the first time after now on the schedule start, start + period, ...
+
+    runs are due at fixed offsets from start rather than a period after the last one
+    finished, so the schedule doesn't drift. runs missed while a scrape overran are
+    skipped, not made up back to back
+    """
+    return start + period * ((now - start) // period + 1)
+
+
+class AdvisoryLock(object):
+    """a postgres session advisory lock, held on a connection of its own
+
+    the lock goes with its session, so when the database drops the idle connection it
+    is released without a word. check finds out, and takes it again when it is free
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.key = zlib.crc32(name.encode('utf-8'))
+        self.con = None
+
+    def _held(self):
+        sql = ("SELECT COUNT(*) FROM pg_locks WHERE locktype = 'advisory' AND objid = :key "
+               "AND pid = pg_backend_pid() AND granted")
+        try:
+            return self.con.execute(text(sql), {'key': self.key}).scalar() > 0
+        except DBAPIError:
+            return False
+
+    def check(self):
+        """returns once the lock is held, raises AlreadyRunning when another process has it"""
+        if self.con is not None and self._held():
+            return
+
+        self.release()
+        self.con = storage.get_engine().connect()
+        if not self.con.execute(text('SELECT pg_try_advisory_lock(:key)'), {'key': self.key}).scalar():
+            self.release()
+            raise AlreadyRunning(self.name + ' is locked by another worker')
+
+    def release(self):
+        if self.con is None:
+            return
+
+        try:
+            self.con.execute(text('SELECT pg_advisory_unlock(:key)'), {'key': self.key})
+        except DBAPIError:
+            pass
+        finally:
+            self.con.close()
+            self.con = None
+
+
+@contextmanager
+def single_instance(name=LOCK_NAME):
+    """held while the worker runs, raises AlreadyRunning when another process has it
+
+    yields a check to call before each run, which raises AlreadyRunning once another
+    process has taken the lock. on postgres it is a session advisory lock, which covers
+    workers on other machines. elsewhere, like a local sqlite database, it is a lock file
+    in the temp directory
+    """
+    if storage.get_engine().dialect.name == 'postgresql':
+        lock = AdvisoryLock(name)
+        lock.check()
+        try:
+            yield lock.check
+        finally:
+            lock.release()
+        return
+
+    with open(os.path.join(tempfile.gettempdir(), name + '.lock'), 'w') as f:
+        try:
+            fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            raise AlreadyRunning(name + ' is locked by another worker')
+        try:
+            # held by the open file, it can't be lost
+            yield lambda: None
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def run_every(period, job, runs=None, clock=time.monotonic, sleep=time.sleep):
+    """call job now and then on the schedule from next_run, forever unless runs is given
+
+    a job that finds another worker running stops the schedule, other errors only fail
+    that run
+    """
+    start = clock()
+    done = 0
+    while runs is None or done < runs:
+        try:
+            job()
+        except AlreadyRunning:
+            raise
+        except Exception as e:
+            print('scheduled run failed: ' + str(e))
+        done += 1
+
+        if runs is None or done < runs:
+            sleep(max(0.0, next_run(start, period, clock()) - clock()))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='search craigslist for new posts on a schedule')
+    parser.add_argument('--interval', type=float, default=UPDATE_INTERVAL,
+                        help='seconds between the starts of scrapes')
+    parser.add_argument('--max-pages', type=int, default=MAX_PAGES,
+                        help='result pages to follow per location')
+    args = parser.parse_args()
+
+    try:
+        with single_instance() as check_lock:
+            def scrape():
+                check_lock()
+                run_apartment_search(max_pages=args.max_pages)
+
+            run_every(args.interval, scrape)
+    except AlreadyRunning as e:
+        print(str(e) + ', exiting.')
+
+
+if __name__ == '__main__':
+    main()